@@ -4,42 +4,374 @@ from sklearn.model_selection import train_test_split
 from sklearn.metrics.pairwise import cosine_similarity, manhattan_distances, euclidean_distances
 from tqdm import tqdm
 from sklearn.metrics import mean_squared_error
+from scipy import sparse
+
+# shared modules of 2.RecommenderSystem, the entry point puts that folder on sys.path
+from assetstore import AssetStore, LazyAsset
+from instrumentation import Instrumentation
+from simbuilder import build_neighbors, top_k_positions
+from querycache import canonical_key
+from bundle import Bundle, BundleAssetStore, write_bundle, frame_arrays, sparse_arrays, dict_arrays
+
+
+METRICS = ['cosine_similarity', 'manhattan_distances', 'euclidean_distances']
+AGGREGATIONS = ['sum', 'mean', 'max']
+# create_sim_mat method -> simbuilder metric
+BUILDER_METRICS = {'cosine_similarity' : 'cosine', 'manhattan_distances' : 'manhattan', 'euclidean_distances' : 'euclidean'}
+
+
+def _pairwise(X_block, X, method):
+    """
+    Compute the similarity (or distance) between a block of rows and every row of X.
+    """
+    if method == 'cosine_similarity':
+        return cosine_similarity(X_block, X)
+    elif method == 'manhattan_distances':
+        return manhattan_distances(X_block, X)
+    elif method == 'euclidean_distances':
+        return euclidean_distances(X_block, X)
+    raise ValueError("method not in {'cosine_similarity', 'manhattan_distances', 'euclidean distances'}")
+
+
+def _to_score(values, method):
+    """
+    Turn similarities/distances into scores where higher is better and 0 means unrelated,
+    so that sparse rows (missing = 0) can be summed with dense ones.
+    """
+    if method == 'cosine_similarity':
+        return values
+    return 1 / (1 + values)
+
+
+def _is_batch(title_ids):
+    """
+    True if title_ids is a list of seed lists rather than a single seed list.
+    """
+    return len(title_ids) > 0 and np.ndim(title_ids[0]) > 0
+
+
+def cached_top_k(cache, owner, method, version, queries, k, exclude, compute, **params):
+    """
+    aggregate_top_k results of a batch of queries through a QueryCache(see querycache.py):
+    every query is looked up on its sorted seeds, k, exclusions and params, only the missing ones are computed.
+    
+    *parameters
+    - cache(QueryCache): the cache, None computes every query
+    - owner: recommender the queries run on
+    - method(String): name of the query method
+    - version(Integer): model version of owner
+    - queries(List): one list of seed title_ids per query
+    - k(Integer): number of titles to recommend per query
+    - exclude(List): one list of title_ids to exclude per query
+    - compute(Function): compute(queries, exclude) -> (rec_ids, rec_scores) as aggregate_top_k
+    - params: other settings the results depend on
+    
+    *return
+    - rec_ids, rec_scores: (queries x k) arrays as aggregate_top_k
+    """
+    if cache is None:
+        return compute(queries, exclude)
+    keys = [canonical_key(q, k = k, exclude = sorted(excl), **params) for q, excl in zip(queries, exclude)]
+    def compute_missing(missing):
+        rec_ids, rec_scores = compute([queries[i] for i in missing], [exclude[i] for i in missing])
+        return list(zip(rec_ids, rec_scores))
+    rows = cache.call_batch(owner, method, version, keys, compute_missing)
+    return np.vstack([ids for ids, _ in rows]), np.vstack([scores for _, scores in rows])
+
+
+def aggregate_top_k(score_mat, title_ids, title_pos, queries, k, aggregation = 'sum', power = 1, exclude = None):
+    """
+    Shared scoring core of ContentBasedFiltering.recommend and SimilarityScorer.
+    The rows of every seed of every query are gathered at once(sparse rows stay sparse), raised to
+    the given power, aggregated per query with one sparse query x seed product(sum/mean) or
+    maximum.at(max), and the top k of each query are taken with argpartition.
+    Seeds and excluded titles are never picked; seeds missing from title_pos are ignored.
+    
+    *parameters
+    - score_mat(numpy array or scipy sparse matrix): titles x titles scores, higher is better
+    - title_ids(numpy array): title_id of each row position
+    - title_pos(Dictionary): title_id -> row position
+    - queries(List): one list of seed title_ids per query
+    - k(Integer): number of titles to recommend per query
+    - aggregation(String): ['sum', 'mean', 'max']
+    - power(Float): seed scores are raised to this power before aggregation(sign is kept)
+    - exclude(List): one list of title_ids to exclude per query
+    
+    *return
+    - rec_ids(numpy array): (queries x k) recommended title_ids, padded with -1
+    - rec_scores(numpy array): (queries x k) aggregated scores, padded with nan
+    """
+    if aggregation not in AGGREGATIONS:
+        raise ValueError("aggregation not in {'sum', 'mean', 'max'}")
+    if exclude is None:
+        exclude = [[] for _ in queries]
+    
+    # row positions of every seed, and the query each one belongs to
+    seed_pos = [[title_pos[t] for t in q if t in title_pos] for q in queries]
+    seed_counts = np.array([len(p) for p in seed_pos])
+    seed_rows = np.repeat(np.arange(len(queries)), seed_counts)
+    flat_pos = np.array([p for q in seed_pos for p in q], dtype = np.int64)
+    
+    rows = score_mat[flat_pos]
+    if power != 1:
+        if sparse.issparse(rows):
+            rows.data = np.sign(rows.data) * np.abs(rows.data) ** power
+        else:
+            rows = np.sign(rows) * np.abs(rows) ** power
+    
+    n_titles = score_mat.shape[0]
+    if aggregation == 'max':
+        scores = np.zeros((len(queries), n_titles), dtype = np.float32)
+        if sparse.issparse(rows):
+            rows = rows.tocoo()
+            np.maximum.at(scores, (seed_rows[rows.row], rows.col), rows.data)
+        else:
+            scores[:] = -np.inf
+            np.maximum.at(scores, seed_rows, rows)
+    else:
+        weights = np.ones(len(flat_pos), dtype = np.float32)
+        if aggregation == 'mean':
+            weights /= np.repeat(np.maximum(seed_counts, 1), seed_counts)
+        query_mat = sparse.csr_matrix((weights, (seed_rows, np.arange(len(flat_pos)))), shape = (len(queries), len(flat_pos)))
+        scores = query_mat @ rows
+        scores = scores.toarray() if sparse.issparse(scores) else np.asarray(scores)
+    
+    # seeds and excluded titles can never be picked, queries without a known seed get nothing
+    scores[seed_counts == 0] = -np.inf
+    for q, (pos, excl) in enumerate(zip(seed_pos, exclude)):
+        scores[q, pos] = -np.inf
+        scores[q, [title_pos[t] for t in excl if t in title_pos]] = -np.inf
+    
+    idx = top_k_positions(scores, k, largest = True)
+    rec_scores = np.take_along_axis(scores, idx, axis = 1)
+    rec_ids = np.where(np.isinf(rec_scores), -1, title_ids[idx])
+    rec_scores[np.isinf(rec_scores)] = np.nan
+    return rec_ids, rec_scores
+
+
+class SimilarityScorer:
+    def __init__(self, sim_mat, title_ids, power = 3, aggregation = 'sum', names = None, instrumentation = None, cache = None):
+        """
+        Multi-seed recommender over a precomputed similarity matrix(e.g. latent_sim.npz) that never
+        densifies the seed rows: the power/sum weighting runs on the sparse rows and the top k are
+        taken with argpartition, so the cost grows with the non-zeros of the seeds, not with the catalog.
+        
+        *parameters
+        - sim_mat(scipy sparse matrix or numpy array): titles x titles similarity
+        - title_ids(List): title_id of each row of sim_mat(e.g. title_idx_num.csv)
+        - power(Float): seed similarities are raised to this power before aggregation(sign is kept)
+        - aggregation(String): ['sum', 'mean', 'max']
+        - names(List): title name of each row(e.g. title_romaji). If given, titles whose name contains
+          a seed's name(sequels, spin-offs) are excluded along with the seed
+        - instrumentation(Instrumentation): stage timers of recommend(see instrumentation.py). Default is a disabled one
+        - cache(QueryCache): cache of the recommend results(see querycache.py). None caches nothing
+        """
+        self.sim_mat = sparse.csr_matrix(sim_mat) if sparse.issparse(sim_mat) else np.asarray(sim_mat)
+        self.title_ids = np.asarray(title_ids)
+        self.title_pos = {title_id : pos for pos, title_id in enumerate(self.title_ids)}
+        self.power = power
+        self.aggregation = aggregation
+        self.names = None if names is None else pd.Series(names).fillna('').str.lower().values
+        self._aliases = {}
+        self.instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        self.cache = cache
+        # the similarity matrix never changes after __init__
+        self.version = 0
+    
+    def aliases(self, title_id):
+        """
+        title_ids whose name contains the name of title_id(computed once per title, then cached)
+        
+        *parameters
+        - title_id(Integer): title_id of a title
+        
+        *return
+        - aliases(List): title_ids of its aliases, title_id included
+        """
+        if title_id not in self._aliases:
+            pos = self.title_pos.get(title_id)
+            if self.names is None or pos is None or self.names[pos] == '':
+                self._aliases[title_id] = [title_id]
+            else:
+                contains = pd.Series(self.names).str.contains(self.names[pos], regex = False).values
+                self._aliases[title_id] = self.title_ids[contains].tolist()
+        return self._aliases[title_id]
+    
+    def recommend(self, title_ids, k = 50, exclude = None):
+        """
+        Recommend titles for one set of seed titles, or for a batch of seed lists in one pass.
+        The seeds and their aliases are excluded by id.
+        
+        *parameters
+        - title_ids(List): seed title_ids, or a list of seed lists for a batch of queries
+        - k(Integer): number of titles to recommend per query
+        - exclude(List): other title_ids never to recommend. For a batch, either one list for every query
+          or one list per query
+        
+        *return
+        - rec_ids(numpy array): recommended title_ids, best first
+        - rec_scores(numpy array): aggregated score of each recommended title
+          for a batch both are (queries x k) arrays padded with -1 and nan
+        """
+        batch = _is_batch(title_ids)
+        queries = [list(q) for q in title_ids] if batch else [list(title_ids)]
+        if exclude is None:
+            exclude = [[] for _ in queries]
+        elif not _is_batch(exclude):
+            exclude = [exclude for _ in queries]
+        
+        excluded = []
+        with self.instrumentation.stage('cbf.aliases'):
+            for seeds, excl in zip(queries, exclude):
+                query_excluded = set(excl)
+                for title_id in seeds:
+                    query_excluded.update(self.aliases(title_id))
+                excluded.append(list(query_excluded))
+        def compute(queries, excluded):
+            with self.instrumentation.stage('cbf.aggregate_top_k'):
+                return aggregate_top_k(self.sim_mat, self.title_ids, self.title_pos, queries, k, self.aggregation, self.power, excluded)
+        rec_ids, rec_scores = cached_top_k(self.cache, self, 'cbf.scorer_recommend', self.version, queries, k, excluded, compute)
+        if batch:
+            return rec_ids, rec_scores
+        valid = rec_ids[0] != -1
+        return rec_ids[0][valid], rec_scores[0][valid]
+    
+    def save_bundle(self, path):
+        """
+        Write the similarity matrix, title_ids, names and settings to a single bundle file(see bundle.py)
+        that worker processes memory-map with load_bundle instead of each reading their own copy.
+        
+        *parameters
+        - path(String): bundle file to write
+        """
+        if sparse.issparse(self.sim_mat):
+            arrays, meta = sparse_arrays('sim_mat', self.sim_mat)
+        else:
+            arrays, meta = {'sim_mat' : self.sim_mat}, {}
+        arrays['title_ids'] = self.title_ids
+        if self.names is not None:
+            arrays['names'] = np.array(self.names, dtype = str)
+        meta.update({'power' : self.power, 'aggregation' : self.aggregation})
+        write_bundle(path, arrays, 'cbf_scorer', meta)
+    
+    @classmethod
+    def load_bundle(cls, path, instrumentation = None, cache = None):
+        """
+        SimilarityScorer over a bundle written by save_bundle. The similarity matrix is a read-only
+        memory-mapped view of the file, shared by every process that loads the same bundle.
+        
+        *parameters
+        - path(String): bundle file
+        - instrumentation(Instrumentation): stage timers of recommend(see instrumentation.py). Default is a disabled one
+        - cache(QueryCache): cache of the recommend results(see querycache.py). None caches nothing
+        
+        *return
+        - scorer(SimilarityScorer)
+        """
+        bundle = Bundle(path, expected_kind = 'cbf_scorer')
+        sim_mat = bundle.sparse('sim_mat') if 'sim_mat.data' in bundle else bundle.array('sim_mat')
+        names = bundle.array('names') if 'names' in bundle else None
+        return cls(sim_mat, bundle.array('title_ids'), bundle.meta['power'], bundle.meta['aggregation'], names,
+                   instrumentation = instrumentation, cache = cache)
+
 
 class ContentBasedFiltering:
-    def __init__(self):
+    # titles are loaded lazily, the first time a method needs them(see assetstore.py)
+    titles_df = LazyAsset(lambda self : self.assets.load_frame('titles_200p_cleaned'))
+    title_romaji_map = LazyAsset(lambda self : self.titles_df.set_index('title_id')['title_romaji'].to_dict())
+    popular_titles = LazyAsset(lambda self : self.titles_df.loc[lambda x : x.popularity > 10000]['title_id'].tolist())
+    
+    def __init__(self, asset_root = '/home/dy0904k/assets', columnar_root = None, instrumentation = None, cache = None):
+        """
+        *parameters
+        - asset_root(String): folder that holds titles_200p_cleaned.csv
+        - columnar_root(String): folder of the columnar copies of the assets. Default is asset_root/columnar
+        - instrumentation(Instrumentation): stage timers of the methods(see instrumentation.py). Default is a disabled one
+        - cache(QueryCache): cache of the recommend results(see querycache.py). None caches nothing
+        """
+        self.assets = AssetStore(asset_root, columnar_root)
+        self.instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        self.cache = cache
+        # incremented by every create_sim_mat call, cached results of older versions are dropped
+        self.version = 0
         self.sim_mat = None
-        self.titles_df = pd.read_csv('/home/dy0904k/assets/titles_200p_cleaned.csv')
-        self.title_romaji_map = self.titles_df.set_index('title_id')['title_romaji'].to_dict()
-        self.popular_titles = self.titles_df.loc[lambda x : x.popularity > 10000]['title_id'].tolist()
+        self.sim_index = None
+        self._score_mat = None
         self.similarity_metric = None
         
-    def create_sim_mat(self, df, method = 'cosine_similarity'):
+    def create_sim_mat(self, df, method = 'cosine_similarity', top_k = None, block_size = 1024, n_workers = 1, out_dir = None):
         """
         Create a similarity matrix with a title-feature dataframe using chosen method.
         a title-feature dataframe should be formatted as follows:
         - title_ids in the indexes
         - features(e.g., genres, synopsis, etc.) in the columns
         
+        If top_k is given, the full matrix is never materialized: similarities are computed
+        block_size rows at a time and only the top_k neighbors of each title are kept.
+        With n_workers != 1 or an out_dir, the blocks run on a process pool(see simbuilder.py) and
+        the index is written to out_dir as they finish.
+        
         *parameters
         - df(Pandas DataFrame object): title-feature dataframe
         - method(String): ['cosine_similarity', ' manhattan_distances', 'euclidean_distances']
+        - top_k(Integer): number of neighbors to keep per title. None builds the dense matrix
+        - block_size(Integer): number of rows computed at once when top_k is given
+        - n_workers(Integer): worker processes of the top_k build. None uses every core
+        - out_dir(String): folder to write the top_k index to and memory-map it from
         
         *attributes
-        - self.sim_mat(Pandas DataFrame object): similarity matrix created from title-feature dataframe
+        - self.sim_mat(Pandas DataFrame object): similarity matrix created from title-feature dataframe (dense mode)
+        - self.sim_index(Dictionary): top-k neighbor index (top_k mode)
+            - 'neighbors'(int32 array, titles x top_k): row positions of the neighbors, best first
+            - 'values'(float32 array, titles x top_k): similarity/distance to each neighbor
+        - self.title_ids(numpy array): title_id of each row position
+        - self.title_pos(Dictionary): title_id -> row position
         """
         
-        df = df.loc[lambda x : x.index.isin(self.titles_df.title_id)]
-        if method == 'cosine_similarity':
-            sim_mat = cosine_similarity(df)
-        elif method == 'manhattan_distances':
-            sim_mat = manhattan_distances(df)
-        elif method == 'euclidean_distances':
-            sim_mat = euclidean_distances(df)
-        else:
+        if method not in METRICS:
             raise ValueError("method not in {'cosine_similarity', 'manhattan_distances', 'euclidean distances'}")
         
+        df = df.loc[lambda x : x.index.isin(self.titles_df.title_id)]
         self.similarity_metric = method
-        self.sim_mat = pd.DataFrame(sim_mat, index = df.index, columns = df.index)
+        self.version += 1
+        self.title_ids = df.index.values
+        self.title_pos = {title_id : pos for pos, title_id in enumerate(self.title_ids)}
+        self._score_mat = None
+        
+        if top_k is None:
+            self.sim_index = None
+            with self.instrumentation.stage('cbf.create_sim_mat.pairwise'):
+                self.sim_mat = pd.DataFrame(_pairwise(df, df, method), index = df.index, columns = df.index)
+            return
+        
+        if n_workers != 1 or out_dir is not None:
+            with self.instrumentation.stage('cbf.create_sim_mat.parallel'):
+                index = build_neighbors(df.values, BUILDER_METRICS[method], top_k, n_workers = n_workers,
+                                        tile_size = block_size, out_dir = out_dir)
+            self.sim_mat = None
+            self.sim_index = index
+            return
+        
+        # build the top-k index block by block; peak memory is block_size x titles
+        X = df.values.astype(np.float32)
+        n_titles = len(X)
+        top_k = min(top_k, n_titles - 1)
+        largest = method == 'cosine_similarity'
+        neighbors = np.empty((n_titles, top_k), dtype = np.int32)
+        values = np.empty((n_titles, top_k), dtype = np.float32)
+        for start in range(0, n_titles, block_size):
+            stop = min(start + block_size, n_titles)
+            with self.instrumentation.stage('cbf.create_sim_mat.pairwise'):
+                block = _pairwise(X[start:stop], X, method)
+            # a title is never its own neighbor
+            block[np.arange(stop - start), np.arange(start, stop)] = -np.inf if largest else np.inf
+            with self.instrumentation.stage('cbf.create_sim_mat.top_k'):
+                idx = top_k_positions(block, top_k, largest)
+            neighbors[start:stop] = idx
+            values[start:stop] = np.take_along_axis(block, idx, axis = 1)
+        
+        self.sim_mat = None
+        self.sim_index = {'neighbors' : neighbors, 'values' : values}
         
     def check_sanity(self, title_id, max_num = 20, in_romaji = True, only_popular = True):
         """
@@ -55,6 +387,9 @@ class ContentBasedFiltering:
         *return
         - sim_rank(Pandas DataFrame object): a list of similar titles to given title_id sorted by similarity
         """
+        if self.sim_index is not None:
+            return self._check_sanity_from_index(title_id, max_num, in_romaji, only_popular)
+        
         sim_mat = self.sim_mat
         if only_popular == True:
             sim_mat = self.sim_mat[self.popular_titles]
@@ -69,3 +404,131 @@ class ContentBasedFiltering:
             sim_rank.index = sim_rank.index.map(self.title_romaji_map)
             sim_rank.columns = [self.title_romaji_map[title_id]]
         return sim_rank
+    
+    def _check_sanity_from_index(self, title_id, max_num, in_romaji, only_popular):
+        """
+        check_sanity for the top-k index built by create_sim_mat(top_k = ...).
+        Neighbors are already sorted best first, so no sorting is needed here.
+        """
+        pos = self.title_pos[title_id]
+        neighbor_ids = self.title_ids[self.sim_index['neighbors'][pos]]
+        values = self.sim_index['values'][pos]
+        if only_popular == True:
+            is_popular = np.isin(neighbor_ids, self.popular_titles)
+            neighbor_ids, values = neighbor_ids[is_popular], values[is_popular]
+        
+        sim_rank = pd.Series(values[:max_num], index = neighbor_ids[:max_num], name = title_id).to_frame()
+        if in_romaji == True:
+            sim_rank.index = sim_rank.index.map(self.title_romaji_map)
+            sim_rank.columns = [self.title_romaji_map[title_id]]
+        return sim_rank
+    
+    def _get_score_mat(self):
+        """
+        Score matrix used by recommend(): dense array in dense mode, float32 CSR built from
+        the top-k index otherwise. Built once per create_sim_mat call.
+        """
+        if self._score_mat is None:
+            if self.sim_index is not None:
+                neighbors = self.sim_index['neighbors']
+                n_titles, top_k = neighbors.shape
+                data = _to_score(self.sim_index['values'], self.similarity_metric).ravel()
+                indptr = np.arange(0, n_titles * top_k + 1, top_k)
+                self._score_mat = sparse.csr_matrix((data, neighbors.ravel(), indptr), shape = (n_titles, n_titles))
+            else:
+                self._score_mat = _to_score(self.sim_mat.values, self.similarity_metric).astype(np.float32)
+        return self._score_mat
+    
+    def recommend(self, title_ids, k = 20, aggregation = 'sum', power = 1, exclude = None):
+        """
+        Recommend titles similar to a set of seed titles.
+        All seeds of all queries are scored in one pass: their similarity rows are raised to
+        the given power, aggregated per query and the top k are taken with argpartition.
+        Distances are turned into scores with 1 / (1 + distance) so that higher is always better.
+        Seed titles are never recommended. Seeds missing from the similarity matrix are ignored.
+        
+        *parameters
+        - title_ids(List): seed title_ids of one query, or a list of seed lists for a batch of queries
+        - k(Integer): number of titles to recommend per query
+        - aggregation(String): ['sum', 'mean', 'max'], how the seed rows are combined
+        - power(Float): seed similarities are raised to this power before aggregation(sign is kept)
+        - exclude(List): title_ids never to recommend. For a batch, either one list for every query
+          or one list per query
+        
+        *return
+        - rec_ids(numpy array): recommended title_ids, best first
+        - rec_scores(numpy array): aggregated score of each recommended title
+          for a batch both are (queries x k) arrays padded with -1 and nan
+        """
+        batch = _is_batch(title_ids)
+        queries = title_ids if batch else [title_ids]
+        if exclude is None:
+            exclude = [[] for _ in queries]
+        elif not _is_batch(exclude):
+            exclude = [exclude for _ in queries]
+        
+        with self.instrumentation.stage('cbf.score_mat'):
+            score_mat = self._get_score_mat()
+        def compute(queries, exclude):
+            with self.instrumentation.stage('cbf.aggregate_top_k'):
+                return aggregate_top_k(score_mat, self.title_ids, self.title_pos, queries, k, aggregation, power, exclude)
+        rec_ids, rec_scores = cached_top_k(self.cache, self, 'cbf.recommend', self.version, queries, k, exclude, compute,
+                                           aggregation = aggregation, power = power)
+        if batch:
+            return rec_ids, rec_scores
+        valid = rec_ids[0] != -1
+        return rec_ids[0][valid], rec_scores[0][valid]
+    
+    def save_bundle(self, path):
+        """
+        Write the fitted state of create_sim_mat to a single bundle file(see bundle.py) that worker processes
+        memory-map with load_bundle instead of recomputing it: the titles, the similarity matrix(dense mode)
+        or top-k index(top_k mode) and the score matrix recommend() runs on.
+        
+        *parameters
+        - path(String): bundle file to write
+        """
+        if self.sim_mat is None and self.sim_index is None:
+            raise ValueError('create_sim_mat first')
+        arrays, meta = frame_arrays('titles_200p_cleaned', self.titles_df)
+        arrays['title_ids'] = self.title_ids
+        if self.sim_index is not None:
+            arrays.update(dict_arrays('sim_index', self.sim_index))
+            score_arrays, score_meta = sparse_arrays('score_mat', self._get_score_mat())
+            arrays.update(score_arrays)
+            meta.update(score_meta)
+        else:
+            arrays['sim_mat'] = self.sim_mat.values
+            arrays['score_mat'] = self._get_score_mat()
+        meta.update({'version' : self.version, 'similarity_metric' : self.similarity_metric})
+        write_bundle(path, arrays, 'cbf', meta)
+    
+    @classmethod
+    def load_bundle(cls, path, instrumentation = None, cache = None):
+        """
+        ContentBasedFiltering over a bundle written by save_bundle, without calling create_sim_mat.
+        The matrices and the titles are read-only memory-mapped views of the file, shared by every process
+        that loads the same bundle. create_sim_mat can still be called to build a new version in memory.
+        
+        *parameters
+        - path(String): bundle file
+        - instrumentation(Instrumentation): stage timers of the methods(see instrumentation.py). Default is a disabled one
+        - cache(QueryCache): cache of the recommend results(see querycache.py). None caches nothing
+        
+        *return
+        - cbf(ContentBasedFiltering)
+        """
+        bundle = Bundle(path, expected_kind = 'cbf')
+        cbf = cls(instrumentation = instrumentation, cache = cache)
+        cbf.assets = BundleAssetStore(bundle)
+        cbf.version = bundle.meta['version']
+        cbf.similarity_metric = bundle.meta['similarity_metric']
+        cbf.title_ids = bundle.array('title_ids')
+        cbf.title_pos = {title_id : pos for pos, title_id in enumerate(cbf.title_ids)}
+        if 'sim_mat' in bundle:
+            cbf.sim_mat = pd.DataFrame(bundle.array('sim_mat'), index = cbf.title_ids, columns = cbf.title_ids, copy = False)
+            cbf._score_mat = bundle.array('score_mat')
+        else:
+            cbf.sim_index = bundle.arrays('sim_index')
+            cbf._score_mat = bundle.sparse('score_mat')
+        return cbf
@@ -1,28 +1,259 @@
 import sys
+import copy
+import time
+import threading
 import pandas as pd
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity, manhattan_distances, euclidean_distances
 from sklearn.neighbors import NearestNeighbors
+from sklearn.decomposition import TruncatedSVD
 from scipy.sparse import csr_matrix
 from scipy import sparse
 
+# shared modules of 2.RecommenderSystem, the entry point puts that folder on sys.path
+from assetstore import AssetStore, LazyAsset, DEFAULT_ASSET_ROOT, compact_frame, frame_memory
+from instrumentation import Instrumentation
+from simbuilder import build_neighbors, top_k_positions
+from querycache import canonical_key
+from bundle import Bundle, BundleAssetStore, write_bundle, frame_arrays, sparse_arrays, dict_arrays
+
+
+def isin_sorted(values, sorted_arr):
+    '''
+    np.isin for an already sorted reference array, via binary search
+    :params
+        values: array of values to check
+        sorted_arr: sorted array to look the values up in
+    :returns
+        boolean array, True where the value is in sorted_arr
+    '''
+
+    if len(sorted_arr) == 0:
+        return np.zeros(len(values), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_arr, values), len(sorted_arr)-1)
+    return sorted_arr[pos] == values
+
+
+def drop_self_neighbors(indices, distances, query_pos):
+    '''
+    removes each queried row from its own kNN result (or the farthest neighbor if it wasn't returned)
+    :params
+        indices: (queries x n+1) neighbor positions returned by kneighbors
+        distances: (queries x n+1) neighbor distances returned by kneighbors
+        query_pos: row position of each query
+    :returns
+        (queries x n) indices and distances
+    '''
+
+    is_self = indices == np.asarray(query_pos)[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    n = indices.shape[1]-1
+    return indices[~is_self].reshape(-1, n), distances[~is_self].reshape(-1, n)
+
+
+def replace_segments(indptr, values, positions, segments):
+    '''
+    CSR-style segments (row p is values[indptr[p]:indptr[p+1]]) with some rows replaced, without touching the input
+    :params
+        indptr: (rows+1) offsets
+        values: concatenated segments
+        positions: rows to replace; positions past the last row append new rows
+        segments: new segment of each position
+    :returns
+        new indptr and values
+    '''
+
+    n_rows = len(indptr)-1
+    n_new = max([n_rows] + [p+1 for p in positions])
+    lengths = np.zeros(n_new, dtype=np.int64)
+    lengths[:n_rows] = np.diff(indptr)
+    lengths[list(positions)] = [len(segment) for segment in segments]
+    new_indptr = np.concatenate([[0], np.cumsum(lengths)])
+
+    # move the kept rows to their new offsets, then write the replaced ones
+    new_values = np.empty(new_indptr[-1], dtype=values.dtype)
+    kept = np.ones(n_rows, dtype=bool)
+    kept[[p for p in positions if p < n_rows]] = False
+    rows = np.repeat(np.arange(n_rows), np.diff(indptr))
+    is_kept = kept[rows]
+    dest = new_indptr[rows] + (np.arange(len(values)) - indptr[rows])
+    new_values[dest[is_kept]] = values[is_kept]
+    for p, segment in zip(positions, segments):
+        new_values[new_indptr[p]:new_indptr[p+1]] = segment
+    return new_indptr, new_values
+
+
+def normalize_rows(mat):
+    '''
+    rows of a sparse matrix scaled to unit L2 norm (empty rows stay empty)
+    '''
+
+    norms = np.sqrt(np.asarray(mat.multiply(mat).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ mat
+
+
+FUSION_RULES = ["min", "sum", "mean", "rrf"]
+
+# columns the methods read, the only ones loaded in compact mode (None loads every column)
+COMPACT_COLUMNS = {
+    "titles_2000p": ["title_id", "favorites"],
+    "ryota_title_genre_2000p": None,
+    "media_list_all_users": ["user_id", "title_id", "repeat"],
+    "ryota_media_list_genre": None,
+    "ryota_user_genre_dist": None,
+}
+
+# table attribute: asset it is loaded from (and stored under in a bundle)
+TABLE_ASSETS = {
+    "df_titles": "titles_2000p",
+    "df_titles_genre": "ryota_title_genre_2000p",
+    "df_mlist": "media_list_all_users",
+    "df_mlist_genre": "ryota_media_list_genre",
+    "df_user_genre_dist": "ryota_user_genre_dist",
+}
+
 
 class UserBasedFiltering:
-    def __init__(self):
+    # assets are loaded lazily, the first time a method needs them (see assetstore.py)
+    df_titles = LazyAsset(lambda self: self._load_table(TABLE_ASSETS["df_titles"]))
+    df_titles_genre = LazyAsset(lambda self: self._load_table(TABLE_ASSETS["df_titles_genre"]))
+    df_mlist = LazyAsset(lambda self: self._load_table(TABLE_ASSETS["df_mlist"]))
+    df_mlist_genre = LazyAsset(lambda self: self._load_table(TABLE_ASSETS["df_mlist_genre"]))
+    df_user_genre_dist = LazyAsset(lambda self: self._load_table(TABLE_ASSETS["df_user_genre_dist"]))
+    mat_title_user = LazyAsset(lambda self: self.assets.load_sparse("ryota_title_user"))
+    titlle_idx_list = LazyAsset(lambda self: list(self.assets.load_array("ryota_title_user_idx")))
+    title_idx_arr = LazyAsset(lambda self: np.array(self.titlle_idx_list))
+    title_pos = LazyAsset(lambda self: {title_id: pos for pos, title_id in enumerate(self.titlle_idx_list)})
+    model = LazyAsset(lambda self: NearestNeighbors(metric="cosine", algorithm="brute", n_neighbors=20).fit(self.mat_title_user))
+    # title genres as a matrix, rows in title_id order, for the indexed gather of get_similar_users_from_titles
+    title_genre_ids = LazyAsset(lambda self: np.sort(self.df_titles_genre["title_id"].values))
+    title_genre_values = LazyAsset(lambda self: self.df_titles_genre.sort_values("title_id").iloc[:, 1:].values.astype(np.float32))
+
+    def __init__(self, asset_root=DEFAULT_ASSET_ROOT, columnar_root=None, instrumentation=None, cache=None, compact=False):
         '''
         Initializes UserBasedFiltering with necessary data to run it efficiently
+        Nothing is read here: each asset is loaded the first time it is used, and the time spent
+        loading it is recorded in self.assets.load_times (see report_load_times)
+        :params
+            asset_root: folder that holds the assets
+            columnar_root: folder of the columnar copies of the assets. Default is asset_root/columnar
+            instrumentation: stage timers and counters of the queries (see instrumentation.py). Default is a disabled one
+            cache: QueryCache of the similar users and item kNN queries (see querycache.py). None caches nothing
+            compact: memory-optimized tables: only the COMPACT_COLUMNS, int32 ids, float32 distributions,
+                     uint8 genre flags and categorical strings (see assetstore.compact_frame, memory_report)
+        '''
+
+        self.assets = AssetStore(asset_root, columnar_root)
+        self.compact = compact
+        self.cache = cache
+        self.instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        self.user_index = None
+        self.user_title_index = None
+        self.item_neighbors = None
+        self.title_factors = None
+        # threshold: thresholded and L2-normalized user genre distributions (see genre_matrix)
+        self.genre_matrices = {}
+        # incremented whenever query results can change (ingest_media_list, build_item_neighbor_table, build_title_factors):
+        # cached results of older versions are dropped, see snapshot and querycache.py
+        self.version = 0
+        self._ingest_lock = threading.Lock()
+
+    def _load_table(self, name):
+        if not self.compact:
+            return self.assets.load_frame(name)
+        return compact_frame(self.assets.load_frame(name, columns=COMPACT_COLUMNS[name], as_category=True))
+
+    def report_load_times(self):
+        '''
+        startup cost per asset
+        :returns
+            pandas Series of asset: seconds spent loading it
         '''
 
-        # Load various data first
-        self.df_titles = pd.read_csv("/mnt/disks/sdb/home/dy0904k/assets/titles_2000p.csv")
-        self.df_titles_genre = pd.read_csv("/mnt/disks/sdb/home/dy0904k/assets/ryota_title_genre_2000p.csv")
-        self.df_mlist = pd.read_csv("/mnt/disks/sdb/home/dy0904k/assets/media_list_all_users.csv")
-        self.df_mlist_genre = pd.read_csv("/mnt/disks/sdb/home/dy0904k/assets/ryota_media_list_genre.csv")
-        self.df_user_genre_dist = pd.read_csv("/mnt/disks/sdb/home/dy0904k/assets/ryota_user_genre_dist.csv")
-        self.mat_title_user = sparse.load_npz("/mnt/disks/sdb/home/dy0904k/assets/ryota_title_user.npz")
-        self.titlle_idx_list = list(np.load("/mnt/disks/sdb/home/dy0904k/assets/ryota_title_user_idx.npy"))
-        self.model = NearestNeighbors(metric="cosine", algorithm="brute", n_neighbors=20)
-        self.model.fit(self.mat_title_user)
+        return self.assets.report_load_times()
+
+    def rebuild_user_index(self, start_col=1):
+        '''
+        (Re)builds the user neighbor index from df_user_genre_dist.
+        Call this whenever the genre distributions change.
+        The index keeps the genre distributions as float32, their L2-normalized version and their squared norms
+        so that a query only needs its own rows against the matrix instead of the full user:user matrix
+        :params
+            start_col: index of the column to start the similarity calculation from
+        :returns
+            it doesn't return but sets self.user_index
+        '''
+
+        df = self.df_user_genre_dist
+        values = np.ascontiguousarray(df.iloc[:, start_col:].values, dtype=np.float32)
+        norms = np.linalg.norm(values, axis=1)
+        norms[norms == 0] = 1
+        user_ids = df["user_id"].values
+        self.user_index = {
+            "start_col": start_col,
+            "user_ids": user_ids,
+            "user_pos": {user_id: pos for pos, user_id in enumerate(user_ids)},
+            "values": values,
+            "normalized": values / norms[:, None],
+            "sq_norms": (values ** 2).sum(axis=1),
+        }
+
+    def _user_scores(self, query_pos, dist_metric):
+        '''
+        similarity/distance between the queried rows and every user of the index
+        :params
+            query_pos: row positions of the querying users in the index
+            dist_metric: distance metric to be used
+        :returns
+            (len(query_pos) x users) float32 array
+        '''
+
+        index = self.user_index
+        if dist_metric=="euclidean_distances":
+            q = index["values"][query_pos]
+            sq_dist = index["sq_norms"][query_pos][:, None] + index["sq_norms"][None, :] - 2 * (q @ index["values"].T)
+            return np.sqrt(np.maximum(sq_dist, 0))
+        elif dist_metric=="manhattan_distances":
+            # chunk the queries so that the (queries x users x genres) difference stays small
+            values = index["values"]
+            step = max(1, 2**24 // values.size)
+            return np.vstack([np.abs(values[query_pos[i:i+step], None, :] - values[None, :, :]).sum(axis=2) for i in range(0, len(query_pos), step)])
+        else:
+            return index["normalized"][query_pos] @ index["normalized"].T
+
+    def get_similar_users_from_user_ids(self, query_user_ids, start_col=1, dist_metric="cosine_similarity", ascending=False):
+        '''
+        batch version of get_similar_users_from_user_id: query similar users for several user_ids at once
+        :params
+            query_user_ids: list of querying user_ids
+            start_col: index of the column to start the similarity calculation from
+            dist_metric: distance metric to be used
+            ascending: whether to sort similarity scores in an ascending order
+        :returns
+            list of lists of top 10 similar user_ids, one list per querying user_id
+        '''
+
+        if self.cache is not None:
+            keys = [canonical_key(user_id, start_col=start_col, dist_metric=dist_metric, ascending=ascending) for user_id in query_user_ids]
+            return self.cache.call_batch(self, "ubf.similar_users_from_user_ids", self.version, keys,
+                                         lambda missing: self._similar_users_from_user_ids([query_user_ids[i] for i in missing], start_col, dist_metric, ascending))
+        return self._similar_users_from_user_ids(query_user_ids, start_col, dist_metric, ascending)
+
+    def _similar_users_from_user_ids(self, query_user_ids, start_col, dist_metric, ascending):
+        if self.user_index is None or self.user_index["start_col"] != start_col:
+            with self.instrumentation.stage("ubf.rebuild_user_index"):
+                self.rebuild_user_index(start_col)
+
+        query_pos = np.array([self.user_index["user_pos"][user_id] for user_id in query_user_ids])
+        with self.instrumentation.stage("ubf.user_scores"):
+            scores = self._user_scores(query_pos, dist_metric)
+        # a user is never its own neighbor: its own score is made the worst one, so that users with the
+        # same genre distribution(common for short media lists) are kept in its results
+        scores[np.arange(len(query_pos)), query_pos] = np.inf if ascending else -np.inf
+        with self.instrumentation.stage("ubf.top_k"):
+            top_pos = top_k_positions(scores, 10, largest=not ascending)
+        top_10_similar_user_ids = self.user_index["user_ids"][top_pos]
+        return [list(row) for row in top_10_similar_user_ids]
 
     def get_similar_users_from_user_id(self, start_col, dist_metric="cosine_similarity", query_user_id=1, ascending=False):
         '''
@@ -36,22 +267,74 @@ class UserBasedFiltering:
             list of top 10 similar user_ids
         '''
 
-        # Calculate user similarities
-        df = self.df_user_genre_dist
-        id_list = df["user_id"]
-        if dist_metric=="euclidean_distances":
-            df_sim_mat = pd.DataFrame(euclidean_distances(df.iloc[:, start_col:]))
-        elif dist_metric=="manhattan_distances":
-            df_sim_mat = pd.DataFrame(manhattan_distances(df.iloc[:, start_col:]))
-        else:
-            df_sim_mat = pd.DataFrame(cosine_similarity(df.iloc[:, start_col:]))
-        df_sim_mat.index = id_list
-        df_sim_mat.columns = id_list
+        return self.get_similar_users_from_user_ids([query_user_id], start_col, dist_metric, ascending)[0]
 
-        similar_users = df_sim_mat[query_user_id].sort_values(ascending=ascending).reset_index()
-        top_10_similar_user_ids = list(similar_users.iloc[1:11, 0])
-        return top_10_similar_user_ids
 
+    def genre_matrix(self, threshold=50):
+        '''
+        genre distributions of the users with more than threshold titles in their media list, L2-normalized,
+        built once per threshold and cached in self.genre_matrices (ingest_media_list starts a new cache)
+        :params
+            threshold: how many titles that a user needs to have in his/her list in order to be considered
+        :returns
+            dictionary of user_ids and normalized (users x genres float32 array, same row order)
+        '''
+
+        matrix = self.genre_matrices.get(threshold)
+        if matrix is None:
+            with self.instrumentation.stage("ubf.genre_matrix"):
+                # refer to users with more than threshold titles -> more stable genre distribution
+                ref_user_ids = self.df_mlist_genre["user_id"].values[self.df_mlist_genre["mlist_count"].values > threshold]
+                df = self.df_user_genre_dist[self.df_user_genre_dist["user_id"].isin(ref_user_ids)]
+                values = df.iloc[:, 1:].values.astype(np.float32)
+                norms = np.linalg.norm(values, axis=1)
+                norms[norms == 0] = 1
+                matrix = {"user_ids": df["user_id"].values, "normalized": values / norms[:, None]}
+            self.genre_matrices[threshold] = matrix
+        return matrix
+
+    def get_similar_users_from_titles_batch(self, baskets, threshold=50):
+        '''
+        batch version of get_similar_users_from_titles: one matrix multiply for all the title baskets
+        :params
+            baskets: list of lists of favorite title_ids, one per query
+            threshold: how many titles that a user needs to have in his/her list in order to be considered
+        :returns
+            list of arrays of top 10 similar user_ids, least similar first (as get_similar_users_from_titles)
+        '''
+
+        if self.cache is not None:
+            keys = [canonical_key(q_titles, unique=True, threshold=threshold) for q_titles in baskets]
+            return self.cache.call_batch(self, "ubf.similar_users_from_titles", self.version, keys,
+                                         lambda missing: self._similar_users_from_titles([baskets[i] for i in missing], threshold))
+        return self._similar_users_from_titles(baskets, threshold)
+
+    def _similar_users_from_titles(self, baskets, threshold):
+        matrix = self.genre_matrix(threshold)
+
+        # mean genre vector of every basket: indexed gather of the (unique, known) titles' genre rows
+        title_ids = self.title_genre_ids
+        rows, cols = [], []
+        for i, q_titles in enumerate(baskets):
+            q_titles = np.unique(np.asarray(q_titles, dtype=title_ids.dtype))
+            pos = q_titles[isin_sorted(q_titles, title_ids)]
+            if len(pos) == 0:
+                raise ValueError(f"none of the titles {list(q_titles)} has genres")
+            cols.append(np.searchsorted(title_ids, pos))
+            rows.append(np.full(len(pos), i))
+        cols = np.concatenate(cols)
+        basket_mat = csr_matrix((np.ones(len(cols), dtype=np.float32), (np.concatenate(rows), cols)), shape=(len(baskets), len(title_ids)))
+        query = basket_mat @ self.title_genre_values
+        norms = np.linalg.norm(query, axis=1)
+        norms[norms == 0] = 1
+        query /= norms[:, None]
+
+        with self.instrumentation.stage("ubf.user_scores"):
+            scores = query @ matrix["normalized"].T
+        with self.instrumentation.stage("ubf.top_k"):
+            # best first from top_k_positions, reversed to keep the original ascending order
+            top_pos = top_k_positions(scores, 10)[:, ::-1]
+        return list(matrix["user_ids"][top_pos])
 
     def get_similar_users_from_titles(self, q_titles, threshold=50):
         '''
@@ -63,27 +346,44 @@ class UserBasedFiltering:
             list of top 10 similar user_ids
         '''
 
-        # refer to users with more than 50 titles -> more stable genre distribution
-        df_user_mlist_count = self.df_mlist_genre[["user_id", "mlist_count"]]
-        df_user_mlist_count = df_user_mlist_count[df_user_mlist_count["mlist_count"]>threshold]
-        ref_user_ids = df_user_mlist_count["user_id"].values
+        return self.get_similar_users_from_titles_batch([q_titles], threshold)[0]
+
 
-        # limit df_user_genre_dist to users with more than threshold n titles in their media list
-        df_user_genre_dist_thresh = self.df_user_genre_dist[self.df_user_genre_dist["user_id"].isin(ref_user_ids)]
+    def rebuild_user_title_index(self):
+        '''
+        (Re)builds the user:titles index from df_mlist.
+        Media lists are grouped by user once and stored CSR-style: the title_ids of the user at row position p are
+        title_ids[indptr[p]:indptr[p+1]], sorted (duplicated entries of the media list are kept)
+        :returns
+            it doesn't return but sets self.user_title_index
+        '''
 
-        # create genre map from title_id list
-        df_titles_genre_ex = self.df_titles_genre[self.df_titles_genre["title_id"].isin(q_titles)]
-        df_titles_genre_ex = df_titles_genre_ex.sum(axis=0) / len(df_titles_genre_ex)
+        user_ids = self.df_mlist["user_id"].values
+        title_ids = self.df_mlist["title_id"].values.astype(np.int32)
+        order = np.lexsort((title_ids, user_ids))
+        unique_user_ids, starts = np.unique(user_ids[order], return_index=True)
+        self.user_title_index = {
+            "user_pos": {user_id: pos for pos, user_id in enumerate(unique_user_ids)},
+            "indptr": np.append(starts, len(order)),
+            "title_ids": title_ids[order],
+        }
 
-        # get the genre distribution values and work out cosine similarity
-        ex_genre_dist = df_titles_genre_ex.iloc[1:].values.reshape(1,-1)
-        user_genre_dist = df_user_genre_dist_thresh.iloc[:,1:].values
-        res = cosine_similarity(user_genre_dist, ex_genre_dist)
-        res = res.reshape(-1)
-        high_sim_idx = np.argsort(res)[-10:]
-        top_10_similar_user_ids = ref_user_ids[high_sim_idx]
-        return top_10_similar_user_ids
+    def get_user_titles(self, user_id):
+        '''
+        media list of a user from the user:titles index
+        :params
+            user_id: user_id to look up
+        :returns
+            sorted array of title_ids (empty if the user has no media list)
+        '''
 
+        if self.user_title_index is None:
+            self.rebuild_user_title_index()
+        index = self.user_title_index
+        pos = index["user_pos"].get(user_id)
+        if pos is None:
+            return index["title_ids"][:0]
+        return index["title_ids"][index["indptr"][pos]:index["indptr"][pos+1]]
 
     def evaluate_by_overlap_titles(self, similar_user_ids, query_user_id=1):
         '''
@@ -96,17 +396,18 @@ class UserBasedFiltering:
             avgerage of overlap ratio
         '''
 
-        df = self.df_mlist
-        overlap_ratios = []
-        df_q = df[df["user_id"]==query_user_id]
-        q_u_titles = list(df_q["title_id"])
+        q_u_titles = self.get_user_titles(query_user_id)
+        sim_u_titles = [self.get_user_titles(user_id) for user_id in similar_user_ids]
+        lengths = np.array([len(titles) for titles in sim_u_titles])
+        titles = np.concatenate(sim_u_titles)
+        segment = np.repeat(np.arange(len(sim_u_titles)), lengths)
 
-        for user_id in similar_user_ids:
-            df_sim = df[df["user_id"]==user_id]
-            sim_u_titles = list(df_sim["title_id"])
-            overlap = list(set(sim_u_titles) & set(q_u_titles))
-            overlap_ratios.append(len(overlap) / len(sim_u_titles))
-        avg_overlap_ratio = sum(overlap_ratios) / len(overlap_ratios)
+        # each media list is sorted, so a title is counted once where it differs from the previous entry of the same user
+        is_first = np.ones(len(titles), dtype=bool)
+        is_first[1:] = (titles[1:] != titles[:-1]) | (segment[1:] != segment[:-1])
+        overlap = np.bincount(segment, weights=is_first & isin_sorted(titles, q_u_titles), minlength=len(sim_u_titles))
+        overlap_ratios = overlap / lengths
+        avg_overlap_ratio = overlap_ratios.mean()
         return avg_overlap_ratio
 
 
@@ -115,51 +416,616 @@ class UserBasedFiltering:
         It retrieves the media list of similar users and then recommend based on specified logic
 
         :params
-            df_titles: titles df
-            df_mlist: media list df
             n_titles: how many titles to recommend
-            query_user: querying user_id
             similar_user_list: list of similar user_ids
+            query_user_id: querying user_id
             method: which method to make recommendation
         :returns
             list of title_id as recommendation
         '''
 
         # get title_ids that the querying user hasn't read but similar users have
-        df_mlist_similar_user = self.df_mlist[self.df_mlist["user_id"].isin(similar_user_list)]
-        df_mlist_q_user = self.df_mlist[self.df_mlist["user_id"]==query_user_id]
-        q_users_titles = list(df_mlist_q_user["title_id"])
-        df_mlist_similar_user_not_read = df_mlist_similar_user[~df_mlist_similar_user["title_id"].isin(q_users_titles)]
+        with self.instrumentation.stage("ubf.gather_titles"):
+            q_users_titles = self.get_user_titles(query_user_id)
+            similar_users_titles = np.concatenate([q_users_titles[:0]] + [self.get_user_titles(user_id) for user_id in np.unique(similar_user_list)])
+            not_read = similar_users_titles[~isin_sorted(similar_users_titles, q_users_titles)]
 
         if method=="refer_popularity":
             # refer_popularity method: get "favorites" count of the unread titles and return top n titles
-            unread_list = list(df_mlist_similar_user_not_read["title_id"].unique())
-            df_recommend_list = self.df_titles[self.df_titles["title_id"].isin(unread_list)]
-            df_recommend_list = df_recommend_list[["title_id", "favorites"]].sort_values(by="favorites", ascending=False).iloc[:n_titles]
+            unread_list = np.unique(not_read)
+            with self.instrumentation.stage("ubf.metadata_lookup"):
+                df_recommend_list = self.df_titles[self.df_titles["title_id"].isin(unread_list)]
+                df_recommend_list = df_recommend_list[["title_id", "favorites"]].sort_values(by="favorites", ascending=False).iloc[:n_titles]
             recommend_list = list(df_recommend_list["title_id"])
         else:
             # refer_others method: get count of titles and return top n titles
-            df_recommend_list = df_mlist_similar_user_not_read.groupby("title_id").size().sort_values(ascending=False).iloc[:n_titles]
-            recommend_list = list(df_recommend_list.index)
+            with self.instrumentation.stage("ubf.count_titles"):
+                unread_list, counts = np.unique(not_read, return_counts=True)
+                order = np.argsort(-counts, kind="stable")[:n_titles]
+            recommend_list = unread_list[order].tolist()
         return recommend_list
 
 
+    def build_item_neighbor_table(self, n_neighbors=100, batch_size=1000, n_workers=1):
+        '''
+        Precomputes the top n_neighbors similar titles of every title in the title:user matrix (offline step)
+        :params
+            n_neighbors: how many neighbors to keep per title
+            batch_size: how many titles to query NearestNeighbors with at once (titles per tile with n_workers != 1)
+            n_workers: worker processes of the tiled build (see simbuilder.py), None uses every core, 1 queries NearestNeighbors here
+        :returns
+            it doesn't return but sets self.item_neighbors
+            - "neighbors": (titles x n_neighbors) int32 row positions, nearest first
+            - "distances": (titles x n_neighbors) float32 cosine distances
+        '''
+
+        if n_workers != 1:
+            index = build_neighbors(self.mat_title_user, "cosine", n_neighbors, n_workers=n_workers, tile_size=batch_size)
+            self.item_neighbors = {"neighbors": index["neighbors"], "distances": 1 - index["values"]}
+            self.version += 1
+            return
+
+        n_titles = self.mat_title_user.shape[0]
+        n_neighbors = min(n_neighbors, n_titles-1)
+        neighbors = np.empty((n_titles, n_neighbors), dtype=np.int32)
+        distances = np.empty((n_titles, n_neighbors), dtype=np.float32)
+        for start in range(0, n_titles, batch_size):
+            stop = min(start+batch_size, n_titles)
+            dist, idx = self.model.kneighbors(self.mat_title_user[start:stop], n_neighbors=n_neighbors+1)
+            neighbors[start:stop], distances[start:stop] = drop_self_neighbors(idx, dist, np.arange(start, stop))
+        self.item_neighbors = {"neighbors": neighbors, "distances": distances}
+        self.version += 1
+
+    def get_item_neighbors_batch(self, q_title_idxs, output_neighbors=10):
+        '''
+        nearest titles of several titles in the title:user matrix, in one search.
+        Served from the precomputed table when it holds enough neighbors, from the title factors when they are built
+        (approximate, see build_title_factors), one brute force NearestNeighbors call otherwise
+        :params
+            q_title_idxs: row positions of the querying titles in the title:user matrix
+            output_neighbors: how many neighbors to return per title (at most the number of other titles)
+        :returns
+            (titles x output_neighbors) row positions and cosine distances of the neighbors, nearest first
+        '''
+
+        q_title_idxs = np.asarray(q_title_idxs, dtype=int)
+        output_neighbors = min(output_neighbors, self.mat_title_user.shape[0]-1)
+        if self.item_neighbors is not None and output_neighbors <= self.item_neighbors["neighbors"].shape[1]:
+            self.instrumentation.count("ubf.neighbor_table_queries", len(q_title_idxs))
+            return self.item_neighbors["neighbors"][q_title_idxs, :output_neighbors], self.item_neighbors["distances"][q_title_idxs, :output_neighbors]
+        if self.title_factors is not None:
+            self.instrumentation.count("ubf.factor_queries", len(q_title_idxs))
+            with self.instrumentation.stage("ubf.factor_neighbors"):
+                return self._factor_neighbors(q_title_idxs, output_neighbors)
+
+        # output_neighbors+1 because it always puts the queried title as result
+        self.instrumentation.count("ubf.brute_force_queries", len(q_title_idxs))
+        with self.instrumentation.stage("ubf.kneighbors"):
+            distances, indices = self.model.kneighbors(self.mat_title_user[q_title_idxs], n_neighbors=output_neighbors+1)
+        return drop_self_neighbors(indices, distances, q_title_idxs)
+
+    def build_title_factors(self, rank=64, n_iter=5, random_state=0, k=10, n_eval=500):
+        '''
+        Factorizes the title:user matrix with a truncated SVD into (titles x rank) float32 title factors (offline step).
+        Item neighbors are then searched in the factors, whose size depends on the catalog only, instead of in the
+        user columns of the title:user matrix. The agreement with the exact neighbors is measured right away
+        :params
+            rank: number of factors per title
+            n_iter: iterations of the randomized SVD solver
+            random_state: seed of the solver and of the titles the agreement is measured on
+            k: neighbors compared per title in the agreement report
+            n_eval: titles the agreement is measured on
+        :returns
+            agreement report (see factor_agreement), also kept in self.title_factors["agreement"]
+        '''
+
+        mat = self.mat_title_user
+        rank = max(1, min(rank, mat.shape[0]-1, mat.shape[1]-1))
+        svd = TruncatedSVD(rank, n_iter=n_iter, random_state=random_state)
+        factors = svd.fit_transform(mat).astype(np.float32)
+        norms = np.linalg.norm(factors, axis=1)
+        norms[norms == 0] = 1
+        self.title_factors = {
+            "rank": rank,
+            "components": svd.components_.astype(np.float32),
+            "normalized": factors / norms[:, None],
+            "explained_variance": float(svd.explained_variance_ratio_.sum()),
+        }
+        self.title_factors["agreement"] = self.factor_agreement(k, n_eval, random_state)
+        self.version += 1
+        return self.title_factors["agreement"]
+
+    def _factor_neighbors(self, q_title_idxs, output_neighbors):
+        '''
+        nearest titles in the title factors: (titles x output_neighbors) row positions and cosine distances, nearest first
+        '''
+
+        normalized = self.title_factors["normalized"]
+        sims = normalized[q_title_idxs] @ normalized.T
+        sims[np.arange(len(q_title_idxs)), q_title_idxs] = -np.inf
+        indices = top_k_positions(sims, output_neighbors)
+        return indices, (1 - np.take_along_axis(sims, indices, axis=1)).astype(np.float32)
+
+    def factor_agreement(self, k=10, n_eval=500, random_state=0):
+        '''
+        how well the neighbors found in the title factors agree with the exact NearestNeighbors ones
+        :params
+            k: neighbors compared per title
+            n_eval: titles sampled for the comparison
+            random_state: seed of the sample
+        :returns
+            dictionary of rank, explained_variance, recall_at_k(share of the exact k neighbors found),
+            distance_ratio(mean exact distance of the factor neighbors / of the exact neighbors),
+            exact_ms/factor_ms(search time per title) and speedup
+        '''
+
+        n_titles = self.mat_title_user.shape[0]
+        sample = np.random.RandomState(random_state).choice(n_titles, min(n_eval, n_titles), replace=False)
+        k = min(k, n_titles-1)
+
+        start = time.perf_counter()
+        distances, indices = self.model.kneighbors(self.mat_title_user[sample], n_neighbors=k+1)
+        exact, exact_dist = drop_self_neighbors(indices, distances, sample)
+        exact_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        approx, _ = self._factor_neighbors(sample, k)
+        factor_seconds = time.perf_counter() - start
+
+        recall = np.mean([len(np.intersect1d(e, a)) / k for e, a in zip(exact, approx)])
+        # exact cosine distances of the neighbors the factors picked
+        # (each query row repeated k times stays sparse)
+        q = sparse.csr_matrix(normalize_rows(self.mat_title_user[sample]))
+        candidates = normalize_rows(self.mat_title_user[approx.ravel()])
+        approx_dist = 1 - np.asarray(q[np.repeat(np.arange(len(sample)), k)].multiply(candidates).sum(axis=1)).ravel()
+        return {"rank": self.title_factors["rank"], "explained_variance": self.title_factors["explained_variance"],
+                "recall_at_k": float(recall), "k": k, "n_eval": len(sample),
+                "distance_ratio": float(approx_dist.mean() / max(exact_dist.mean(), 1e-12)),
+                "exact_ms": exact_seconds * 1000 / len(sample), "factor_ms": factor_seconds * 1000 / len(sample),
+                "speedup": exact_seconds / max(factor_seconds, 1e-12)}
+
+    def get_item_neighbors(self, q_title_idx, output_neighbors=10):
+        '''
+        nearest titles of a title in the title:user matrix (see get_item_neighbors_batch)
+        :params
+            q_title_idx: row position of the querying title in the title:user matrix
+            output_neighbors: how many neighbors to return
+        :returns
+            row positions and cosine distances of the neighbors, nearest first
+        '''
+
+        indices, distances = self.get_item_neighbors_batch([q_title_idx], output_neighbors)
+        return indices[0], distances[0]
+
     def recommend_from_other_user_histories(self, q_title_id, output_neighbors=10):
         '''
         Query by the given title_id. Refers to the title:user matrix
         :params
-            q_title_id: querying user_id
-            output_neighbors: n_neighbors parameter to set with NearestNeighbors
+            q_title_id: querying title_id
+            output_neighbors: how many similar titles to return
+        :returns
+            dataframe of title_id recommendations and their cosine distances, nearest first
+        '''
+
+        indices, distances = self.get_item_neighbors(self.title_pos[q_title_id], output_neighbors)
+        recommended_title_ids = self.title_idx_arr[indices]
+        return pd.DataFrame({"title_id": recommended_title_ids, "distances": distances})
+
+    def recommend_from_titles(self, q_title_ids, n_titles=50, output_neighbors=51, fusion="min", rrf_k=60):
+        '''
+        Query by a list of title_ids. Refers to the title:user matrix
+        The neighbors of all the querying titles are searched at once and their scores are fused per candidate title
+        :params
+            q_title_ids: list of querying title_ids (unknown ones are ignored)
+            n_titles: how many titles to recommend
+            output_neighbors: how many neighbors to retrieve per querying title
+            fusion: how to merge the candidates of several querying titles, one of
+                "min": each candidate keeps its smallest cosine distance to any querying title, i.e. its highest
+                       similarity (1 - distance), taken with np.maximum.at. The app used to keep the distance of the
+                       querying title it was first found through instead, so candidates shared by several querying
+                       titles can rank differently than they did there
+                "sum": sum of the similarities to the querying titles
+                "mean": sum divided by the number of querying titles
+                "rrf": reciprocal rank fusion, sum of 1 / (rrf_k + rank)
+            rrf_k: rank offset of the "rrf" fusion
+        :returns
+            array of recommended title_ids and array of their fused scores (higher is better), best first.
+            querying titles are never recommended
+        '''
+
+        return self.recommend_from_titles_batch([q_title_ids], n_titles, output_neighbors, fusion, rrf_k)[0]
+
+    def recommend_from_titles_batch(self, queries, n_titles=50, output_neighbors=51, fusion="min", rrf_k=60):
+        '''
+        batch version of recommend_from_titles: the neighbors of the distinct querying titles of every query
+        are searched at once, then fused per query
+        :params
+            queries: list of lists of querying title_ids
+            (other params: see recommend_from_titles)
+        :returns
+            list of (recommended title_ids, fused scores) tuples, one per query
+        '''
+
+        if fusion not in FUSION_RULES:
+            raise ValueError("fusion not in {'min', 'sum', 'mean', 'rrf'}")
+        if self.cache is not None:
+            keys = [canonical_key(q, n_titles=n_titles, output_neighbors=output_neighbors, fusion=fusion, rrf_k=rrf_k) for q in queries]
+            return self.cache.call_batch(self, "ubf.recommend_from_titles", self.version, keys,
+                                         lambda missing: self._recommend_from_titles([queries[i] for i in missing], n_titles, output_neighbors, fusion, rrf_k))
+        return self._recommend_from_titles(queries, n_titles, output_neighbors, fusion, rrf_k)
+
+    def _recommend_from_titles(self, queries, n_titles, output_neighbors, fusion, rrf_k):
+        q_title_idxs = [np.array([self.title_pos[t] for t in q if t in self.title_pos], dtype=int) for q in queries]
+        unique_idxs, inverse = np.unique(np.concatenate([np.array([], dtype=int)] + q_title_idxs), return_inverse=True)
+        if len(unique_idxs):
+            with self.instrumentation.stage("ubf.neighbors"):
+                indices, distances = self.get_item_neighbors_batch(unique_idxs, output_neighbors)
+
+        results = []
+        offset = 0
+        for idxs in q_title_idxs:
+            if len(idxs) == 0:
+                results.append((self.title_idx_arr[:0], np.array([], dtype=np.float32)))
+                continue
+            rows = inverse[offset:offset+len(idxs)]
+            offset += len(idxs)
+            results.append(self._fuse_neighbors(idxs, indices[rows], distances[rows], n_titles, fusion, rrf_k))
+        return results
+
+    def _fuse_neighbors(self, q_title_idxs, indices, distances, n_titles, fusion, rrf_k):
+        '''
+        fuses the neighbor rows of the querying titles of one query (see recommend_from_titles):
+        "min" keeps the best similarity of each candidate with np.maximum.at, the others add up the contributions with bincount
+        :returns
+            array of recommended title_ids and array of their fused scores, best first
+        '''
+
+        with self.instrumentation.stage("ubf.fusion"):
+            candidates, inverse = np.unique(indices, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            if fusion == "rrf":
+                ranks = np.broadcast_to(np.arange(1, indices.shape[1]+1), indices.shape).reshape(-1)
+                contributions = 1 / (rrf_k + ranks)
+            else:
+                contributions = 1 - distances.reshape(-1)
+
+            if fusion == "min":
+                scores = np.full(len(candidates), -np.inf)
+                np.maximum.at(scores, inverse, contributions)
+            else:
+                scores = np.bincount(inverse, weights=contributions, minlength=len(candidates))
+                if fusion == "mean":
+                    scores /= len(q_title_idxs)
+
+        # exclude the querying titles and take the top n_titles
+        with self.instrumentation.stage("ubf.top_k"):
+            keep = ~np.isin(candidates, q_title_idxs)
+            candidates, scores = candidates[keep], scores[keep]
+            top = top_k_positions(scores, n_titles)
+        return self.title_idx_arr[candidates[top]], scores[top]
+
+    def snapshot(self):
+        '''
+        frozen view of the current version: ingest_media_list never modifies the arrays/frames of a version in place
+        but swaps in new ones, so a reader holding a snapshot keeps a consistent state while updates are applied
+        :returns
+            shallow copy of this UserBasedFiltering
+        '''
+
+        return copy.copy(self)
+
+    def save_bundle(self, path):
+        '''
+        Writes the fitted state of the current version to a single bundle file (see bundle.py) that any number of
+        worker processes can memory-map read-only with load_bundle instead of rebuilding it:
+        the tables, the title:user matrix, the user and user:titles indexes (built here if they aren't yet),
+        and the item neighbor table, title factors and genre matrices if they are built.
+        The NearestNeighbors model isn't stored: it is a brute force search over the title:user matrix, refit on the mapped one
+        :params
+            path: bundle file to write
         :returns
-            list of title_id recommendations
+            it doesn't return but writes the file
+        '''
+
+        with self._ingest_lock:
+            for asset in [*TABLE_ASSETS, "mat_title_user", "title_idx_arr", "title_genre_ids", "title_genre_values"]:
+                getattr(self, asset)
+            if self.user_index is None:
+                self.rebuild_user_index()
+            if self.user_title_index is None:
+                self.rebuild_user_title_index()
+            state = self.snapshot()
+
+        arrays, meta = {}, {"version": state.version, "compact": state.compact, "start_col": state.user_index["start_col"]}
+        for table, name in TABLE_ASSETS.items():
+            table_arrays, table_meta = frame_arrays(name, getattr(state, table))
+            arrays.update(table_arrays)
+            meta.update(table_meta)
+        matrix_arrays, matrix_meta = sparse_arrays("ryota_title_user", state.mat_title_user)
+        arrays.update(matrix_arrays)
+        meta.update(matrix_meta)
+        arrays["ryota_title_user_idx"] = state.title_idx_arr
+        arrays["title_genre_ids"] = state.title_genre_ids
+        arrays["title_genre_values"] = state.title_genre_values
+        arrays.update(dict_arrays("user_index", state.user_index))
+        arrays.update(dict_arrays("user_title_index", state.user_title_index))
+        # user_id of each user:titles row, the row positions are rebuilt from it on load
+        arrays["user_title_index.user_ids"] = np.array(list(state.user_title_index["user_pos"]))
+        if "user_col" in state.__dict__:
+            # ingest_media_list appends the columns of new users, their order can't be derived from the tables
+            arrays["user_col"] = np.array(list(state.user_col))
+        if state.item_neighbors is not None:
+            arrays.update(dict_arrays("item_neighbors", state.item_neighbors))
+        if state.title_factors is not None:
+            arrays.update(dict_arrays("title_factors", state.title_factors))
+            meta["title_factors"] = {key: value for key, value in state.title_factors.items() if not isinstance(value, np.ndarray)}
+        meta["genre_thresholds"] = list(state.genre_matrices)
+        for threshold, matrix in state.genre_matrices.items():
+            arrays.update(dict_arrays(f"genre_matrix_{threshold}", matrix))
+        write_bundle(path, arrays, "ubf", meta)
+
+    @classmethod
+    def load_bundle(cls, path, instrumentation=None, cache=None):
+        '''
+        UserBasedFiltering over a bundle written by save_bundle. Its arrays, matrices and tables are memory-mapped
+        read-only views of the file: processes loading the same bundle share its pages, and only the lookup
+        dictionaries(title/user positions) are built per process. ingest_media_list works as usual, the updated
+        version lives in the memory of this process
+        :params
+            path: bundle file
+            instrumentation: stage timers and counters of the queries (see instrumentation.py). Default is a disabled one
+            cache: QueryCache of the similar users and item kNN queries (see querycache.py). None caches nothing
+        :returns
+            UserBasedFiltering
+        '''
+
+        bundle = Bundle(path, expected_kind="ubf")
+        meta = bundle.meta
+        ubf = cls(instrumentation=instrumentation, cache=cache, compact=meta["compact"])
+        ubf.assets = BundleAssetStore(bundle)
+        ubf.version = meta["version"]
+        ubf.title_genre_ids = bundle.array("title_genre_ids")
+        ubf.title_genre_values = bundle.array("title_genre_values")
+
+        user_index = bundle.arrays("user_index")
+        user_index["start_col"] = meta["start_col"]
+        user_index["user_pos"] = {user_id: pos for pos, user_id in enumerate(user_index["user_ids"])}
+        ubf.user_index = user_index
+        user_title_index = bundle.arrays("user_title_index")
+        user_title_index["user_pos"] = {user_id: pos for pos, user_id in enumerate(user_title_index.pop("user_ids"))}
+        ubf.user_title_index = user_title_index
+        if "user_col" in bundle:
+            ubf.user_col = {user_id: col for col, user_id in enumerate(bundle.array("user_col"))}
+        if "item_neighbors.neighbors" in bundle:
+            ubf.item_neighbors = bundle.arrays("item_neighbors")
+        if "title_factors" in meta:
+            ubf.title_factors = {**meta["title_factors"], **bundle.arrays("title_factors")}
+        for threshold in meta["genre_thresholds"]:
+            ubf.genre_matrices[threshold] = bundle.arrays(f"genre_matrix_{threshold}")
+        return ubf
+
+    def _title_user_columns(self):
+        '''
+        column position of every user in the title:user matrix. The matrix is a pivot of the media lists of the
+        titles it holds, so its columns are the sorted user_ids of those rows (checked against the matrix width)
+        '''
+
+        if "user_col" not in self.__dict__:
+            in_matrix = np.isin(self.df_mlist["title_id"].values, self.title_idx_arr)
+            user_ids = np.unique(self.df_mlist["user_id"].values[in_matrix])
+            if len(user_ids) != self.mat_title_user.shape[1]:
+                raise ValueError(f"{len(user_ids)} users in the media lists but {self.mat_title_user.shape[1]} columns in the title:user matrix")
+            self.user_col = {user_id: col for col, user_id in enumerate(user_ids)}
+        return self.user_col
+
+    def ingest_media_list(self, df_delta, refresh_item_neighbors=True):
+        '''
+        Appends new media list entries (of new or existing users) and updates everything derived from them,
+        instead of regenerating the assets offline:
+        - df_mlist, and the user:titles index for the affected users
+        - ryota_media_list_genre (genre counts, mlist_count) and ryota_user_genre_dist of the affected users
+        - the rows of the affected users in the user neighbor index
+        - the title:user matrix (sum of repeat+1) and the NearestNeighbors model over it
+        - the item neighbor table rows of the affected titles and of the titles that list them as neighbors
+        - the title factors of the affected titles (folded into the existing factorization, new users are left out)
+        Everything is built next to the current version and swapped in at once at the end, so readers see either
+        the old or the new version (use snapshot() to keep one version across several calls).
+        Titles missing from the genre table have no genres and are not counted in mlist_count;
+        titles missing from the title:user matrix only go to the media lists.
+        :params
+            df_delta: new media_list_all_users rows, at least user_id and title_id (status, repeat and list_id are optional)
+            refresh_item_neighbors: whether to update the item neighbor table (if built) now
+        :returns
+            dictionary of version, new_users, affected_users and affected_titles
+        '''
+
+        with self._ingest_lock, self.instrumentation.stage("ubf.ingest"):
+            delta = df_delta.copy()
+            if "repeat" not in delta:
+                delta["repeat"] = 0
+            if "status" not in delta:
+                delta["status"] = np.nan
+            if "list_id" not in delta and "list_id" in self.df_mlist:
+                delta["list_id"] = self.df_mlist["list_id"].max() + 1 + np.arange(len(delta))
+            delta = delta[self.df_mlist.columns]
+            state = {"df_mlist": pd.concat([self.df_mlist, delta], ignore_index=True), "version": self.version + 1, "genre_matrices": {}}
+
+            affected_users = pd.unique(delta["user_id"].values)
+            new_users = np.setdiff1d(affected_users, self.df_mlist["user_id"].values)
+            state.update(self._ingest_genres(delta, affected_users))
+            if self.user_index is not None:
+                state["user_index"] = self._ingest_user_index(state["df_user_genre_dist"], affected_users)
+            if self.user_title_index is not None:
+                state["user_title_index"] = self._ingest_user_titles(delta, affected_users)
+
+            # title:user matrix, its model and the item neighbor table
+            user_col = dict(self._title_user_columns())
+            in_matrix = delta[delta["title_id"].isin(self.title_pos)]
+            for user_id in pd.unique(in_matrix["user_id"].values):
+                if user_id not in user_col:
+                    user_col[user_id] = len(user_col)
+            rows = np.array([self.title_pos[t] for t in in_matrix["title_id"].values], dtype=int)
+            cols = np.array([user_col[u] for u in in_matrix["user_id"].values], dtype=int)
+            shape = (self.mat_title_user.shape[0], len(user_col))
+            mat = self.mat_title_user
+            mat = sparse.csr_matrix((mat.data, mat.indices, mat.indptr), shape=shape)
+            mat = (mat + sparse.csr_matrix((in_matrix["repeat"].values + 1.0, (rows, cols)), shape=shape)).tocsr()
+            affected_titles = np.unique(rows)
+            state.update({"user_col": user_col, "mat_title_user": mat})
+            if "model" in self.__dict__:
+                state["model"] = NearestNeighbors(metric="cosine", algorithm="brute", n_neighbors=20).fit(mat)
+            if self.title_factors is not None:
+                state["title_factors"] = self._ingest_title_factors(mat, affected_titles)
+            if self.item_neighbors is not None and refresh_item_neighbors and len(affected_titles):
+                state["item_neighbors"] = self._ingest_item_neighbors(mat, state.get("model"), affected_titles)
+
+            if self.compact:
+                for name in ["df_mlist", "df_mlist_genre", "df_user_genre_dist"]:
+                    state[name] = compact_frame(state[name])
+
+            # swap the new version in
+            self.__dict__.update(state)
+            return {"version": self.version, "new_users": new_users.tolist(),
+                    "affected_users": affected_users.tolist(), "affected_titles": self.title_idx_arr[affected_titles].tolist()}
+
+    def _ingest_genres(self, delta, affected_users):
+        '''
+        new ryota_media_list_genre / ryota_user_genre_dist frames with the genre counts of delta added
+        (copies: the current frames are left untouched)
         '''
 
-        q_title_idx = self.titlle_idx_list.index(q_title_id)
-        distances, indices = self.model.kneighbors(self.mat_title_user[q_title_idx], n_neighbors=output_neighbors+1) # output_neighbors+1 because it always puts q_title_id as result
-        indices = indices[indices != q_title_idx] # remove queried title_id from result
+        genres = list(self.df_mlist_genre.columns[2:])
+        title_genres = self.df_titles_genre.set_index("title_id")[genres]
+        delta = delta[delta["title_id"].isin(title_genres.index)]
+        counts = title_genres.loc[delta["title_id"].values].groupby(delta["user_id"].values).sum()
+        counts["mlist_count"] = delta.groupby("user_id").size()
+        counts = counts.reindex(affected_users, fill_value=0)
+
+        df_mlist_genre = self.df_mlist_genre.set_index("user_id")
+        new_users = [u for u in affected_users if u not in df_mlist_genre.index]
+        df_mlist_genre = pd.concat([df_mlist_genre, pd.DataFrame(0, index=new_users, columns=df_mlist_genre.columns)])
+        df_mlist_genre.loc[affected_users, ["mlist_count"] + genres] += counts[["mlist_count"] + genres].values
+
+        df_user_genre_dist = self.df_user_genre_dist.set_index("user_id").copy()
+        dist_genres = list(df_user_genre_dist.columns)
+        df_user_genre_dist = pd.concat([df_user_genre_dist, pd.DataFrame(0.0, index=new_users, columns=dist_genres)])
+        affected = df_mlist_genre.loc[affected_users]
+        df_user_genre_dist.loc[affected_users, dist_genres] = (affected[dist_genres].values / np.maximum(affected[["mlist_count"]].values, 1))
+
+        return {"df_mlist_genre": df_mlist_genre.rename_axis("user_id").reset_index(),
+                "df_user_genre_dist": df_user_genre_dist.rename_axis("user_id").reset_index()}
+
+    def _ingest_user_index(self, df_user_genre_dist, affected_users):
+        '''
+        new user neighbor index with only the rows of the affected users recomputed (new users appended)
+        '''
+
+        index = self.user_index
+        start_col = index["start_col"]
+        user_pos = dict(index["user_pos"])
+        for user_id in affected_users:
+            if user_id not in user_pos:
+                user_pos[user_id] = len(user_pos)
+        n_new = len(user_pos) - len(index["user_ids"])
+        dim = index["values"].shape[1]
+
+        positions = np.array([user_pos[u] for u in affected_users], dtype=int)
+        rows = df_user_genre_dist.set_index("user_id").loc[affected_users].values[:, start_col-1:].astype(np.float32)
+        values = np.vstack([index["values"], np.zeros((n_new, dim), dtype=np.float32)])
+        values[positions] = rows
+        norms = np.linalg.norm(rows, axis=1)
+        norms[norms == 0] = 1
+        normalized = np.vstack([index["normalized"], np.zeros((n_new, dim), dtype=np.float32)])
+        normalized[positions] = rows / norms[:, None]
+        sq_norms = np.concatenate([index["sq_norms"], np.zeros(n_new, dtype=index["sq_norms"].dtype)])
+        sq_norms[positions] = (rows ** 2).sum(axis=1)
+        user_ids = np.concatenate([index["user_ids"], np.array([u for u in affected_users if u not in index["user_pos"]], dtype=index["user_ids"].dtype)])
+        return {"start_col": start_col, "user_ids": user_ids, "user_pos": user_pos,
+                "values": values, "normalized": normalized, "sq_norms": sq_norms}
+
+    def _ingest_user_titles(self, delta, affected_users):
+        '''
+        new user:titles index with the sorted media lists of the affected users replaced (new users appended)
+        '''
+
+        index = self.user_title_index
+        user_pos = dict(index["user_pos"])
+        for user_id in affected_users:
+            if user_id not in user_pos:
+                user_pos[user_id] = len(user_pos)
+        added = delta.groupby("user_id")["title_id"].apply(lambda x: x.values.astype(np.int32))
+        positions = [user_pos[u] for u in affected_users]
+        segments = [np.sort(np.concatenate([self.get_user_titles(u), added[u]])) for u in affected_users]
+        indptr, title_ids = replace_segments(index["indptr"], index["title_ids"], positions, segments)
+        return {"user_pos": user_pos, "indptr": indptr, "title_ids": title_ids}
+
+    def _ingest_title_factors(self, mat, affected_titles):
+        '''
+        new title factors with the rows of the affected titles folded in: projected on the SVD components,
+        which only know the users of the factorized matrix (call build_title_factors again to include new users)
+        '''
+
+        title_factors = dict(self.title_factors)
+        components = title_factors["components"]
+        factors = np.asarray(mat[affected_titles][:, :components.shape[1]] @ components.T, dtype=np.float32)
+        norms = np.linalg.norm(factors, axis=1)
+        norms[norms == 0] = 1
+        title_factors["normalized"] = title_factors["normalized"].copy()
+        title_factors["normalized"][affected_titles] = factors / norms[:, None]
+        return title_factors
+
+    def _ingest_item_neighbors(self, mat, model, affected_titles):
+        '''
+        new item neighbor table with the rows that can change searched again in the updated matrix:
+        the affected titles, the titles that had one of them as a neighbor, and the titles an affected title
+        is now at least as close to as their current last neighbor (the other distances didn't change)
+        '''
+
+        neighbors = self.item_neighbors["neighbors"].copy()
+        distances = self.item_neighbors["distances"].copy()
+        model = model or NearestNeighbors(metric="cosine", algorithm="brute", n_neighbors=20).fit(mat)
+        stale = np.union1d(affected_titles, np.nonzero(np.isin(neighbors, affected_titles).any(axis=1))[0])
+
+        # new cosine distance of every affected title to every title, one block of affected rows at a time
+        normalized = normalize_rows(mat).tocsr()
+        closest = np.full(mat.shape[0], np.inf)
+        for start in range(0, len(affected_titles), 1000):
+            block = affected_titles[start:start+1000]
+            block_distances = 1 - (normalized[block] @ normalized.T).toarray()
+            closest = np.minimum(closest, block_distances.min(axis=0))
+        # tolerance for the float32 distances of the table
+        gained = np.nonzero(closest <= distances[:, -1] + 1e-6)[0]
+        stale = np.union1d(stale, gained)
 
-        titlle_idx_arr = np.array(self.titlle_idx_list)
-        recommended_title_ids = titlle_idx_arr[indices].reshape(-1)
-        return recommended_title_ids
+        n_neighbors = neighbors.shape[1]
+        for start in range(0, len(stale), 1000):
+            batch = stale[start:start+1000]
+            dist, idx = model.kneighbors(mat[batch], n_neighbors=n_neighbors+1)
+            neighbors[batch], distances[batch] = drop_self_neighbors(idx, dist, batch)
+        return {"neighbors": neighbors, "distances": distances}
 
+def memory_report(asset_root=DEFAULT_ASSET_ROOT, columnar_root=None, verbose=True):
+    '''
+    memory of every UserBasedFiltering table loaded as is and in compact mode
+    :params
+        asset_root: folder that holds the assets
+        columnar_root: folder of the columnar copies of the assets. Default is asset_root/columnar
+        verbose: whether to print the report
+    :returns
+        dataframe indexed by table with rows, columns/bytes as loaded, columns/bytes in compact mode and the ratio
+    '''
 
+    default = UserBasedFiltering(asset_root, columnar_root)
+    compact = UserBasedFiltering(asset_root, columnar_root, compact=True)
+    rows = {}
+    for table in ["df_titles", "df_titles_genre", "df_mlist", "df_mlist_genre", "df_user_genre_dist"]:
+        before, after = getattr(default, table), getattr(compact, table)
+        rows[table] = {"rows": len(before), "columns": before.shape[1], "mb": frame_memory(before) / 2**20,
+                       "compact_columns": after.shape[1], "compact_mb": frame_memory(after) / 2**20}
+        # drop the default table before loading the next one
+        del default.__dict__[table]
+    df = pd.DataFrame.from_dict(rows, orient="index")
+    df.loc["total"] = df.sum()
+    df["ratio"] = df["compact_mb"] / df["mb"]
+    if verbose:
+        print(df.round(3).to_string())
+    return df
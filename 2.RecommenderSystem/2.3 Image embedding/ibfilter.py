@@ -1,63 +1,588 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+from sklearn.cluster import MiniBatchKMeans
 from PIL import Image
-import matplotlib.pyplot as plt
 
+# shared modules of 2.RecommenderSystem, the entry point puts that folder on sys.path
+from assetstore import AssetStore, LazyAsset, DEFAULT_ASSET_ROOT
+from instrumentation import Instrumentation
+from querycache import canonical_key
+from simbuilder import top_k_positions
+from bundle import Bundle, BundleAssetStore, write_bundle, frame_arrays, dict_arrays
 
-def plot_images(path, character_ids):
+EMBEDDING_DIR = "character_images/models_and_embeddings"
+
+
+class ImageLoader:
+    def __init__(self, path, max_workers=8, cache_size=512, thumbnail_size=(128, 128)):
+        '''
+        Loads character images concurrently and keeps the decoded thumbnails in a bounded LRU cache
+        :params
+            path: folder of the character images(<character_id>.png)
+            max_workers: number of threads that open and decode images
+            cache_size: maximum number of thumbnails kept in memory
+            thumbnail_size: maximum (width, height) of the kept thumbnails. None keeps the full images
+        '''
+
+        self.path = path
+        self.cache_size = cache_size
+        self.thumbnail_size = thumbnail_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _read(self, id):
+        file_path = os.path.join(self.path, str(id) + ".png")
+        if not os.path.exists(file_path):
+            return None
+        with Image.open(file_path) as img:
+            if self.thumbnail_size is not None:
+                img.thumbnail(self.thumbnail_size)
+            return np.array(img)
+
+    def load(self, character_ids):
+        '''
+        images of the given characters, from the cache or read in parallel
+        :params
+            character_ids: ids of the characters
+        :returns
+            images: dictionary of character_id: image array, in the order of character_ids
+            missing: list of character_ids whose image file doesn't exist or couldn't be decoded
+        '''
+
+        with self.lock:
+            cached = {id: self.cache[id] for id in character_ids if id in self.cache}
+            for id in cached:
+                self.cache.move_to_end(id)
+        to_read = [id for id in dict.fromkeys(character_ids) if id not in cached]
+        futures = {id: self.executor.submit(self._read, id) for id in to_read}
+
+        loaded, missing = {}, []
+        for id, future in futures.items():
+            try:
+                img = future.result()
+            except (OSError, ValueError):
+                img = None
+            if img is None:
+                missing.append(id)
+            else:
+                loaded[id] = img
+
+        with self.lock:
+            for id, img in loaded.items():
+                self.cache[id] = img
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        images = {id: cached.get(id, loaded.get(id)) for id in character_ids if id in cached or id in loaded}
+        return images, missing
+
+
+def plot_images(path, character_ids, loader=None):
     '''
-    Shows first 10 images in 2x5 frame
+    Shows first 10 images in 2x5 frame (notebook helper, not used by the recommendation methods)
     :params
         path: path to the image
         character_ids: id of characters to draw
+        loader: ImageLoader to read the images with. A new one is created if not given
     :returns
-        it doesn't return but plots the images
+        list of character_ids whose image is missing
     '''
 
-    rows, columns = 2, 5
-    imgs = []
-    character_ids = character_ids[:10+1]
+    import matplotlib.pyplot as plt
 
-    # get the actual images
-    for id in character_ids:
-        try:
-            img = Image.open(path + str(id) + ".png")
-            imgs.append(np.array(img))
-        except:
-            pass
+    rows, columns = 2, 5
+    loader = loader or ImageLoader(path, thumbnail_size=None)
+    imgs, missing = loader.load(list(character_ids[:10+1]))
 
     # iterate over axis and show
     fig, axes = plt.subplots(rows, columns, figsize=(8,4))
-    for img, ax in zip(imgs, axes.flatten()):
+    for img, ax in zip(imgs.values(), axes.flatten()):
         ax.imshow(img, cmap="gray")
+    if missing:
+        fig.suptitle("missing images: " + ", ".join(str(id) for id in missing))
     plt.show()
+    return missing
+
+
+def writable(arr):
+    '''
+    arr, or an in-memory copy of it if it is read-only (e.g. memory-mapped from a bundle), before an in-place update
+    '''
+
+    return arr if arr.flags.writeable else np.array(arr)
+
+
+class EmbeddingIndex:
+    def __init__(self, ids, embeddings, path=None, block_size=8192):
+        '''
+        Cosine similarity search over a set of embeddings without building the pairwise matrix.
+        Embeddings are L2-normalized once and kept as a float32 array (memory-mapped from path if given),
+        queries are answered with a blocked matrix-vector product and argpartition
+        :params
+            ids: id of each embedding row
+            embeddings: (n x dim) embeddings
+            path: .npy file to store the normalized embeddings in and memory-map them from
+            block_size: number of rows multiplied at once
+        '''
+
+        self.ids = np.asarray(ids)
+        self.id_pos = {id: pos for pos, id in enumerate(self.ids)}
+        self.block_size = block_size
+        self.ivf = None
+        self.approx_recall = None
+
+        normalized, self.norms = self._normalize(embeddings, len(self.ids))
+        if path is None:
+            self.vectors = normalized
+        else:
+            np.save(path, normalized)
+            self.vectors = np.load(path, mmap_mode="r")
+
+    @staticmethod
+    def _normalize(embeddings, n):
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(n, -1)
+        norms = np.linalg.norm(embeddings, axis=1)
+        norms[norms == 0] = 1
+        return embeddings / norms[:, None], norms
+
+    def embeddings(self, ids):
+        '''
+        original(not normalized) embeddings of the given ids
+        :params
+            ids: ids to look up
+        :returns
+            (len(ids) x dim) float32 array
+        '''
+
+        pos = np.array([self.id_pos[id] for id in ids], dtype=int)
+        return self.vectors[pos] * self.norms[pos, None]
+
+    def upsert(self, ids, embeddings):
+        '''
+        replaces the embeddings of existing ids and appends the new ones, without touching the other rows.
+        A memory-mapped(or bundle-loaded) index is copied into memory on its first update
+        :params
+            ids: ids to add or update
+            embeddings: (len(ids) x dim) embeddings
+        :returns
+            it doesn't return but updates the index
+        '''
+
+        ids = np.asarray(ids)
+        if len(ids) == 0:
+            return
+        normalized, norms = self._normalize(embeddings, len(ids))
+        self.vectors, self.norms = writable(self.vectors), writable(self.norms)
+
+        is_new = np.array([id not in self.id_pos for id in ids], dtype=bool)
+        existing_pos = np.array([self.id_pos[id] for id in ids[~is_new]], dtype=int)
+        self.vectors[existing_pos] = normalized[~is_new]
+        self.norms[existing_pos] = norms[~is_new]
+        if is_new.any():
+            self.vectors = np.vstack([self.vectors, normalized[is_new]])
+            self.norms = np.concatenate([self.norms, norms[is_new]])
+            new_pos = np.arange(len(self.ids), len(self.ids)+is_new.sum())
+            self.id_pos.update(zip(ids[is_new], new_pos))
+            self.ids = np.concatenate([self.ids, ids[is_new]])
+        if self.ivf is not None:
+            self._assign_ivf(np.concatenate([existing_pos, np.arange(len(self.ids)-is_new.sum(), len(self.ids))]))
+
+    def remove(self, ids):
+        '''
+        removes ids from the index
+        :params
+            ids: ids to remove(unknown ids are ignored)
+        :returns
+            boolean mask over the previous rows, True for the rows that were kept
+        '''
+
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[[self.id_pos[id] for id in ids if id in self.id_pos]] = False
+        self.vectors = self.vectors[keep]
+        self.norms = self.norms[keep]
+        self.ids = self.ids[keep]
+        self.id_pos = {id: pos for pos, id in enumerate(self.ids)}
+        if self.ivf is not None:
+            self.ivf["labels"] = self.ivf["labels"][keep]
+            self._assign_ivf(np.array([], dtype=int))
+        return keep
+
+    def _assign_ivf(self, positions):
+        # (re)assign the given rows to their closest cluster and rebuild the inverted lists
+        ivf = self.ivf
+        labels = np.resize(ivf["labels"], len(self.ids))
+        if len(positions):
+            labels[positions] = np.argmax(self.vectors[positions] @ ivf["centroids"].T, axis=1)
+        order = np.argsort(labels, kind="stable")
+        ivf["labels"] = labels
+        ivf["members"] = order
+        ivf["offsets"] = np.searchsorted(labels[order], np.arange(len(ivf["centroids"])+1))
+
+    def scores(self, query_vector):
+        '''
+        cosine similarity between a query vector and every embedding, computed block by block
+        :params
+            query_vector: (dim,) query embedding
+        :returns
+            (n,) float32 array of similarities
+        '''
+
+        q = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        q = q / (np.linalg.norm(q) or 1)
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        for start in range(0, len(self.ids), self.block_size):
+            stop = min(start+self.block_size, len(self.ids))
+            scores[start:stop] = self.vectors[start:stop] @ q
+        return scores
+
+    def search(self, query_vector, top_n, exclude_pos=None, approximate=False):
+        '''
+        most similar embeddings to a query vector
+        :params
+            query_vector: (dim,) query embedding
+            top_n: how many results to return
+            exclude_pos: row position to leave out of the result (e.g. the query itself)
+            approximate: whether to use the approximate index built by build_approximate_index
+        :returns
+            ids and cosine similarities of the results, most similar first
+        '''
+
+        if approximate and self.ivf is not None:
+            candidates = self._ivf_candidates(query_vector)
+            scores = self.vectors[candidates] @ (query_vector / (np.linalg.norm(query_vector) or 1)).astype(np.float32)
+        else:
+            candidates = np.arange(len(self.ids))
+            scores = self.scores(query_vector)
+        if exclude_pos is not None:
+            scores[candidates == exclude_pos] = -np.inf
+        top = top_k_positions(scores, top_n)
+        top = top[np.isfinite(scores[top])]
+        return self.ids[candidates[top]], scores[top]
+
+    def search_by_id(self, query_id, top_n, approximate=False):
+        '''
+        most similar embeddings to the embedding of query_id, excluding query_id itself
+        :params
+            query_id: id of the querying embedding
+            top_n: how many results to return
+            approximate: whether to use the approximate index built by build_approximate_index
+        :returns
+            ids and cosine similarities of the results, most similar first
+        '''
+
+        pos = self.id_pos[query_id]
+        return self.search(self.vectors[pos], top_n, exclude_pos=pos, approximate=approximate)
+
+    def build_approximate_index(self, n_clusters=None, n_probe=8, n_eval_queries=200, top_n=10, random_state=0):
+        '''
+        Builds an inverted-file approximate index: embeddings are clustered with k-means and a query only scores
+        the members of its n_probe closest clusters. The recall@top_n against the exact search is measured on
+        n_eval_queries random embeddings
+        :params
+            n_clusters: number of clusters. Default is sqrt(n)
+            n_probe: number of clusters scored per query
+            n_eval_queries: number of queries used to measure the recall
+            top_n: cut-off of the measured recall
+            random_state: seed of k-means and of the evaluation queries
+        :returns
+            measured recall@top_n (also kept as self.approx_recall)
+        '''
+
+        n = len(self.ids)
+        n_clusters = min(n, n_clusters or max(1, int(np.sqrt(n))))
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, n_init=3).fit(self.vectors)
+        labels = kmeans.labels_
+        order = np.argsort(labels, kind="stable")
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        self.ivf = {
+            "centroids": centroids,
+            "labels": labels,
+            "members": order,
+            "offsets": np.searchsorted(labels[order], np.arange(n_clusters+1)),
+            "n_probe": min(n_probe, n_clusters),
+        }
+
+        rng = np.random.RandomState(random_state)
+        hits = []
+        for pos in rng.choice(n, min(n_eval_queries, n), replace=False):
+            exact, _ = self.search_by_id(self.ids[pos], top_n)
+            approx, _ = self.search_by_id(self.ids[pos], top_n, approximate=True)
+            hits.append(len(set(exact) & set(approx)) / max(len(exact), 1))
+        self.approx_recall = float(np.mean(hits))
+        return self.approx_recall
+
+    def _ivf_candidates(self, query_vector):
+        ivf = self.ivf
+        probe = top_k_positions(ivf["centroids"] @ np.asarray(query_vector, dtype=np.float32), ivf["n_probe"])
+        return np.concatenate([ivf["members"][ivf["offsets"][c]:ivf["offsets"][c+1]] for c in probe])
+
+    def bundle_arrays(self, prefix):
+        '''
+        arrays and meta storing the index in a bundle under prefix (read back with from_bundle)
+        '''
+
+        arrays = {prefix+".ids": self.ids, prefix+".vectors": self.vectors, prefix+".norms": self.norms}
+        meta = {"block_size": self.block_size, "approx_recall": self.approx_recall}
+        if self.ivf is not None:
+            arrays.update(dict_arrays(prefix+".ivf", self.ivf))
+            meta["n_probe"] = self.ivf["n_probe"]
+        return arrays, {prefix: meta}
+
+    @classmethod
+    def from_bundle(cls, bundle, prefix):
+        '''
+        index stored by bundle_arrays, its arrays are read-only memory-mapped views of the bundle (see upsert)
+        :params
+            bundle: Bundle
+            prefix: name it was stored under
+        :returns
+            EmbeddingIndex
+        '''
+
+        meta = bundle.meta[prefix]
+        index = cls.__new__(cls)
+        index.ids = bundle.array(prefix+".ids")
+        index.id_pos = {id: pos for pos, id in enumerate(index.ids)}
+        index.block_size = meta["block_size"]
+        index.vectors = bundle.array(prefix+".vectors")
+        index.norms = bundle.array(prefix+".norms")
+        index.approx_recall = meta["approx_recall"]
+        index.ivf = None
+        if "n_probe" in meta:
+            index.ivf = {**bundle.arrays(prefix+".ivf"), "n_probe": meta["n_probe"]}
+        return index
 
 
 class ImageBasedRecommendation:
-    def __init__(self, query_path, version):
-        print("model version: ", version)
-        self.embedding_flat_np = np.load("/mnt/disks/sdb/home/dy0904k/assets/character_images/models_and_embeddings/image_embedding_"+version+".npy") 
-        self.embedding_ids = np.load("/mnt/disks/sdb/home/dy0904k/assets/character_images/models_and_embeddings/image_embedding_character_ids_"+version+".npy") 
-        self.df_characters = pd.read_csv("/mnt/disks/sdb/home/dy0904k/assets/characters_200p.csv")
+    df_characters = LazyAsset(lambda self: self.assets.load_frame("characters_200p"))
+
+    def __init__(self, query_path, version, asset_root=DEFAULT_ASSET_ROOT, index_dir=None, approximate=False, instrumentation=None, cache=None):
+        '''
+        :params
+            query_path: folder of the character images
+            version: version of the image embeddings
+            asset_root: folder that holds the assets
+            index_dir: folder to store the normalized embeddings in(memory-mapped). None keeps them in memory
+            approximate: whether to build the approximate index and use it for the queries
+            instrumentation: stage timers of the build and the queries (see instrumentation.py). Default is a disabled one
+            cache: QueryCache of the recommend results (see querycache.py). None caches nothing
+        '''
+
+        self.instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        self.cache = cache
+        # incremented by every add/remove, cached results of older index versions are dropped
+        self.index_version = 0
+        self.version = version
+        self.assets = AssetStore(asset_root)
+        with self.instrumentation.stage("ibf.load_embeddings"):
+            self.embedding_flat_np = self.assets.load_array(EMBEDDING_DIR+"/image_embedding_"+version)
+            self.embedding_ids = self.assets.load_array(EMBEDDING_DIR+"/image_embedding_character_ids_"+version)
         self.query_path = query_path
+        self.approximate = approximate
+        self.image_loader = None
+
+        # character based similarity index
+        chara_index_path = None if index_dir is None else os.path.join(index_dir, "character_index_"+version+".npy")
+        with self.instrumentation.stage("ibf.build_character_index"):
+            self.chara_index = EmbeddingIndex(self.embedding_ids.astype(int), self.embedding_flat_np, chara_index_path)
+
+        # title based similarity index
+        with self.instrumentation.stage("ibf.build_title_index"):
+            self._build_title_index(None if index_dir is None else os.path.join(index_dir, "title_index_"+version+".npy"))
+
+        # measured recall@10 of the approximate indexes, see EmbeddingIndex.approx_recall
+        if approximate:
+            self.chara_index.build_approximate_index()
+            self.title_index.build_approximate_index()
+
+    def load_images(self, character_ids):
+        '''
+        optional step after a recommendation: the character images, read by a shared ImageLoader
+        :params
+            character_ids: ids of the characters
+        :returns
+            images: dictionary of character_id: thumbnail array
+            missing: list of character_ids whose image is missing
+        '''
 
-        # create character_based similarity matrix
-        self.df_chara_sim_mat = pd.DataFrame(cosine_similarity(self.embedding_flat_np))
-        self.df_chara_sim_mat.index = self.embedding_ids
-        self.df_chara_sim_mat.columns = self.embedding_ids
+        if self.image_loader is None:
+            self.image_loader = ImageLoader(self.query_path)
+        return self.image_loader.load(list(character_ids))
+
+    def _build_title_index(self, path=None):
+        '''
+        Title embedding = average of the embeddings of its characters, computed as one sparse
+        (titles x characters) averaging matrix times the character embedding matrix.
+        The per-title sums and character counts are kept so that add/remove only update the affected titles
+        :params
+            path: .npy file to memory-map the normalized title embeddings from. None keeps them in memory
+        :returns
+            it doesn't return but sets self.title_index, self.chara_title, self.title_sums, self.title_counts
+        '''
 
-        # create title_based similarity matrix
-        np_embedding_id_concat = np.c_[self.embedding_ids.astype(int), self.embedding_flat_np] # create character_id:embeddings table
-        df_embedding = pd.DataFrame(np_embedding_id_concat)
-        df_embedding.rename(columns={0:"character_id"}, inplace=True)
         df_characters_unique = self.df_characters.drop_duplicates(subset="character_id") 
         df_title_char = df_characters_unique[["title_id", "character_id"]] # get character:title reference table
-        df_merged = pd.merge(df_title_char, df_embedding, how="inner", on="character_id")
-        df_title_embedding_avg = df_merged.groupby("title_id").mean() # merge and calculate "average" of image features
-        self.df_title_sim_mat = pd.DataFrame(cosine_similarity(df_title_embedding_avg.iloc[:, 1:])) # similarity calculation of titles
-        self.df_title_sim_mat.index = df_title_embedding_avg.index
-        self.df_title_sim_mat.columns = df_title_embedding_avg.index
+        df_title_char = df_title_char[df_title_char["character_id"].isin(self.chara_index.id_pos)]
+        self.chara_title = dict(zip(df_title_char["character_id"], df_title_char["title_id"]))
+
+        title_ids, title_rows = np.unique(df_title_char["title_id"].values, return_inverse=True)
+        chara_cols = np.array([self.chara_index.id_pos[c] for c in df_title_char["character_id"]], dtype=int)
+        membership = sparse.csr_matrix((np.ones(len(chara_cols)), (title_rows, chara_cols)), shape=(len(title_ids), len(self.chara_index.ids)))
+        self.title_counts = np.asarray(membership.sum(axis=1)).reshape(-1)
+        averaging = sparse.diags(1 / self.title_counts) @ membership
+        title_embedding_avg = averaging @ np.asarray(self.embedding_flat_np, dtype=np.float64).reshape(len(self.embedding_ids), -1)
+        self.title_sums = title_embedding_avg * self.title_counts[:, None]
+        self.title_index = EmbeddingIndex(title_ids, title_embedding_avg, path)
+
+    def add_characters(self, df_new_characters, embeddings):
+        '''
+        adds (or replaces) characters and updates only the titles they belong to; new titles are created as needed
+        :params
+            df_new_characters: characters_200p formatted rows(at least character_id and title_id) of the new characters
+            embeddings: (len(df_new_characters) x dim) image embeddings, in the same order
+        :returns
+            it doesn't return but updates the indexes and df_characters
+        '''
+
+        character_ids = df_new_characters["character_id"].values
+        self.remove_characters([c for c in character_ids if c in self.chara_title])
+        embeddings = np.asarray(embeddings, dtype=np.float64).reshape(len(character_ids), -1)
+        self.chara_index.upsert(character_ids, embeddings)
+        self.chara_title.update(zip(character_ids, df_new_characters["title_id"].values))
+        self.df_characters = pd.concat([self.df_characters, df_new_characters], ignore_index=True)
+
+        # grow the per-title sums/counts for new titles, then add the new characters to them
+        title_ids = df_new_characters["title_id"].values
+        new_titles = np.array([t for t in pd.unique(title_ids) if t not in self.title_index.id_pos])
+        self.title_sums = np.vstack([self.title_sums, np.zeros((len(new_titles), self.title_sums.shape[1]))])
+        self.title_counts = np.concatenate([self.title_counts, np.zeros(len(new_titles))])
+        title_pos = {**self.title_index.id_pos, **{t: len(self.title_index.ids)+i for i, t in enumerate(new_titles)}}
+        rows = np.array([title_pos[t] for t in title_ids], dtype=int)
+        np.add.at(self.title_sums, rows, embeddings)
+        np.add.at(self.title_counts, rows, 1)
+
+        affected = np.unique(rows)
+        self.title_index.upsert(np.array([*self.title_index.ids, *new_titles])[affected], self.title_sums[affected] / self.title_counts[affected, None])
+        self.index_version += 1
+
+    def remove_characters(self, character_ids):
+        '''
+        removes characters and updates only the titles they belonged to; titles left without characters are removed
+        :params
+            character_ids: ids of the characters to remove
+        :returns
+            it doesn't return but updates the indexes and df_characters
+        '''
+
+        character_ids = [c for c in character_ids if c in self.chara_title]
+        if not character_ids:
+            return
+        rows = np.array([self.title_index.id_pos[self.chara_title[c]] for c in character_ids], dtype=int)
+        self.title_sums, self.title_counts = writable(self.title_sums), writable(self.title_counts)
+        np.subtract.at(self.title_sums, rows, self.chara_index.embeddings(character_ids).astype(np.float64))
+        np.subtract.at(self.title_counts, rows, 1)
+        for c in character_ids:
+            del self.chara_title[c]
+        self.chara_index.remove(character_ids)
+        self.df_characters = self.df_characters[~self.df_characters["character_id"].isin(character_ids)]
+
+        affected = np.unique(rows)
+        empty = affected[self.title_counts[affected] == 0]
+        updated = affected[self.title_counts[affected] > 0]
+        self.title_index.upsert(self.title_index.ids[updated], self.title_sums[updated] / self.title_counts[updated, None])
+        self._remove_title_rows(self.title_index.ids[empty])
+        self.index_version += 1
+
+    def remove_titles(self, title_ids):
+        '''
+        removes titles together with their characters
+        :params
+            title_ids: ids of the titles to remove
+        :returns
+            it doesn't return but updates the indexes and df_characters
+        '''
+
+        title_ids = set(title_ids)
+        self.remove_characters([c for c, t in self.chara_title.items() if t in title_ids])
+        self._remove_title_rows(list(title_ids))
+
+    def _remove_title_rows(self, title_ids):
+        keep = self.title_index.remove(title_ids)
+        self.title_sums = self.title_sums[keep]
+        self.title_counts = self.title_counts[keep]
+        self.index_version += 1
+
+    def save_bundle(self, path):
+        '''
+        Writes the fitted state to a single bundle file (see bundle.py) that any number of worker processes can
+        memory-map read-only with load_bundle instead of normalizing the embeddings and building the indexes again:
+        both EmbeddingIndexes(approximate indexes included), the per-title sums/counts and the character table
+        :params
+            path: bundle file to write
+        :returns
+            it doesn't return but writes the file
+        '''
+
+        arrays, meta = frame_arrays("characters_200p", self.df_characters)
+        for name in ["chara_index", "title_index"]:
+            index_arrays, index_meta = getattr(self, name).bundle_arrays(name)
+            arrays.update(index_arrays)
+            meta.update(index_meta)
+        arrays["chara_title.character_ids"] = np.array(list(self.chara_title), dtype=int)
+        arrays["chara_title.title_ids"] = np.array(list(self.chara_title.values()), dtype=int)
+        arrays["title_sums"] = self.title_sums
+        arrays["title_counts"] = self.title_counts
+        meta.update({"version": self.version, "index_version": self.index_version, "approximate": self.approximate})
+        write_bundle(path, arrays, "ibf", meta)
+
+    @classmethod
+    def load_bundle(cls, path, query_path, instrumentation=None, cache=None):
+        '''
+        ImageBasedRecommendation over a bundle written by save_bundle. The embeddings and indexes are read-only
+        memory-mapped views of the file, shared by every process that loads the same bundle; add/remove copy what
+        they update into the memory of this process. The raw embeddings aren't kept(embedding_flat_np is None),
+        chara_index.embeddings returns them
+        :params
+            path: bundle file
+            query_path: folder of the character images
+            instrumentation: stage timers of the queries (see instrumentation.py). Default is a disabled one
+            cache: QueryCache of the recommend results (see querycache.py). None caches nothing
+        :returns
+            ImageBasedRecommendation
+        '''
+
+        bundle = Bundle(path, expected_kind="ibf")
+        ibr = cls.__new__(cls)
+        ibr.instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        ibr.cache = cache
+        ibr.index_version = bundle.meta["index_version"]
+        ibr.version = bundle.meta["version"]
+        ibr.assets = BundleAssetStore(bundle)
+        ibr.query_path = query_path
+        ibr.approximate = bundle.meta["approximate"]
+        ibr.image_loader = None
+        with ibr.instrumentation.stage("ibf.load_bundle"):
+            ibr.chara_index = EmbeddingIndex.from_bundle(bundle, "chara_index")
+            ibr.title_index = EmbeddingIndex.from_bundle(bundle, "title_index")
+            ibr.chara_title = dict(zip(bundle.array("chara_title.character_ids").tolist(), bundle.array("chara_title.title_ids").tolist()))
+            ibr.title_sums = bundle.array("title_sums")
+            ibr.title_counts = bundle.array("title_counts")
+        ibr.embedding_ids = ibr.chara_index.ids
+        ibr.embedding_flat_np = None
+        return ibr
+
+    def _cached(self, method, query_id, top_n, compute):
+        if self.cache is None:
+            return compute()
+        key = canonical_key(query_id, top_n=top_n, approximate=self.approximate)
+        return self.cache.call(self, method, (self.version, self.index_version), key, compute)
 
     def recommend_titles_from_similar_characters(self, query_character_id, top_n):
         '''
@@ -66,58 +591,46 @@ class ImageBasedRecommendation:
             query_character_id: character id of the queried character
             top_n: how many similar characters to get
         :returns
-            list of recommended titles
+            dataframe of the similar characters(most similar first) with their similarity and the title they appear in:
+            character_id, similarity, character_name, title_id, title_romaji.
+            The recommended titles are its unique title_ids
         '''
 
-        # show the querying character
-        df_q = self.df_characters[self.df_characters["character_id"]==query_character_id]
-        print("Queried character: ", df_q["character_name"].unique(), " who appears in: ", df_q["title_romaji"].unique())
-        img = Image.open(self.query_path + str(query_character_id) + ".png")
-        plt.imshow(np.array(img), cmap="gray")
-        plt.show()
+        return self._cached("ibf.similar_characters", query_character_id, top_n,
+                            lambda: self._similar_characters(query_character_id, top_n))
 
+    def _similar_characters(self, query_character_id, top_n):
         # get similar character
-        df = self.df_chara_sim_mat[str(query_character_id)].sort_values(ascending=False)
-        df_top = df[1:top_n+1]
-        top_ids = list(df_top.index.astype(int))
-        plot_images(self.query_path, top_ids)
-
-        # print character names
-        print("Similar characters (in the order of appearance)")
-        for chara_id in top_ids:
-            df_recc = self.df_characters[self.df_characters["character_id"]==int(chara_id)]
-            print("Character: ", df_recc["character_name"].unique(), " who appears in : ", df_recc["title_romaji"].unique())
+        with self.instrumentation.stage("ibf.search"):
+            top_ids, similarities = self.chara_index.search_by_id(int(query_character_id), top_n, approximate=self.approximate)
+        df_top = pd.DataFrame({"character_id": top_ids, "similarity": similarities})
 
         # get titles that each similar character appears in
-        df_res = self.df_characters[self.df_characters["character_id"].isin(top_ids)]
-        df_res = df_res.drop_duplicates(subset="character_name")
-        recc_title_ids = df_res["title_id"].unique()
-
-        return recc_title_ids
+        with self.instrumentation.stage("ibf.metadata_merge"):
+            df_res = self.df_characters[self.df_characters["character_id"].isin(top_ids)]
+            df_res = df_res.drop_duplicates(subset="character_name")
+            df_res = df_top.merge(df_res[["character_id", "character_name", "title_id", "title_romaji"]], how="inner", on="character_id")
+        return df_res
 
     def recommend_titles_from_similar_image_embedding(self, query_title_id, top_n):
         '''
-        recommends titles from similar characters to the queried character
+        recommends titles whose average character image embedding is similar to the queried title's
         :params
             query_title_id: title id of the queried title
             top_n: how many similar titles to get
         :returns
-            list of recommended titles
+            dataframe of the similar titles(most similar first, queried title excluded): title_id, similarity, title_romaji
         '''
 
-        # query title and pull out similar titles
-        df = self.df_title_sim_mat[query_title_id].sort_values(ascending=False)
-        df_top = df[0:top_n+1]
-        top_ids = df_top.index
-
-        # get images for comparison
-        for idx, id in enumerate(top_ids):
-            df = self.df_characters[self.df_characters["title_id"]==id]
-            if idx == 0:
-                print("Querying title: ", df["title_romaji"].unique())
-            else:
-                print("Similar title: ", df["title_romaji"].unique())
-            character_ids = df["character_id"].unique()
-            plot_images(self.query_path, character_ids)
+        return self._cached("ibf.similar_image_embedding", query_title_id, top_n,
+                            lambda: self._similar_image_embedding(query_title_id, top_n))
 
-        return list(top_ids[1:]) # exclude first element as it's the queried title
+    def _similar_image_embedding(self, query_title_id, top_n):
+        # query title and pull out similar titles
+        with self.instrumentation.stage("ibf.search"):
+            top_ids, similarities = self.title_index.search_by_id(query_title_id, top_n, approximate=self.approximate)
+        df_res = pd.DataFrame({"title_id": top_ids, "similarity": similarities})
+        with self.instrumentation.stage("ibf.metadata_merge"):
+            df_titles = self.df_characters[["title_id", "title_romaji"]].drop_duplicates(subset="title_id")
+            df_res = df_res.merge(df_titles, how="left", on="title_id")
+        return df_res
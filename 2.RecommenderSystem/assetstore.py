@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+DEFAULT_ASSET_ROOT = "/mnt/disks/sdb/home/dy0904k/assets"
+COLUMNAR_DIR = "columnar"
+
+# assets converted by convert_assets() when no names are given
+CSV_ASSETS = ["titles_2000p", "ryota_title_genre_2000p", "media_list_all_users", "ryota_media_list_genre",
+              "ryota_user_genre_dist", "titles_200p_cleaned", "characters_200p"]
+NPZ_ASSETS = ["ryota_title_user"]
+
+
+def write_frame(df, out_dir):
+    '''
+    Writes a dataframe as a directory of typed columns
+    - numeric/bool columns: one .npy file each, memory-mappable
+    - other columns: categorical int32 codes (.npy, memory-mappable) + their categories
+    :params
+        df: dataframe to write
+        out_dir: directory to write the columns and the manifest.json to
+    :returns
+        it doesn't return but writes the files
+    '''
+
+    os.makedirs(out_dir, exist_ok=True)
+    columns = []
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            np.save(os.path.join(out_dir, f"{i}.npy"), values.values)
+            columns.append({"name": col, "kind": "numeric", "dtype": str(values.dtype)})
+        else:
+            categorical = pd.Categorical(values)
+            np.save(os.path.join(out_dir, f"{i}.codes.npy"), categorical.codes.astype(np.int32))
+            np.save(os.path.join(out_dir, f"{i}.categories.npy"), np.array(categorical.categories, dtype=str))
+            columns.append({"name": col, "kind": "categorical", "dtype": "category"})
+
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump({"format": "frame", "n_rows": len(df), "columns": columns}, f)
+
+
+def read_columns(in_dir, columns=None, mmap=True):
+    '''
+    Reads columns written by write_frame
+    :params
+        in_dir: directory written by write_frame
+        columns: names of the columns to read. None reads all of them
+        mmap: whether to memory-map the numeric columns and the categorical codes
+    :returns
+        dictionary of column name: numpy array (numeric) or pandas Categorical
+    '''
+
+    with open(os.path.join(in_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    mmap_mode = "r" if mmap else None
+    data = {}
+    for i, col in enumerate(manifest["columns"]):
+        if columns is not None and col["name"] not in columns:
+            continue
+        if col["kind"] == "numeric":
+            data[col["name"]] = np.load(os.path.join(in_dir, f"{i}.npy"), mmap_mode=mmap_mode)
+        else:
+            codes = np.load(os.path.join(in_dir, f"{i}.codes.npy"), mmap_mode=mmap_mode)
+            categories = np.load(os.path.join(in_dir, f"{i}.categories.npy"))
+            data[col["name"]] = pd.Categorical.from_codes(codes, categories)
+    return data
+
+
+def write_sparse(mat, out_dir):
+    '''
+    Writes a sparse matrix as memory-mappable CSR components
+    :params
+        mat: scipy sparse matrix
+        out_dir: directory to write data.npy, indices.npy, indptr.npy and manifest.json to
+    :returns
+        it doesn't return but writes the files
+    '''
+
+    os.makedirs(out_dir, exist_ok=True)
+    mat = sparse.csr_matrix(mat)
+    for part in ["data", "indices", "indptr"]:
+        np.save(os.path.join(out_dir, f"{part}.npy"), getattr(mat, part))
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump({"format": "csr", "shape": list(mat.shape)}, f)
+
+
+def read_sparse(in_dir, mmap=True):
+    '''
+    Reads a sparse matrix written by write_sparse
+    :params
+        in_dir: directory written by write_sparse
+        mmap: whether to memory-map the CSR components
+    :returns
+        scipy csr_matrix
+    '''
+
+    with open(os.path.join(in_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    mmap_mode = "r" if mmap else None
+    parts = [np.load(os.path.join(in_dir, f"{part}.npy"), mmap_mode=mmap_mode) for part in ["data", "indices", "indptr"]]
+    return sparse.csr_matrix(tuple(parts), shape=tuple(manifest["shape"]), copy=False)
+
+
+def compact_frame(df):
+    '''
+    Same table in smaller dtypes, without changing any value
+    - integer columns: uint8 when they only hold 0..255(e.g. genre flags), int32 when they fit, int64 otherwise
+    - float columns: float32
+    - string columns: categoricals
+    :params
+        df: dataframe to compact
+    :returns
+        pandas DataFrame
+    '''
+
+    data = {}
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_bool_dtype(values) or isinstance(values.dtype, pd.CategoricalDtype):
+            data[col] = values
+            continue
+        if pd.api.types.is_integer_dtype(values):
+            low, high = (values.min(), values.max()) if len(values) else (0, 0)
+            if low >= 0 and high <= np.iinfo(np.uint8).max:
+                dtype = np.uint8
+            elif low >= np.iinfo(np.int32).min and high <= np.iinfo(np.int32).max:
+                dtype = np.int32
+            else:
+                dtype = values.dtype
+        elif pd.api.types.is_float_dtype(values):
+            dtype = np.float32
+        else:
+            dtype = "category"
+        # columns already in their compact dtype are kept as they are(e.g. memory-mapped ones)
+        data[col] = values if values.dtype == dtype else values.astype(dtype)
+    return pd.DataFrame(data, index=df.index, copy=False)
+
+
+def frame_memory(df):
+    '''
+    bytes held by a dataframe, strings and index included
+    '''
+
+    return int(df.memory_usage(deep=True).sum())
+
+
+def convert_assets(asset_root=DEFAULT_ASSET_ROOT, names=None, columnar_root=None):
+    '''
+    One-time conversion of the csv/npz assets into the columnar format
+    :params
+        asset_root: folder that holds the csv/npz assets
+        names: asset names(file names without extension) to convert. None converts every known asset that exists
+        columnar_root: output folder. Default is asset_root/columnar
+    :returns
+        list of converted asset names
+    '''
+
+    columnar_root = columnar_root or os.path.join(asset_root, COLUMNAR_DIR)
+    converted = []
+    for name in (names or CSV_ASSETS + NPZ_ASSETS):
+        csv_path = os.path.join(asset_root, name + ".csv")
+        npz_path = os.path.join(asset_root, name + ".npz")
+        if os.path.exists(csv_path):
+            write_frame(pd.read_csv(csv_path), os.path.join(columnar_root, name))
+        elif os.path.exists(npz_path):
+            write_sparse(sparse.load_npz(npz_path), os.path.join(columnar_root, name))
+        else:
+            continue
+        converted.append(name)
+    return converted
+
+
+class AssetStore:
+    def __init__(self, asset_root=DEFAULT_ASSET_ROOT, columnar_root=None, mmap=True):
+        '''
+        Loads assets by name from asset_root, preferring the columnar copy written by convert_assets
+        and falling back to the original csv/npz/npy file
+        :params
+            asset_root: folder that holds the assets
+            columnar_root: folder of the columnar copies. Default is asset_root/columnar
+            mmap: whether to memory-map numeric columns and arrays
+        '''
+
+        self.asset_root = asset_root
+        self.columnar_root = columnar_root or os.path.join(asset_root, COLUMNAR_DIR)
+        self.mmap = mmap
+        self.load_times = {}
+
+    def _columnar_dir(self, name):
+        path = os.path.join(self.columnar_root, name)
+        return path if os.path.exists(os.path.join(path, "manifest.json")) else None
+
+    def load_columns(self, name, columns=None):
+        '''
+        loads columns of a table asset as arrays
+        :params
+            name: asset name
+            columns: names of the columns to load. None loads all of them
+        :returns
+            dictionary of column name: array
+        '''
+
+        path = self._columnar_dir(name)
+        if path is not None:
+            return read_columns(path, columns, self.mmap)
+        df = pd.read_csv(os.path.join(self.asset_root, name + ".csv"), usecols=columns)
+        return {col: df[col].values for col in df.columns}
+
+    def load_frame(self, name, columns=None, as_category=False):
+        '''
+        loads a table asset as a dataframe
+        :params
+            name: asset name
+            columns: names of the columns to load. None loads all of them
+            as_category: whether to keep string columns of the columnar copy as pandas categoricals.
+                         By default they are turned back into object columns, as read_csv would return them
+        :returns
+            pandas DataFrame
+        '''
+
+        path = self._columnar_dir(name)
+        if path is None:
+            return pd.read_csv(os.path.join(self.asset_root, name + ".csv"), usecols=columns)
+        data = read_columns(path, columns, self.mmap)
+        if not as_category:
+            data = {col: np.asarray(values, dtype=object) if isinstance(values, pd.Categorical) else values for col, values in data.items()}
+        return pd.DataFrame(data)
+
+    def load_sparse(self, name):
+        '''
+        loads a sparse matrix asset
+        :params
+            name: asset name
+        :returns
+            scipy csr_matrix
+        '''
+
+        path = self._columnar_dir(name)
+        if path is not None:
+            return read_sparse(path, self.mmap)
+        return sparse.load_npz(os.path.join(self.asset_root, name + ".npz"))
+
+    def load_array(self, name):
+        '''
+        loads a .npy asset (memory-mapped when possible)
+        :params
+            name: asset name
+        :returns
+            numpy array
+        '''
+
+        return np.load(os.path.join(self.asset_root, name + ".npy"), mmap_mode="r" if self.mmap else None)
+
+    def report_load_times(self):
+        '''
+        seconds spent loading each asset so far, in loading order
+        :returns
+            pandas Series of asset name: seconds
+        '''
+
+        return pd.Series(self.load_times, name="seconds", dtype=float)
+
+
+class LazyAsset:
+    def __init__(self, loader):
+        '''
+        Attribute that is loaded by loader(obj) the first time it is read and then cached on the instance.
+        The time spent is recorded in obj.assets.load_times under the attribute name,
+        and as the stage "load.<name>" of obj.instrumentation if the object has one
+        :params
+            loader: function taking the owning object and returning the value
+        '''
+
+        self.loader = loader
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        start = time.perf_counter()
+        value = self.loader(obj)
+        seconds = time.perf_counter() - start
+        obj.assets.load_times[self.name] = seconds
+        instrumentation = getattr(obj, "instrumentation", None)
+        if instrumentation is not None:
+            instrumentation.record("load." + self.name, seconds)
+        obj.__dict__[self.name] = value
+        return value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert csv/npz assets into the columnar asset format")
+    parser.add_argument("--asset-root", default=DEFAULT_ASSET_ROOT)
+    parser.add_argument("--columnar-root", default=None)
+    parser.add_argument("names", nargs="*", help="asset names to convert (default: every known asset)")
+    args = parser.parse_args()
+    converted = convert_assets(args.asset_root, args.names or None, args.columnar_root)
+    print("converted: ", converted)
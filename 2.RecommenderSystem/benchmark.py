@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+for folder in ["", "2.1 Content based filtering", "2.2 User based filtering", "2.3 Image embedding"]:
+    sys.path.append(os.path.join(ROOT, folder))
+from synthetic_data import generate_assets
+
+
+def measure(fn, *args, **kwargs):
+    '''
+    runs fn once, tracing its allocations
+    :returns
+        result of fn and dictionary of seconds and peak_alloc_mb(peak of the memory allocated by python/numpy during the call)
+    '''
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {"seconds": seconds, "peak_alloc_mb": peak / 2**20}
+
+
+def latencies(fn, queries):
+    '''
+    calls fn(query) for every query, untraced
+    :returns
+        dictionary of the number of queries and the mean/p50/p90/p99 latency in milliseconds
+    '''
+
+    times = np.zeros(len(queries))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        fn(query)
+        times[i] = time.perf_counter() - start
+    times *= 1000
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {"n": len(queries), "mean_ms": float(times.mean()), "p50_ms": float(p50), "p90_ms": float(p90), "p99_ms": float(p99)}
+
+
+def bench_cbf(asset_root, rng, n_queries, dense_limit, top_k=100):
+    '''
+    create_sim_mat on the title genres (dense below dense_limit titles, top-k index always) and recommend from 5 seeds
+    '''
+
+    from cbfilter import ContentBasedFiltering
+    builds, queries = {}, {}
+    genres = pd.read_csv(os.path.join(asset_root, "ryota_title_genre_2000p.csv")).set_index("title_id")
+    modes = [("dense", None), ("top_k", top_k)] if len(genres) <= dense_limit else [("top_k", top_k)]
+    for mode, k in modes:
+        cbf = ContentBasedFiltering(asset_root)
+        cbf.titles_df
+        _, builds["cbf_create_sim_mat_" + mode] = measure(cbf.create_sim_mat, genres, top_k=k)
+        seeds = [list(rng.choice(cbf.title_ids, 5, replace=False)) for _ in range(n_queries)]
+        cbf.recommend(seeds[0], k=20)
+        queries["cbf_recommend_" + mode] = latencies(lambda q: cbf.recommend(q, k=20), seeds)
+    return builds, queries
+
+
+def bench_ubf(asset_root, rng, n_queries):
+    '''
+    UserBasedFiltering asset loading, user index, similar users, unread titles and the item kNN query of the app
+    '''
+
+    from ubfilter import UserBasedFiltering
+    builds, queries = {}, {}
+    def load():
+        ubf = UserBasedFiltering(asset_root)
+        for asset in ["df_mlist", "df_user_genre_dist", "model", "title_pos", "title_idx_arr"]:
+            getattr(ubf, asset)
+        return ubf
+
+    ubf, builds["ubf_load_assets"] = measure(load)
+    _, builds["ubf_rebuild_user_index"] = measure(ubf.rebuild_user_index)
+    _, builds["ubf_rebuild_user_title_index"] = measure(ubf.rebuild_user_title_index)
+
+    user_ids = rng.choice(ubf.df_user_genre_dist["user_id"].values, n_queries)
+    queries["ubf_get_similar_users_from_user_id"] = latencies(lambda u: ubf.get_similar_users_from_user_id(1, query_user_id=u), user_ids)
+    similar = {u: ubf.get_similar_users_from_user_id(1, query_user_id=u) for u in user_ids}
+    queries["ubf_recommend_unread_titles"] = latencies(lambda u: ubf.recommend_unread_titles(10, similar[u], query_user_id=u), user_ids)
+    seeds = [list(rng.choice(ubf.title_idx_arr, 5, replace=False)) for _ in range(n_queries)]
+    queries["ubf_recommend_from_titles"] = latencies(lambda q: ubf.recommend_from_titles(q, n_titles=50), seeds)
+    return builds, queries
+
+
+def bench_ibf(asset_root, rng, n_queries, version="v2"):
+    '''
+    ImageBasedRecommendation.__init__ (embedding and title indexes) and its two queries
+    '''
+
+    from ibfilter import ImageBasedRecommendation
+    builds, queries = {}, {}
+    ibr, builds["ibf_init"] = measure(ImageBasedRecommendation, "", version, asset_root)
+    characters = rng.choice(ibr.chara_index.ids, n_queries)
+    titles = rng.choice(ibr.title_index.ids, n_queries)
+    queries["ibf_recommend_titles_from_similar_characters"] = latencies(lambda c: ibr.recommend_titles_from_similar_characters(c, 10), characters)
+    queries["ibf_recommend_titles_from_similar_image_embedding"] = latencies(lambda t: ibr.recommend_titles_from_similar_image_embedding(t, 10), titles)
+    return builds, queries
+
+
+BENCHMARKS = {"cbf": bench_cbf, "ubf": bench_ubf, "ibf": bench_ibf}
+
+
+def run_scale(scale, modules, n_queries=200, data_root=None, dense_limit=20000, random_state=0):
+    '''
+    generates the synthetic assets of one scale and benchmarks the modules on them.
+    Meant to run in its own process so that peak_rss_mb belongs to this scale only
+    :params
+        scale: multiplier of the current catalog size
+        modules: names of BENCHMARKS to run
+        n_queries: queries per latency measurement
+        data_root: folder to keep the generated assets in. None uses a temporary folder that is removed afterwards
+        dense_limit: the dense create_sim_mat is only benchmarked up to this many titles
+        random_state: seed of the data and of the queries
+    :returns
+        dictionary of the data sizes, build time/peak allocation per stage and latency percentiles per query
+    '''
+
+    asset_root = os.path.join(data_root, "scale_%g" % scale) if data_root else tempfile.mkdtemp(prefix="otaku_bench_")
+    try:
+        sizes, generate = measure(generate_assets, asset_root, scale, random_state)
+        result = {"scale": scale, "sizes": sizes, "builds": {"generate_assets": generate}, "queries": {}}
+        for name in modules:
+            rng = np.random.RandomState(random_state)
+            kwargs = {"dense_limit": dense_limit} if name == "cbf" else {}
+            builds, queries = BENCHMARKS[name](asset_root, rng, n_queries, **kwargs)
+            result["builds"].update(builds)
+            result["queries"].update(queries)
+        # ru_maxrss is in kilobytes on Linux
+        result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return result
+    finally:
+        if data_root is None:
+            shutil.rmtree(asset_root, ignore_errors=True)
+
+
+def environment():
+    '''
+    versions the results were measured with, to tell regressions from environment changes
+    '''
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "git_commit": commit or None, "python": platform.python_version(),
+            "numpy": np.__version__, "pandas": pd.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count()}
+
+
+def run(scales=(1, 10, 100), modules=("cbf", "ubf", "ibf"), n_queries=200, data_root=None, dense_limit=20000, out=None):
+    '''
+    Benchmarks every scale in a fresh process and writes the results as json
+    :params
+        scales: multipliers of the current catalog size
+        modules: names of BENCHMARKS to run
+        n_queries: queries per latency measurement
+        data_root: folder to keep the generated assets in. None generates them in temporary folders
+        dense_limit: the dense create_sim_mat is only benchmarked up to this many titles
+        out: json file to write the results to
+    :returns
+        dictionary of environment and results(one per scale)
+    '''
+
+    report = {"environment": environment(), "results": []}
+    for scale in scales:
+        with ProcessPoolExecutor(1) as pool:
+            report["results"].append(pool.submit(run_scale, scale, list(modules), n_queries, data_root, dense_limit).result())
+        if out:
+            with open(out, "w") as f:
+                json.dump(report, f, indent=2)
+    return report
+
+
+def compare(baseline, current, tolerance=0.2):
+    '''
+    stage by stage comparison of two benchmark reports(e.g. the json of two versions)
+    :params
+        baseline: report or path of its json
+        current: report or path of its json
+        tolerance: relative slowdown above which a row is flagged as a regression
+    :returns
+        dataframe of scale, stage, metric, baseline, current, ratio and regression
+    '''
+
+    def rows(report):
+        if isinstance(report, str):
+            with open(report) as f:
+                report = json.load(f)
+        for result in report["results"]:
+            for stage, values in result["builds"].items():
+                yield result["scale"], stage, "seconds", values["seconds"]
+                yield result["scale"], stage, "peak_alloc_mb", values["peak_alloc_mb"]
+            for stage, values in result["queries"].items():
+                yield result["scale"], stage, "p50_ms", values["p50_ms"]
+                yield result["scale"], stage, "p99_ms", values["p99_ms"]
+
+    key = ["scale", "stage", "metric"]
+    df = pd.DataFrame(rows(baseline), columns=key + ["baseline"]).merge(pd.DataFrame(rows(current), columns=key + ["current"]), on=key)
+    df["ratio"] = df["current"] / df["baseline"]
+    df["regression"] = df["ratio"] > 1 + tolerance
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="scaling benchmark of the recommenders on synthetic data")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100], help="multipliers of the current catalog size")
+    parser.add_argument("--modules", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--data-root", default=None, help="keep the generated assets here instead of temporary folders")
+    parser.add_argument("--dense-limit", type=int, default=20000)
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=None, help="json of a previous run to compare with")
+    args = parser.parse_args()
+
+    report = run(args.scales, args.modules, args.n_queries, args.data_root, args.dense_limit, args.out)
+    for result in report["results"]:
+        print("scale", result["scale"], result["sizes"])
+        print(pd.DataFrame(result["builds"]).T.to_string())
+        print(pd.DataFrame(result["queries"]).T.to_string())
+    if args.baseline:
+        print(compare(args.baseline, report).to_string())
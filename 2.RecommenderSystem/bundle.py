@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+MAGIC = b"OTAKUBND"
+FORMAT_VERSION = 1
+# arrays start on multiples of ALIGNMENT bytes, so that each one can be memory-mapped as is
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_bundle(path, arrays, kind, meta=None):
+    '''
+    Writes named arrays into a single bundle file:
+    MAGIC, the header length(uint64), a json header(format version, kind, meta and the name/dtype/shape/offset of
+    every array), then the raw arrays, each starting on an ALIGNMENT boundary.
+    The file is written next to path and renamed over it at the end, so readers never see a partial bundle
+    (processes that mapped the previous file keep reading it until they load the new one)
+    :params
+        path: bundle file
+        arrays: dictionary of name: numpy array (no object dtype)
+        kind: what the bundle holds, checked by Bundle(expected_kind=...)
+        meta: json-serializable settings/metadata stored with the arrays
+    :returns
+        it doesn't return but writes the file
+    '''
+
+    arrays = {name: np.ascontiguousarray(values) for name, values in arrays.items()}
+    for name, values in arrays.items():
+        if values.dtype.hasobject:
+            raise TypeError(f"array {name} has dtype object, convert it first (see frame_arrays)")
+
+    def header(offset):
+        table = {}
+        for name, values in arrays.items():
+            offset = _aligned(offset)
+            table[name] = {"dtype": values.dtype.str, "shape": list(values.shape), "offset": offset}
+            offset += values.nbytes
+        return {"format_version": FORMAT_VERSION, "kind": kind, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "meta": meta or {}, "arrays": table}
+
+    # the offsets depend on the header length: grow the reserved space until the header fits in it
+    reserved = ALIGNMENT
+    while True:
+        # numpy scalars in meta are stored as python numbers
+        encoded = json.dumps(header(len(MAGIC) + 8 + reserved), default=lambda value: value.item()).encode()
+        if len(encoded) <= reserved:
+            break
+        reserved = _aligned(len(encoded) * 2)
+    encoded = encoded.ljust(reserved)
+    table = header(len(MAGIC) + 8 + reserved)["arrays"]
+
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(reserved).tobytes())
+        f.write(encoded)
+        for name, values in arrays.items():
+            f.write(b"\0" * (table[name]["offset"] - f.tell()))
+            f.write(values.tobytes())
+    os.replace(tmp_path, path)
+
+
+class Bundle:
+    def __init__(self, path, expected_kind=None):
+        '''
+        Read-only view of a bundle written by write_bundle. The file is memory-mapped once and every array is a view
+        of it, so nothing is read until it is used and processes mapping the same bundle share its pages
+        :params
+            path: bundle file
+            expected_kind: raise ValueError if the bundle holds something else
+        '''
+
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a bundle")
+            length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(length).decode())
+        if header["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"{path} has bundle format {header['format_version']}, expected {FORMAT_VERSION}")
+        if expected_kind is not None and header["kind"] != expected_kind:
+            raise ValueError(f"{path} holds a {header['kind']} bundle, expected {expected_kind}")
+        self.path = path
+        self.kind = header["kind"]
+        self.created = header["created"]
+        self.meta = header["meta"]
+        self.table = header["arrays"]
+        self._mmap = np.memmap(path, dtype=np.uint8, mode="r")
+
+    def __contains__(self, name):
+        return name in self.table
+
+    def array(self, name):
+        '''
+        read-only memory-mapped array
+        '''
+
+        entry = self.table[name]
+        dtype = np.dtype(entry["dtype"])
+        n_bytes = int(np.prod(entry["shape"])) * dtype.itemsize
+        return self._mmap[entry["offset"]:entry["offset"]+n_bytes].view(dtype).reshape(entry["shape"])
+
+    def sparse(self, prefix):
+        '''
+        csr_matrix stored by sparse_arrays (its components are memory-mapped)
+        '''
+
+        return sparse.csr_matrix((self.array(prefix + ".data"), self.array(prefix + ".indices"), self.array(prefix + ".indptr")),
+                                 shape=tuple(self.meta[prefix]["shape"]), copy=False)
+
+    def frame(self, prefix, columns=None, as_category=False):
+        '''
+        dataframe stored by frame_arrays
+        :params
+            prefix: name it was stored under
+            columns: names of the columns to load. None loads all of them
+            as_category: whether to keep string columns as pandas categoricals(object columns otherwise, as read_csv)
+        '''
+
+        data = {}
+        for i, col in enumerate(self.meta[prefix]["columns"]):
+            if columns is not None and col["name"] not in columns:
+                continue
+            name = f"{prefix}.{i}"
+            if col["kind"] == "numeric":
+                data[col["name"]] = self.array(name)
+            else:
+                values = pd.Categorical.from_codes(self.array(name + ".codes"), self.array(name + ".categories"))
+                data[col["name"]] = values if as_category else np.asarray(values, dtype=object)
+        # copy=False keeps the columns as views of the bundle instead of consolidating them into new blocks
+        return pd.DataFrame(data, copy=False)
+
+    def arrays(self, prefix):
+        '''
+        dictionary of the arrays stored by dict_arrays under prefix (key: memory-mapped array)
+        '''
+
+        return {name[len(prefix)+1:]: self.array(name) for name in self.table if name.startswith(prefix + ".")}
+
+
+def dict_arrays(prefix, values):
+    '''
+    arrays storing the array values of a dictionary(e.g. an index) in a bundle (read back with Bundle.arrays)
+    '''
+
+    return {f"{prefix}.{key}": value for key, value in values.items() if isinstance(value, np.ndarray)}
+
+
+def sparse_arrays(prefix, mat):
+    '''
+    arrays and meta storing a sparse matrix in a bundle (read back with Bundle.sparse)
+    '''
+
+    mat = sparse.csr_matrix(mat)
+    arrays = {prefix + ".data": mat.data, prefix + ".indices": mat.indices, prefix + ".indptr": mat.indptr}
+    return arrays, {prefix: {"shape": list(mat.shape)}}
+
+
+def frame_arrays(prefix, df):
+    '''
+    arrays and meta storing a dataframe in a bundle (read back with Bundle.frame): numeric columns as they are,
+    other columns as int32 categorical codes and their categories as fixed-width strings
+    '''
+
+    arrays, columns = {}, []
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        name = f"{prefix}.{i}"
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            arrays[name] = values.values
+            columns.append({"name": col, "kind": "numeric"})
+        else:
+            categorical = pd.Categorical(values)
+            arrays[name + ".codes"] = categorical.codes.astype(np.int32)
+            arrays[name + ".categories"] = np.array(categorical.categories, dtype=str)
+            columns.append({"name": col, "kind": "categorical"})
+    return arrays, {prefix: {"columns": columns}}
+
+
+class BundleAssetStore:
+    def __init__(self, bundle, fallback=None):
+        '''
+        AssetStore interface over the tables/matrices/arrays of a bundle, so that LazyAsset attributes load from it.
+        Assets missing from the bundle are loaded from fallback(an AssetStore) if given
+        :params
+            bundle: Bundle
+            fallback: AssetStore for the assets the bundle doesn't hold
+        '''
+
+        self.bundle = bundle
+        self.fallback = fallback
+        self.load_times = {}
+
+    def _missing(self, name):
+        if self.fallback is None:
+            raise KeyError(f"{name} is not in {self.bundle.path}")
+        return self.fallback
+
+    def load_frame(self, name, columns=None, as_category=False):
+        if name not in self.bundle.meta:
+            return self._missing(name).load_frame(name, columns, as_category)
+        return self.bundle.frame(name, columns, as_category)
+
+    def load_sparse(self, name):
+        if name not in self.bundle.meta:
+            return self._missing(name).load_sparse(name)
+        return self.bundle.sparse(name)
+
+    def load_array(self, name):
+        if name not in self.bundle:
+            return self._missing(name).load_array(name)
+        return self.bundle.array(name)
+
+    def report_load_times(self):
+        return pd.Series(self.load_times, name="seconds", dtype=float)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="header and arrays of a bundle (written by the save_bundle methods of the recommenders)")
+    parser.add_argument("path")
+    args = parser.parse_args()
+
+    bundle = Bundle(args.path)
+    print(f"{bundle.kind} bundle, format {FORMAT_VERSION}, created {bundle.created}, {os.path.getsize(args.path) / 2**20:.1f} MB")
+    for name, entry in bundle.table.items():
+        print(f"  {name:40s} {entry['dtype']:6s} {str(tuple(entry['shape'])):20s} {bundle.array(name).nbytes / 2**20:10.2f} MB")
@@ -0,0 +1,227 @@
+import json
+import time
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+
+class _NullStage:
+    # returned by Instrumentation.stage while disabled: entering/exiting it does nothing
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("instrumentation", "name", "start", "allocated")
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.allocated = tracemalloc.get_traced_memory()[0] if self.instrumentation.trace_allocations else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        allocated = None
+        if self.allocated is not None and tracemalloc.is_tracing():
+            allocated = tracemalloc.get_traced_memory()[0] - self.allocated
+        self.instrumentation.record(self.name, seconds, allocated)
+        return False
+
+
+class Instrumentation:
+    def __init__(self, enabled=False, trace_allocations=False, namespace="otaku"):
+        '''
+        Opt-in per-stage timers, counters and allocation snapshots of the recommenders.
+        While disabled, stage() returns a shared no-op context manager and count() returns at once,
+        so instrumented code costs one attribute check per stage
+        :params
+            enabled: whether to record anything
+            trace_allocations: also record the net memory allocated by each stage(starts tracemalloc, slower)
+            namespace: prefix of the exported metric names
+        '''
+
+        self.namespace = namespace
+        self.enabled = False
+        self.trace_allocations = False
+        self._started_tracing = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+        if enabled:
+            self.enable(trace_allocations)
+
+    def enable(self, trace_allocations=False):
+        self.enabled = True
+        self.trace_allocations = trace_allocations
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def disable(self):
+        self.enabled = False
+        self.trace_allocations = False
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def reset(self):
+        '''
+        forgets every recorded stage and counter
+        '''
+
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+
+    def stage(self, name):
+        '''
+        context manager timing a block of code under name, e.g. with instrumentation.stage("ubf.neighbors"): ...
+        '''
+
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, seconds, allocated_bytes=None):
+        '''
+        adds one measurement of a stage(used by stage(), or directly for timings measured elsewhere)
+        :params
+            name: stage name
+            seconds: time spent
+            allocated_bytes: net memory allocated by the stage, None if not traced
+        '''
+
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = {"count": 0, "seconds_sum": 0.0, "seconds_max": 0.0, "allocated_bytes_sum": 0}
+            stats["count"] += 1
+            stats["seconds_sum"] += seconds
+            stats["seconds_max"] = max(stats["seconds_max"], seconds)
+            if allocated_bytes is not None:
+                stats["allocated_bytes_sum"] += allocated_bytes
+        request = getattr(self._local, "request", None)
+        if request is not None:
+            request["stages"].append({"stage": name, "seconds": seconds, "allocated_bytes": allocated_bytes})
+
+    def count(self, name, n=1):
+        '''
+        increments a counter, e.g. cache hits or brute force fallbacks
+        '''
+
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        request = getattr(self._local, "request", None)
+        if request is not None:
+            request["counters"][name] = request["counters"].get(name, 0) + n
+
+    @contextmanager
+    def request(self, name):
+        '''
+        collects the stages and counters recorded by the current thread while the block runs,
+        e.g. one recommendation of a Streamlit session
+        :params
+            name: name of the request
+        :returns
+            dictionary of name, seconds, stages(list in recording order) and counters, filled when the block exits
+        '''
+
+        request = {"name": name, "seconds": None, "stages": [], "counters": {}}
+        if not self.enabled:
+            yield request
+            return
+        outer = getattr(self._local, "request", None)
+        self._local.request = request
+        start = time.perf_counter()
+        try:
+            yield request
+        finally:
+            request["seconds"] = time.perf_counter() - start
+            self._local.request = outer
+
+    def snapshot(self, top=10):
+        '''
+        lines of code holding the most memory right now (requires trace_allocations)
+        :returns
+            dataframe of location, size_bytes and count
+        '''
+
+        if not tracemalloc.is_tracing():
+            return pd.DataFrame(columns=["location", "size_bytes", "count"])
+        stats = tracemalloc.take_snapshot().statistics("lineno")[:top]
+        return pd.DataFrame({"location": [str(s.traceback) for s in stats],
+                             "size_bytes": [s.size for s in stats],
+                             "count": [s.count for s in stats]})
+
+    def summary(self):
+        '''
+        recorded stages, slowest total first
+        :returns
+            dataframe indexed by stage with count, seconds_sum, seconds_mean, seconds_max and allocated_bytes_sum
+        '''
+
+        with self._lock:
+            df = pd.DataFrame.from_dict(self.stages, orient="index", columns=["count", "seconds_sum", "seconds_max", "allocated_bytes_sum"])
+        df.insert(2, "seconds_mean", df["seconds_sum"] / df["count"])
+        return df.sort_values("seconds_sum", ascending=False)
+
+    def log(self, logger=None, level=logging.INFO):
+        '''
+        writes one structured(json) log line per stage and one with the counters
+        :params
+            logger: logging.Logger, default the "instrumentation" logger
+            level: logging level
+        '''
+
+        logger = logger or logging.getLogger("instrumentation")
+        with self._lock:
+            stages = {name: dict(stats) for name, stats in self.stages.items()}
+            counters = dict(self.counters)
+        for name, stats in stages.items():
+            logger.log(level, json.dumps({"type": "stage", "stage": name, **stats}))
+        logger.log(level, json.dumps({"type": "counters", "counters": counters}))
+
+    def prometheus(self):
+        '''
+        recorded stages and counters in the Prometheus text exposition format
+        :returns
+            string
+        '''
+
+        prefix = self.namespace
+        with self._lock:
+            stages = {name: dict(stats) for name, stats in self.stages.items()}
+            counters = dict(self.counters)
+        lines = [f"# TYPE {prefix}_stage_seconds summary"]
+        for name, stats in stages.items():
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stats["seconds_sum"]}')
+        lines.append(f"# TYPE {prefix}_stage_seconds_max gauge")
+        for name, stats in stages.items():
+            lines.append(f'{prefix}_stage_seconds_max{{stage="{name}"}} {stats["seconds_max"]}')
+        if self.trace_allocations:
+            lines.append(f"# TYPE {prefix}_stage_allocated_bytes counter")
+            for name, stats in stages.items():
+                lines.append(f'{prefix}_stage_allocated_bytes{{stage="{name}"}} {stats["allocated_bytes_sum"]}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, value in counters.items():
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
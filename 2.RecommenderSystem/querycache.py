@@ -0,0 +1,245 @@
+import sys
+import time
+import itertools
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# a distinct token per recommender object, so that one cache can serve several of them
+_owner_tokens = itertools.count()
+
+
+def canonical_key(seeds=None, unique=False, **params):
+    '''
+    hashable form of a query: the sorted seed ids and the sorted parameters,
+    so that the same basket in another order(or with other list types) hits the same entry
+    :params
+        seeds: seed ids of the query (a single id is a one-seed query)
+        unique: whether duplicated seeds are the same query (True where the method ignores duplicates)
+        params: every other argument the result depends on(k, method, filters, ...)
+    :returns
+        tuple
+    '''
+
+    if seeds is not None:
+        seeds = np.atleast_1d(np.asarray(seeds)).tolist()
+        seeds = tuple(sorted(set(seeds) if unique else seeds))
+    return seeds, tuple(sorted((name, _hashable(value)) for name, value in params.items()))
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple, set, np.ndarray)):
+        return tuple(sorted(_hashable(v) for v in value)) if isinstance(value, set) else tuple(_hashable(v) for v in value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def sizeof(value):
+    '''
+    approximate bytes held by a cached value (arrays, frames and containers of them are walked)
+    '''
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes + 112
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(deep=True))
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+def _compact(value):
+    # a view(e.g. one row of a batch result) keeps its whole base array alive while sizeof only counts the view:
+    # cached arrays are copied out of their base, so that max_bytes bounds the memory the cache really holds
+    if isinstance(value, np.ndarray):
+        return value.copy() if value.base is not None else value
+    if isinstance(value, tuple):
+        return tuple(_compact(v) for v in value)
+    if isinstance(value, list):
+        return [_compact(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _compact(v) for k, v in value.items()}
+    return value
+
+
+def _freeze(value):
+    # cached arrays are shared by every hit: make them read-only so a caller cannot modify them in place
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _freeze(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _freeze(v)
+    return value
+
+
+def _thaw(value):
+    # frames cannot be made read-only, hand out copies of them instead
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple(_thaw(v) for v in value)
+    if isinstance(value, list):
+        return [_thaw(v) for v in value]
+    return value
+
+
+class QueryCache:
+    def __init__(self, max_bytes=64*2**20, ttl=None, instrumentation=None):
+        '''
+        Bounded LRU cache of query results, shared by the recommenders that are given it.
+        Entries are keyed on (recommender, method, canonical query) and stamped with the model version they were computed
+        with: a lookup under another version drops the entry. The cache is capped in bytes(see sizeof), the least
+        recently used entries are evicted first, and entries older than ttl seconds expire
+        :params
+            max_bytes: memory cap of the cached results
+            ttl: seconds an entry stays valid. None never expires them
+            instrumentation: also counts cache.hits/misses/evictions/invalidations/expirations there (see instrumentation.py)
+        '''
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.instrumentation = instrumentation
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.counts = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "expirations": 0, "rejected": 0}
+
+    def _count(self, name):
+        self.counts[name] += 1
+        if self.instrumentation is not None:
+            self.instrumentation.count("cache." + name)
+
+    @staticmethod
+    def owner_token(owner):
+        '''
+        token identifying a recommender object in the keys (assigned on first use, kept by its snapshots)
+        '''
+
+        token = owner.__dict__.get("_query_cache_token")
+        if token is None:
+            token = owner._query_cache_token = next(_owner_tokens)
+        return token
+
+    def get(self, key, version):
+        '''
+        :returns
+            whether the key is cached for this version, and the cached value (None on a miss)
+        '''
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, entry_version, nbytes, expires = entry
+                if entry_version != version:
+                    self._drop(key, nbytes)
+                    self._count("invalidations")
+                elif expires is not None and expires < time.monotonic():
+                    self._drop(key, nbytes)
+                    self._count("expirations")
+                else:
+                    self._entries.move_to_end(key)
+                    self._count("hits")
+                    return True, _thaw(value)
+            self._count("misses")
+        return False, None
+
+    def put(self, key, version, value):
+        '''
+        caches value under key for this model version, evicting the least recently used entries above max_bytes.
+        Values larger than max_bytes are not cached
+        :returns
+            the value as cached (array views copied out of their base and made read-only)
+        '''
+
+        value = _compact(value)
+        nbytes = sizeof(key) + sizeof(value)
+        if nbytes > self.max_bytes:
+            with self._lock:
+                self._count("rejected")
+            return value
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._drop(key, self._entries[key][2])
+            self._entries[key] = (_freeze(value), version, nbytes, expires)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                old_key, old_entry = next(iter(self._entries.items()))
+                self._drop(old_key, old_entry[2])
+                self._count("evictions")
+        return value
+
+    def _drop(self, key, nbytes):
+        del self._entries[key]
+        self.bytes -= nbytes
+
+    def call(self, owner, method, version, query, compute):
+        '''
+        cached result of one query, computed with compute() on a miss
+        :params
+            owner: recommender object the query runs on
+            method: name of the query method
+            version: current model version of owner
+            query: canonical form of the query (see canonical_key)
+            compute: function returning the result
+        '''
+
+        key = (self.owner_token(owner), method, query)
+        hit, value = self.get(key, version)
+        if hit:
+            return value
+        value = self.put(key, version, compute())
+        return _thaw(value)
+
+    def call_batch(self, owner, method, version, queries, compute_missing):
+        '''
+        cached results of a batch of queries: only the missing ones are computed, in one call
+        :params
+            owner: recommender object the queries run on
+            method: name of the query method
+            version: current model version of owner
+            queries: canonical form of every query (see canonical_key)
+            compute_missing: function of the positions of the missing queries returning their results, in the same order
+        :returns
+            list of one result per query
+        '''
+
+        token = self.owner_token(owner)
+        results, missing = [None] * len(queries), []
+        for i, query in enumerate(queries):
+            hit, value = self.get((token, method, query), version)
+            if hit:
+                results[i] = value
+            else:
+                missing.append(i)
+        if missing:
+            for i, value in zip(missing, compute_missing(missing)):
+                results[i] = _thaw(self.put((token, method, queries[i]), version, value))
+        return results
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        '''
+        :returns
+            dictionary of the hit/miss/eviction/invalidation/expiration/rejected counts, hit_rate, entries, bytes and max_bytes
+        '''
+
+        with self._lock:
+            counts = dict(self.counts)
+            lookups = counts["hits"] + counts["misses"]
+            return {**counts, "hit_rate": counts["hits"] / lookups if lookups else None,
+                    "entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes}
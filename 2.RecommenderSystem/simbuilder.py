@@ -0,0 +1,257 @@
+import os
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+from sklearn.metrics.pairwise import manhattan_distances
+
+METRICS = ["cosine", "euclidean", "manhattan"]
+
+
+def _save_input(X, metric, folder):
+    '''
+    writes the (preprocessed) rows as .npy files the workers memory-map: the dense array, or the three arrays of a csr matrix.
+    Cosine rows are L2-normalized here once, euclidean gets the squared row norms
+    :returns
+        dictionary describing the saved input (see _load_input)
+    '''
+
+    if sparse.issparse(X):
+        X = sparse.csr_matrix(X, dtype=np.float32)
+        sq_norms = np.asarray(X.multiply(X).sum(axis=1)).ravel()
+    else:
+        X = np.asarray(X, dtype=np.float32)
+        sq_norms = (X ** 2).sum(axis=1)
+    if metric == "cosine":
+        norms = np.sqrt(sq_norms)
+        norms[norms == 0] = 1
+        X = sparse.diags(1 / norms).dot(X).tocsr() if sparse.issparse(X) else X / norms[:, None]
+    spec = {"folder": folder, "shape": X.shape, "sparse": sparse.issparse(X)}
+    if spec["sparse"]:
+        for name in ["data", "indices", "indptr"]:
+            np.save(os.path.join(folder, "X_" + name + ".npy"), getattr(X, name))
+    else:
+        np.save(os.path.join(folder, "X.npy"), X)
+    np.save(os.path.join(folder, "sq_norms.npy"), sq_norms.astype(np.float32))
+    return spec
+
+
+def _load_input(spec):
+    '''
+    memory-maps the rows saved by _save_input(read-only, so the pages are shared between the workers)
+    '''
+
+    folder = spec["folder"]
+    if spec["sparse"]:
+        arrays = [np.load(os.path.join(folder, "X_" + name + ".npy"), mmap_mode="r") for name in ["data", "indices", "indptr"]]
+        X = sparse.csr_matrix(tuple(arrays), shape=spec["shape"])
+    else:
+        X = np.load(os.path.join(folder, "X.npy"), mmap_mode="r")
+    return X, np.load(os.path.join(folder, "sq_norms.npy"), mmap_mode="r")
+
+
+def _pairwise_tile(X, sq_norms, rows, cols, metric):
+    '''
+    similarity(cosine) or distance(euclidean, manhattan) between the rows rows and cols of X, as a dense float32 tile
+    '''
+
+    A, B = X[rows[0]:rows[-1]+1], X[cols[0]:cols[-1]+1]
+    if metric == "manhattan":
+        return manhattan_distances(A, B).astype(np.float32)
+    dot = A @ B.T
+    dot = dot.toarray() if sparse.issparse(dot) else np.asarray(dot)
+    if metric == "cosine":
+        return dot.astype(np.float32)
+    sq_dist = sq_norms[rows][:, None] + sq_norms[cols][None, :] - 2 * dot
+    return np.sqrt(np.maximum(sq_dist, 0)).astype(np.float32)
+
+
+def top_k_positions(values, k, largest=True):
+    '''
+    positions of the k best values of each row, best first (argpartition instead of a full sort).
+    Shared by the recommenders for every top-k selection
+    :params
+        values: 2d array of scores(or a 1d array, one row)
+        k: how many positions to keep per row
+        largest: whether higher values are better
+    :returns
+        2d array of column positions(1d for a 1d values)
+    '''
+
+    if values.ndim == 1:
+        return top_k_positions(values[None, :], k, largest)[0]
+    k = min(k, values.shape[1])
+    if k <= 0:
+        return np.zeros((values.shape[0], 0), dtype=np.intp)
+    keyed = -values if largest else values
+    part = np.argpartition(keyed, k-1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(keyed, part, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
+def _merge_top_k(best_idx, best_values, idx, values, k, largest):
+    # keeps the k best of the running best and the new candidates, best first
+    idx = np.hstack([best_idx, idx])
+    values = np.hstack([best_values, values])
+    part = top_k_positions(values, k, largest)
+    return np.take_along_axis(idx, part, axis=1), np.take_along_axis(values, part, axis=1)
+
+
+_worker = {}
+
+
+def _init_worker(spec):
+    _worker["X"], _worker["sq_norms"] = _load_input(spec)
+    _worker["spec"] = spec
+
+
+def _run_tile(start, stop, metric, top_k, threshold, tile_size, exclude_self, out):
+    '''
+    computes rows start:stop against every row, column tile by column tile, and writes their output straight to disk:
+    - top-k mode: rows start:stop of the neighbors.npy/values.npy memmaps in out
+    - threshold mode: tile_<start>.npz in out, the entries that pass the threshold(limited to top_k per row if given)
+    so that at most (stop-start) x tile_size similarities exist at once
+    '''
+
+    X, sq_norms = _worker["X"], _worker["sq_norms"]
+    n = X.shape[0]
+    largest = metric == "cosine"
+    worst = -np.inf if largest else np.inf
+    rows = np.arange(start, stop)
+    k = min(top_k, n - exclude_self) if top_k else None
+    best_idx = np.zeros((len(rows), 0), dtype=np.int64)
+    best_values = np.zeros((len(rows), 0), dtype=np.float32)
+    kept_rows, kept_cols, kept_values = [], [], []
+
+    for col_start in range(0, n, tile_size):
+        cols = np.arange(col_start, min(col_start+tile_size, n))
+        tile = _pairwise_tile(X, sq_norms, rows, cols, metric)
+        if exclude_self:
+            # a row is never its own neighbor
+            r = rows[(rows >= cols[0]) & (rows <= cols[-1])]
+            tile[r - start, r - col_start] = worst
+        if threshold is not None:
+            passed = tile >= threshold if largest else tile <= threshold
+            tile = np.where(passed, tile, worst)
+            if k is None:
+                r, c = np.nonzero(passed)
+                kept_rows.append(r)
+                kept_cols.append(cols[c])
+                kept_values.append(tile[r, c])
+                continue
+        best_idx, best_values = _merge_top_k(best_idx, best_values, np.broadcast_to(cols, tile.shape), tile, k, largest)
+
+    if threshold is None:
+        neighbors = np.load(os.path.join(out, "neighbors.npy"), mmap_mode="r+")
+        values = np.load(os.path.join(out, "values.npy"), mmap_mode="r+")
+        neighbors[start:stop] = best_idx
+        values[start:stop] = best_values
+        neighbors.flush()
+        values.flush()
+    else:
+        if k is not None:
+            valid = np.isfinite(best_values)
+            kept_rows, kept_cols, kept_values = [np.nonzero(valid)[0]], [best_idx[valid]], [best_values[valid]]
+        tile = sparse.csr_matrix((np.concatenate(kept_values) if kept_values else np.zeros(0, dtype=np.float32),
+                                  (np.concatenate(kept_rows) if kept_rows else np.zeros(0, dtype=int),
+                                   np.concatenate(kept_cols) if kept_cols else np.zeros(0, dtype=int))), shape=(len(rows), n))
+        sparse.save_npz(os.path.join(out, "tile_%d.npz" % start), tile)
+    return start, stop
+
+
+def build_neighbors(X, metric="cosine", top_k=100, threshold=None, n_workers=None, tile_size=1024, out_dir=None, exclude_self=True):
+    '''
+    Builds the top-k neighbors(or the thresholded similarities) of every row of X against every other row, tile by tile,
+    without ever holding the full n x n matrix. Row tiles run on a process pool; the workers memory-map the
+    preprocessed rows and write their output to disk as they finish
+    :params
+        X: (n x dim) dense array or sparse matrix
+        metric: "cosine"(similarity, higher is better), "euclidean" or "manhattan"(distances, lower is better)
+        top_k: neighbors to keep per row. With a threshold it only caps the entries per row, None keeps all of them
+        threshold: keep the entries whose similarity is >= threshold(cosine) or distance <= threshold, as a sparse matrix
+        n_workers: worker processes. Default is os.cpu_count(), 1 runs the tiles in this process
+        tile_size: rows(and columns) per tile
+        out_dir: folder to write the output to(memory-mapped from there). None builds it in a temporary folder
+            and returns it in memory
+        exclude_self: whether a row can be its own neighbor
+    :returns
+        top-k mode: dictionary of "neighbors"((n x k) int32 row positions, best first) and "values"((n x k) float32)
+        threshold mode: (n x n) float32 csr_matrix, also saved as out_dir/similarity.npz
+    '''
+
+    if metric not in METRICS:
+        raise ValueError(f"metric not in {METRICS}")
+    if top_k is None and threshold is None:
+        raise ValueError("top_k or threshold is required")
+    n_workers = n_workers or os.cpu_count()
+    folder = out_dir or tempfile.mkdtemp(prefix="otaku_sim_")
+    os.makedirs(folder, exist_ok=True)
+    input_dir = tempfile.mkdtemp(prefix="input_", dir=folder)
+    try:
+        spec = _save_input(X, metric, input_dir)
+        n = spec["shape"][0]
+        if threshold is None:
+            k = min(top_k, n - exclude_self)
+            np.lib.format.open_memmap(os.path.join(folder, "neighbors.npy"), mode="w+", dtype=np.int32, shape=(n, k)).flush()
+            np.lib.format.open_memmap(os.path.join(folder, "values.npy"), mode="w+", dtype=np.float32, shape=(n, k)).flush()
+
+        tiles = [(start, min(start+tile_size, n)) for start in range(0, n, tile_size)]
+        args = (metric, top_k, threshold, tile_size, exclude_self, folder)
+        if n_workers == 1:
+            _init_worker(spec)
+            for start, stop in tiles:
+                _run_tile(start, stop, *args)
+            _worker.clear()
+        else:
+            with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(spec,)) as pool:
+                for future in [pool.submit(_run_tile, start, stop, *args) for start, stop in tiles]:
+                    future.result()
+
+        if threshold is None:
+            result = {name: np.load(os.path.join(folder, name + ".npy"), mmap_mode="r" if out_dir else None)
+                      for name in ["neighbors", "values"]}
+        else:
+            paths = [os.path.join(folder, "tile_%d.npz" % start) for start, _ in tiles]
+            result = sparse.vstack([sparse.load_npz(path) for path in paths]).tocsr()
+            for path in paths:
+                os.remove(path)
+            sparse.save_npz(os.path.join(folder, "similarity.npz"), result)
+        return result
+    finally:
+        shutil.rmtree(input_dir, ignore_errors=True)
+        if out_dir is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def neighbors_to_csr(neighbors, values):
+    '''
+    (n x n) csr_matrix holding the top-k table of build_neighbors(e.g. to save it in the latent_sim.npz format)
+    '''
+
+    n, k = neighbors.shape
+    return sparse.csr_matrix((np.asarray(values).ravel(), np.asarray(neighbors).ravel(), np.arange(0, n*k+1, k)), shape=(n, n))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="parallel tiled top-k / thresholded similarity build, e.g. latent_sim.npz")
+    parser.add_argument("features", help=".npy dense or .npz sparse (titles x features) matrix")
+    parser.add_argument("out", help="output .npz(csr matrix, as read by SimilarityScorer)")
+    parser.add_argument("--metric", default="cosine", choices=METRICS)
+    parser.add_argument("--top-k", type=int, default=100)
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--tile-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    X = sparse.load_npz(args.features) if args.features.endswith(".npz") else np.load(args.features, mmap_mode="r")
+    work_dir = tempfile.mkdtemp(prefix="otaku_sim_", dir=os.path.dirname(os.path.abspath(args.out)))
+    try:
+        result = build_neighbors(X, args.metric, args.top_k, args.threshold, args.workers, args.tile_size, work_dir)
+        if args.threshold is None:
+            result = neighbors_to_csr(result["neighbors"], result["values"])
+        sparse.save_npz(args.out, result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"{result.shape[0]} rows, {result.nnz} entries -> {args.out}")
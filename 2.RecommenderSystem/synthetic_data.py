@@ -0,0 +1,229 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from assetstore import convert_assets
+
+# sizes of the current catalog(scale 1), see the notebooks of 0.Data Retrieval and 2.2 User based filtering
+BASE_SIZES = {"n_titles": 2000, "n_users": 6700, "mean_list_length": 50, "characters_per_title": 10, "embedding_dim": 128}
+
+GENRES = ["Action", "Comedy", "Drama", "Fantasy", "Romance", "Slice of Life", "Adventure", "Sci-Fi", "Supernatural",
+          "Mystery", "Ecchi", "Sports", "Psychological", "Mecha", "Music", "Horror", "Mahou Shoujo", "Thriller"]
+STATUSES = ["COMPLETED", "PLANNING", "CURRENT", "DROPPED", "PAUSED", "REPEATING"]
+STATUS_PROBS = [0.55, 0.25, 0.1, 0.05, 0.04, 0.01]
+
+
+def zipf_weights(n, exponent):
+    '''
+    normalized weights of a power law over n ranks (rank 0 heaviest)
+    '''
+
+    weights = 1 / np.arange(1, n+1) ** exponent
+    return weights / weights.sum()
+
+
+def weighted_draws(weights, n, rng):
+    '''
+    n positions drawn with replacement with the given weights (vectorized inverse cdf)
+    '''
+
+    cdf = np.cumsum(weights)
+    return np.minimum(np.searchsorted(cdf, rng.random_sample(n) * cdf[-1], side="right"), len(weights)-1)
+
+
+def generate_titles(n_titles, rng, popularity_exponent=0.8, max_genres=4):
+    '''
+    Titles with power law popularity and 1 to max_genres genres each(common genres are drawn more often)
+    :params
+        n_titles: number of titles
+        rng: numpy RandomState
+        popularity_exponent: exponent of the popularity power law
+        max_genres: maximum genres per title
+    :returns
+        df_titles: title_id, title_romaji, title_english, popularity, favorites (titles_2000p format)
+        df_title_genre: title_id and one 0/1 column per genre (ryota_title_genre_2000p format)
+    '''
+
+    title_ids = np.sort(rng.choice(np.arange(1, 20*n_titles+1), n_titles, replace=False))
+    popularity = np.rint(zipf_weights(n_titles, popularity_exponent)[rng.permutation(n_titles)] * 500 * n_titles).astype(int) + 200
+    english = np.array(["Title %d" % t for t in title_ids], dtype=object)
+    english[rng.random_sample(n_titles) < 0.3] = np.nan
+    df_titles = pd.DataFrame({"title_id": title_ids,
+                              "title_romaji": ["Sakuhin %d" % t for t in title_ids],
+                              "title_english": english,
+                              "popularity": popularity,
+                              "favorites": (popularity * rng.beta(1, 20, n_titles)).astype(int)})
+
+    genre_draws = weighted_draws(zipf_weights(len(GENRES), 0.7), n_titles*max_genres, rng).reshape(n_titles, max_genres)
+    n_genres = 1 + rng.binomial(max_genres-1, 0.4, n_titles)
+    genre_mat = np.zeros((n_titles, len(GENRES)), dtype=int)
+    rows, cols = np.nonzero(np.arange(max_genres) < n_genres[:, None])
+    genre_mat[rows, genre_draws[rows, cols]] = 1
+    df_title_genre = pd.DataFrame(genre_mat, columns=GENRES)
+    df_title_genre.insert(0, "title_id", title_ids)
+    return df_titles, df_title_genre
+
+
+def generate_media_lists(df_titles, df_title_genre, n_users, mean_list_length, rng, genre_affinity=0.6, duplicate_rate=0.02):
+    '''
+    Media lists with log-normal list lengths; every user has a favorite genre and draws genre_affinity of
+    the list from titles of that genre, the rest from all titles, both weighted by popularity
+    :params
+        df_titles: output of generate_titles
+        df_title_genre: output of generate_titles
+        n_users: number of users
+        mean_list_length: average number of rows per user
+        rng: numpy RandomState
+        genre_affinity: share of a list drawn from the favorite genre
+        duplicate_rate: share of rows repeated, like the duplicate rows of the crawled lists
+    :returns
+        dataframe of list_id, user_id, title_id, status, repeat (media_list_all_users format, duplicates included)
+    '''
+
+    n_titles = len(df_titles)
+    user_ids = np.sort(rng.choice(np.arange(1, 20*n_users+1), n_users, replace=False))
+    sigma = 1.0
+    lengths = rng.lognormal(np.log(mean_list_length) - sigma**2/2, sigma, n_users)
+    lengths = np.clip(np.rint(lengths), 1, n_titles).astype(int)
+    row_users = np.repeat(np.arange(n_users), lengths)
+
+    popularity = df_titles["popularity"].values.astype(float)
+    title_pos = weighted_draws(popularity, len(row_users), rng)
+
+    # rows of the favorite genre, redrawn among that genre's titles
+    genre_mat = df_title_genre[GENRES].values
+    favorite = weighted_draws(genre_mat.sum(axis=0), n_users, rng)
+    from_genre = rng.random_sample(len(row_users)) < genre_affinity
+    for g in range(len(GENRES)):
+        rows = np.nonzero(from_genre & (favorite[row_users] == g))[0]
+        members = np.nonzero(genre_mat[:, g])[0]
+        if len(rows) and len(members):
+            title_pos[rows] = members[weighted_draws(popularity[members], len(rows), rng)]
+
+    # a title appears once per list, then a few rows are duplicated
+    pairs = np.unique(row_users.astype(np.int64)*n_titles + title_pos)
+    pairs = np.concatenate([pairs, rng.choice(pairs, int(len(pairs)*duplicate_rate))])
+    pairs = pairs[rng.permutation(len(pairs))]
+    pairs = pairs[np.argsort(pairs // n_titles, kind="mergesort")]
+    row_users, title_pos = pairs // n_titles, pairs % n_titles
+    return pd.DataFrame({"list_id": np.arange(len(pairs)),
+                         "user_id": user_ids[row_users],
+                         "title_id": df_titles["title_id"].values[title_pos],
+                         "status": np.array(STATUSES)[weighted_draws(np.array(STATUS_PROBS), len(pairs), rng)],
+                         "repeat": rng.geometric(0.9, len(pairs)) - 1})
+
+
+def genre_tables(df_mlist, df_title_genre):
+    '''
+    per-user genre counts and distributions of the media lists
+    :returns
+        df_mlist_genre: user_id, mlist_count and the genre counts (ryota_media_list_genre format)
+        df_user_genre_dist: user_id and the genre counts / mlist_count (ryota_user_genre_dist format)
+    '''
+
+    title_pos = pd.Series(np.arange(len(df_title_genre)), index=df_title_genre["title_id"].values)
+    user_ids, user_rows = np.unique(df_mlist["user_id"].values, return_inverse=True)
+    title_rows = title_pos.reindex(df_mlist["title_id"].values).values.astype(int)
+    counts = sparse.csr_matrix((np.ones(len(user_rows)), (user_rows, title_rows)), shape=(len(user_ids), len(title_pos))) @ df_title_genre[GENRES].values
+    mlist_count = np.bincount(user_rows, minlength=len(user_ids))
+
+    df_mlist_genre = pd.DataFrame(counts.astype(int), columns=GENRES)
+    df_mlist_genre.insert(0, "mlist_count", mlist_count)
+    df_mlist_genre.insert(0, "user_id", user_ids)
+    df_user_genre_dist = pd.DataFrame(counts / mlist_count[:, None], columns=GENRES)
+    df_user_genre_dist.insert(0, "user_id", user_ids)
+    return df_mlist_genre, df_user_genre_dist
+
+
+def title_user_matrix(df_mlist):
+    '''
+    title:user matrix of sum(repeat+1) per title and user
+    :returns
+        csr_matrix (titles x users) and the title_id of each row (ryota_title_user.npz / ryota_title_user_idx.npy)
+    '''
+
+    title_ids, title_rows = np.unique(df_mlist["title_id"].values, return_inverse=True)
+    user_ids, user_cols = np.unique(df_mlist["user_id"].values, return_inverse=True)
+    mat = sparse.csr_matrix((df_mlist["repeat"].values + 1.0, (title_rows, user_cols)), shape=(len(title_ids), len(user_ids)))
+    mat.sum_duplicates()
+    return mat, title_ids
+
+
+def generate_characters(df_titles, df_title_genre, characters_per_title, embedding_dim, rng, noise=0.5):
+    '''
+    Characters of every title and their image embeddings: a character is its title's center plus noise,
+    and a title's center is the sum of its genres' centers plus noise, so titles sharing genres look alike
+    :returns
+        df_characters: character_id, title_id, character_name, title_romaji (characters_200p format)
+        character_ids: ids of the embeddings as strings, like the saved ones
+        embeddings: (characters x embedding_dim) float32
+    '''
+
+    n_titles = len(df_titles)
+    genre_centers = rng.normal(0, 1, (len(GENRES), embedding_dim))
+    title_centers = df_title_genre[GENRES].values @ genre_centers + rng.normal(0, 1, (n_titles, embedding_dim))
+    counts = np.maximum(rng.poisson(characters_per_title, n_titles), 1)
+    title_rows = np.repeat(np.arange(n_titles), counts)
+    character_ids = rng.choice(np.arange(1, 20*len(title_rows)+1), len(title_rows), replace=False)
+    embeddings = (title_centers[title_rows] + rng.normal(0, noise, (len(title_rows), embedding_dim))).astype(np.float32)
+
+    df_characters = pd.DataFrame({"character_id": character_ids,
+                                  "title_id": df_titles["title_id"].values[title_rows],
+                                  "character_name": ["Character %d" % c for c in character_ids],
+                                  "title_romaji": df_titles["title_romaji"].values[title_rows]})
+    return df_characters, character_ids.astype(str), embeddings
+
+
+def generate_assets(out_root, scale=1.0, random_state=0, version="v2", columnar=False, **sizes):
+    '''
+    Writes a full synthetic asset folder in the layout the recommenders read(csv, npz, npy and image embeddings),
+    so that any module can be pointed to it with asset_root=out_root
+    :params
+        out_root: folder to write the assets to
+        scale: multiplier of the catalog size (titles, users and characters) of BASE_SIZES
+        random_state: seed of the generator
+        version: version name of the image embeddings
+        columnar: also write the columnar copies(see assetstore.convert_assets)
+        sizes: overrides of BASE_SIZES (applied before scaling)
+    :returns
+        dictionary of the generated sizes
+    '''
+
+    rng = np.random.RandomState(random_state)
+    sizes = {**BASE_SIZES, **sizes}
+    n_titles = max(int(sizes["n_titles"]*scale), 10)
+    n_users = max(int(sizes["n_users"]*scale), 10)
+
+    df_titles, df_title_genre = generate_titles(n_titles, rng)
+    df_mlist = generate_media_lists(df_titles, df_title_genre, n_users, sizes["mean_list_length"], rng)
+    df_mlist_genre, df_user_genre_dist = genre_tables(df_mlist, df_title_genre)
+    mat, title_idx = title_user_matrix(df_mlist)
+    df_characters, character_ids, embeddings = generate_characters(df_titles, df_title_genre, sizes["characters_per_title"], sizes["embedding_dim"], rng)
+
+    embedding_dir = os.path.join(out_root, "character_images", "models_and_embeddings")
+    os.makedirs(embedding_dir, exist_ok=True)
+    for name, df in [("titles_2000p", df_titles), ("titles_200p_cleaned", df_titles), ("ryota_title_genre_2000p", df_title_genre),
+                     ("media_list_all_users", df_mlist), ("ryota_media_list_genre", df_mlist_genre),
+                     ("ryota_user_genre_dist", df_user_genre_dist), ("characters_200p", df_characters)]:
+        df.to_csv(os.path.join(out_root, name + ".csv"), index=False)
+    sparse.save_npz(os.path.join(out_root, "ryota_title_user.npz"), mat)
+    np.save(os.path.join(out_root, "ryota_title_user_idx.npy"), title_idx)
+    np.save(os.path.join(embedding_dir, "image_embedding_" + version + ".npy"), embeddings)
+    np.save(os.path.join(embedding_dir, "image_embedding_character_ids_" + version + ".npy"), character_ids)
+    if columnar:
+        convert_assets(out_root)
+
+    return {"scale": scale, "n_titles": n_titles, "n_users": n_users, "n_media_list_rows": len(df_mlist),
+            "title_user_nnz": int(mat.nnz), "n_characters": len(df_characters), "embedding_dim": sizes["embedding_dim"]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="write a synthetic asset folder with realistic skew")
+    parser.add_argument("out_root")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier of the current catalog size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--columnar", action="store_true", help="also write the columnar copies")
+    args = parser.parse_args()
+    print(generate_assets(args.out_root, args.scale, args.seed, columnar=args.columnar))
@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+RECOMMENDER_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+for folder in ["", "2.1 Content based filtering", "2.2 User based filtering", "2.3 Image embedding"]:
+    sys.path.append(os.path.join(RECOMMENDER_ROOT, folder))
+from synthetic_data import generate_assets
+
+
+@pytest.fixture(scope="session")
+def asset_root(tmp_path_factory):
+    '''
+    small synthetic asset folder (400 titles, 300 users) shared by the tests, see synthetic_data.py
+    '''
+
+    root = str(tmp_path_factory.mktemp("assets"))
+    generate_assets(root, n_titles=400, n_users=300, mean_list_length=30, characters_per_title=3, embedding_dim=16)
+    return root
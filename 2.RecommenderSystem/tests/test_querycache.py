@@ -0,0 +1,20 @@
+import numpy as np
+from querycache import QueryCache, canonical_key
+
+
+def test_cached_rows_are_copied_out_of_the_batch_array():
+    cache = QueryCache(max_bytes=2**20)
+    batch = np.arange(1000 * 100, dtype=np.int64).reshape(1000, 100)
+    owner = object.__new__(type("Owner", (), {}))
+    keys = [canonical_key(i) for i in range(3)]
+    results = cache.call_batch(owner, "rows", 0, keys, lambda missing: [(batch[i], batch[i] * 2.0) for i in missing])
+
+    # three rows of ids and scores are cached, not the 800 kB batch array they were views of
+    for ids, scores in [entry[0] for entry in cache._entries.values()]:
+        assert not np.shares_memory(ids, batch)
+        assert ids.base is None and not ids.flags.writeable
+    assert cache.bytes < 10 * 2**10
+    assert all(np.array_equal(ids, batch[i]) for i, (ids, _) in enumerate(results))
+
+    hit, (ids, _) = cache.get((QueryCache.owner_token(owner), "rows", keys[1]), 0)
+    assert hit and np.array_equal(ids, batch[1])
@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import asyncio
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "3.App and Evaluation"))
+from instrumentation import Instrumentation
+from registry import ModelRegistry
+from recommend_service import RecommendService, item_knn_batch, ubf_titles_batch, ubf_user_batch, load_ubf
+
+
+@pytest.fixture(scope="module")
+def ubf(asset_root):
+    return load_ubf(asset_root, Instrumentation())
+
+
+def test_oversized_counts_only_fail_their_own_request(ubf):
+    title_id = int(ubf.title_idx_arr[0])
+    n_titles = len(ubf.title_idx_arr)
+
+    small, large, invalid = item_knn_batch(ubf, [{"title_id": title_id, "k": 5}, {"title_id": title_id, "k": 1000}, {"title_id": title_id, "k": 0}])
+    assert len(small["title_ids"]) == 5 and small["title_ids"] == large["title_ids"][:5]
+    assert len(large["title_ids"]) == n_titles - 1
+    assert isinstance(invalid, ValueError)
+
+    results = ubf_titles_batch(ubf, [{"title_ids": [title_id], "n_titles": 5, "output_neighbors": 1000},
+                                     {"title_ids": [title_id], "n_titles": 5, "output_neighbors": 1001}])
+    assert len(results[0]["title_ids"]) == 5 and title_id not in results[0]["title_ids"]
+    assert isinstance(results[1], ValueError)
+
+
+def test_unknown_user_method_is_rejected(ubf):
+    user_id = int(ubf.user_index["user_ids"][0])
+    valid, typo = ubf_user_batch(ubf, [{"user_id": user_id, "method": "refer_popularity"}, {"user_id": user_id, "method": "refer_popularty"}])
+    assert len(valid["similar_user_ids"]) == 10
+    assert isinstance(typo, ValueError)
+
+
+def test_handle_batches_valid_and_invalid_requests(ubf):
+    registry = ModelRegistry()
+    registry.register("ubf", lambda: ubf)
+    registry.warm_up()
+    service = RecommendService(registry, n_workers=1, max_wait=0.05)
+    title_id = int(ubf.title_idx_arr[0])
+
+    async def run():
+        collectors = [batcher.start() for batcher in service.batchers.values()]
+        try:
+            return await asyncio.gather(*[service.handle("POST", "/neighbors/item", json.dumps(body).encode())
+                                          for body in [{"title_id": title_id, "k": 5}, {"title_id": title_id, "k": -1},
+                                                       {"title_id": -1}, {"title_id": title_id, "k": 1000}]])
+        finally:
+            for collector in collectors:
+                collector.cancel()
+            service.executor.shutdown(wait=False)
+
+    (ok, result, _), (bad, _, _), (unknown, _, _), (large, _, _) = asyncio.run(run())
+    assert (ok, bad, unknown, large) == (200, 400, 404, 200)
+    assert len(result["title_ids"]) == 5
+    assert service.batchers["/neighbors/item"].batches == 1
+    assert asyncio.run(service.handle("GET", "/neighbors/item", b""))[0] == 405
+    assert asyncio.run(service.handle("POST", "/recommend/cbf", b"{}"))[0] == 404
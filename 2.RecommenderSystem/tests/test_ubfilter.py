@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+from sklearn.metrics.pairwise import cosine_distances
+from ubfilter import UserBasedFiltering
+
+
+def test_similar_users_keep_twins_and_drop_the_query(asset_root):
+    ubf = UserBasedFiltering(asset_root)
+    df = ubf.df_user_genre_dist
+    # a new user with exactly the genre distribution of the first one
+    twin = df.iloc[[0]].assign(user_id=df["user_id"].max() + 1)
+    ubf.df_user_genre_dist = pd.concat([df, twin], ignore_index=True)
+    query_user_id, twin_user_id = df["user_id"].iloc[0], twin["user_id"].iloc[0]
+    for dist_metric, ascending in [("cosine_similarity", False), ("euclidean_distances", True), ("manhattan_distances", True)]:
+        similar = ubf.get_similar_users_from_user_ids([query_user_id, twin_user_id], dist_metric=dist_metric, ascending=ascending)
+        assert len(similar[0]) == len(similar[1]) == 10
+        assert query_user_id not in similar[0] and twin_user_id in similar[0]
+        assert twin_user_id not in similar[1] and query_user_id in similar[1]
+
+
+def test_ingest_item_neighbors_match_full_rebuild(asset_root):
+    base = UserBasedFiltering(asset_root)
+    base.build_item_neighbor_table(n_neighbors=10)
+    user_ids = base.df_mlist["user_id"].unique()
+    for seed in range(6):
+        ubf = base.snapshot()
+        rng = np.random.RandomState(seed)
+        delta = pd.DataFrame({"user_id": np.append(rng.choice(user_ids, 2), user_ids.max() + 1),
+                              "title_id": rng.choice(ubf.title_idx_arr, 3)})
+        ubf.ingest_media_list(delta)
+        rebuilt = ubf.snapshot()
+        rebuilt.build_item_neighbor_table(n_neighbors=10)
+        # same distances as the rebuilt table, and each neighbor really is at that distance
+        # (titles tied at the same distance may come in another order)
+        neighbors, distances = ubf.item_neighbors["neighbors"], ubf.item_neighbors["distances"]
+        assert np.allclose(distances, rebuilt.item_neighbors["distances"], atol=1e-6)
+        exact = cosine_distances(ubf.mat_title_user)
+        assert np.allclose(np.take_along_axis(exact, neighbors, axis=1), distances, atol=1e-6)
+        assert not (neighbors == np.arange(len(neighbors))[:, None]).any()
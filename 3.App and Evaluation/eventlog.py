@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import random
+import atexit
+import threading
+
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+def push_key():
+    """Generates a key in the format of Firebase push ids (8 timestamp chars + 12 random chars).
+
+    Keys sort chronologically like the ones push() creates, so the logged
+    nodes keep the same order when read back with db.reference(path).get().
+
+    Returns:
+        str: the key
+    """
+    now = int(time.time() * 1000)
+    chars = []
+    for _ in range(8):
+        chars.append(PUSH_CHARS[now % 64])
+        now //= 64
+    return ''.join(reversed(chars)) + ''.join(random.choice(PUSH_CHARS) for _ in range(12))
+
+
+class FirebaseSink:
+    def __init__(self, reference):
+        """Writes a batch of events to the Firebase realtime database in one multi-path update.
+
+        Args:
+            reference (callable): firebase_admin.db.reference
+        """
+        self.reference = reference
+
+    def write_batch(self, records):
+        self.reference().update({f"{r['path']}/{r['key']}": r['event'] for r in records})
+
+
+class JsonlFileSink:
+    def __init__(self, path):
+        """Appends events to a local JSON lines file (local stand-in for FirebaseSink).
+
+        Args:
+            path (str): file to append to
+        """
+        self.path = path
+
+    def write_batch(self, records):
+        with open(self.path, 'a') as f:
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+
+
+class MemorySink:
+    def __init__(self):
+        """Keeps events in memory, grouped by path like the realtime database (stand-in for local runs)."""
+        self.data = {}
+        self.batches = 0
+
+    def write_batch(self, records):
+        for r in records:
+            self.data.setdefault(r['path'], {})[r['key']] = r['event']
+        self.batches += 1
+
+
+class EventLogger:
+    def __init__(self, sink, buffer_dir='event_buffer', batch_size=100, flush_interval=1.0,
+                 max_pending=10000, put_timeout=5.0, max_retries=5, retry_backoff=0.5,
+                 compact_bytes=1 << 20):
+        """Asynchronous, batched event logger.
+
+        log() only appends the event to a local append-only JSON lines segment and
+        returns; a background thread reads the segment in batches and writes them
+        to the sink. The last flushed position is persisted, so events that were
+        not flushed before a crash are sent on the next start.
+
+        Args:
+            sink: object with a write_batch(records) method, e.g. FirebaseSink
+            buffer_dir (str): folder of the segment (events.jsonl) and its flushed offset (events.offset)
+            batch_size (int): maximum number of events per write_batch call
+            flush_interval (float): seconds to wait for more events before flushing a partial batch
+            max_pending (int): log() blocks (or drops the event, see log) while this many events are waiting to be flushed
+            put_timeout (float): seconds log() waits for room before raising TimeoutError
+            max_retries (int): attempts per batch before the worker backs off and tries again later
+            retry_backoff (float): initial seconds between attempts, doubled after every failure
+            compact_bytes (int): the segment is truncated once everything is flushed and it is larger than this
+        """
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.compact_bytes = compact_bytes
+
+        os.makedirs(buffer_dir, exist_ok=True)
+        self.segment_path = os.path.join(buffer_dir, 'events.jsonl')
+        self.offset_path = os.path.join(buffer_dir, 'events.offset')
+        self.segment = open(self.segment_path, 'a')
+        self.flushed_offset = self._read_offset()
+        self.pending = self._count_pending()
+        self.failed_attempts = 0
+        self.last_error = None
+        # events log(block=False) dropped because the buffer was full
+        self.dropped = 0
+
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.worker = threading.Thread(target=self._run, name='event-logger', daemon=True)
+        self.worker.start()
+        atexit.register(self.close)
+
+    def _read_offset(self):
+        if not os.path.exists(self.offset_path):
+            return 0
+        with open(self.offset_path) as f:
+            return min(int(f.read() or 0), os.path.getsize(self.segment_path))
+
+    def _write_offset(self):
+        tmp_path = self.offset_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(self.flushed_offset))
+        os.replace(tmp_path, self.offset_path)
+
+    def _count_pending(self):
+        with open(self.segment_path) as f:
+            f.seek(self.flushed_offset)
+            return sum(1 for _ in f)
+
+    def log(self, path, event, block=True):
+        """Queues an event for the realtime database node `path` (e.g. 'query').
+
+        Args:
+            path (str): database path the event is pushed to
+            event (dict): the event, written unchanged
+            block (bool): wait for room when max_pending events are waiting; False drops the
+                event instead (counted in self.dropped), for callers that must never stall
+
+        Returns:
+            bool: whether the event was queued
+
+        Raises:
+            TimeoutError: if block and max_pending events are still waiting after put_timeout seconds
+        """
+        record = {'path': path, 'key': push_key(), 'event': event}
+        line = json.dumps(record) + '\n'
+        with self.cond:
+            if not block and self.pending >= self.max_pending:
+                self.dropped += 1
+                return False
+            deadline = time.monotonic() + self.put_timeout
+            while self.pending >= self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.cond.wait(remaining):
+                    raise TimeoutError(f'{self.pending} events waiting to be flushed')
+            self.segment.write(line)
+            self.segment.flush()
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.cond.notify_all()
+        return True
+
+    def _read_batch(self):
+        with open(self.segment_path) as f:
+            f.seek(self.flushed_offset)
+            records = []
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    break
+                records.append(json.loads(line))
+                if len(records) == self.batch_size:
+                    break
+            return records, f.tell() if records else self.flushed_offset
+
+    def _send(self, records):
+        backoff = self.retry_backoff
+        for attempt in range(self.max_retries):
+            try:
+                self.sink.write_batch(records)
+                return True
+            except Exception as e:
+                self.failed_attempts += 1
+                self.last_error = e
+                if attempt < self.max_retries - 1:
+                    time.sleep(backoff)
+                    backoff *= 2
+        return False
+
+    def _flush_once(self):
+        """Sends one batch. Returns False if there was nothing to send or the sink kept failing."""
+        records, end_offset = self._read_batch()
+        if not records or not self._send(records):
+            return False
+        with self.cond:
+            self.flushed_offset = end_offset
+            self.pending -= len(records)
+            # compact the segment once everything in it has been flushed
+            if self.pending == 0 and self.flushed_offset >= self.compact_bytes:
+                self.segment.truncate(0)
+                self.segment.seek(0)
+                self.flushed_offset = 0
+            self._write_offset()
+            self.cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if self.pending < self.batch_size and not self.stopping:
+                    self.cond.wait(self.flush_interval)
+                stopping = self.stopping
+            # a failing sink ends the inner loop; the events stay buffered for the next round
+            while self.pending and self._flush_once():
+                pass
+            if stopping:
+                return
+
+    def flush(self, timeout=None):
+        """Blocks until every event logged so far has been flushed.
+
+        Args:
+            timeout (float): maximum seconds to wait, None waits forever
+
+        Returns:
+            bool: True if nothing is left to flush
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            self.cond.notify_all()
+            while self.pending > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining if remaining is not None else self.flush_interval)
+        return True
+
+    def close(self, timeout=10.0):
+        """Flushes what is left and stops the worker (also registered with atexit)."""
+        if self.stopping:
+            return
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.worker.join(timeout)
+        self.segment.close()
@@ -0,0 +1,313 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import pandas as pd
+
+RECOMMENDER_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '2.RecommenderSystem')
+for folder in ['', '2.1 Content based filtering', '2.2 User based filtering', '2.3 Image embedding']:
+    sys.path.append(os.path.join(RECOMMENDER_ROOT, folder))
+from assetstore import AssetStore, DEFAULT_ASSET_ROOT
+
+
+def leave_n_out_split(mlist, n_holdout=1, min_history=5, n_users=None, max_seeds=None, random_state=0):
+    """Hides n titles of every user's media list; the rest are the seeds of the user's query.
+
+    Args:
+        mlist (pd.DataFrame): media_list_all_users formatted rows (at least user_id and title_id)
+        n_holdout (int): titles hidden per user
+        min_history (int): users with fewer distinct titles are skipped
+        n_users (int): sample this many of the eligible users, None keeps them all
+        max_seeds (int): keep at most this many (random) seed titles per user, None keeps them all
+        random_state (int): seed of the sampling
+
+    Returns:
+        pd.DataFrame: one row per user with user_id, seeds (list) and heldout (list)
+    """
+    rng = np.random.RandomState(random_state)
+    pairs = mlist[['user_id', 'title_id']].drop_duplicates()
+    sizes = pairs.groupby('user_id').size()
+    users = sizes.index.values[sizes.values >= max(min_history, n_holdout + 1)]
+    if n_users is not None and n_users < len(users):
+        users = np.sort(rng.choice(users, n_users, replace=False))
+
+    # shuffle once, then the first n_holdout rows of each user are held out
+    pairs = pairs[pairs.user_id.isin(users)]
+    pairs = pairs.iloc[rng.permutation(len(pairs))]
+    rank = pairs.groupby('user_id').cumcount().values
+    is_heldout = rank < n_holdout
+    is_seed = ~is_heldout if max_seeds is None else ~is_heldout & (rank < n_holdout + max_seeds)
+
+    split = pd.DataFrame({'user_id': users})
+    for column, mask in [('seeds', is_seed), ('heldout', is_heldout)]:
+        lists = pairs[mask].groupby('user_id').title_id.apply(list)
+        split[column] = lists.reindex(users).values
+    return split
+
+
+def heldout_pairs(split):
+    """Returns the hidden (user_id, title_id) pairs of a leave_n_out_split output, one row per pair."""
+    pairs = split[['user_id', 'heldout']].explode('heldout').rename(columns={'heldout': 'title_id'})
+    return pairs.astype({'title_id': np.int64}).reset_index(drop=True)
+
+
+def ranking_metrics(recommended, heldout, k):
+    """Precision@k, recall@k and NDCG@k of one ranked list against the held-out titles (binary relevance).
+
+    Args:
+        recommended (list): recommended title_ids, best first
+        heldout (list): held-out title_ids
+        k (int): cut-off
+
+    Returns:
+        tuple: precision, recall, ndcg
+    """
+    hits = np.isin(np.asarray(recommended[:k]), heldout)
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    idcg = discounts[:min(len(heldout), k)].sum()
+    return hits.sum() / k, hits.sum() / len(heldout), (discounts[:len(hits)] * hits).sum() / idcg
+
+
+def latency_summary(latencies):
+    """Returns mean and p50/p90/p99 of per-query latencies in milliseconds."""
+    latencies = np.asarray(latencies) * 1000
+    if len(latencies) == 0:
+        return {}
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {'mean': float(latencies.mean()), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99)}
+
+
+###################### recommenders under evaluation ######################
+# a factory builds a recommender in each worker and returns recommend(seed_title_ids, k) -> title_ids, best first.
+# factories must be picklable (module level functions or functools.partial of them)
+
+
+def cbf_factory(asset_root=DEFAULT_ASSET_ROOT, top_k=200):
+    """ContentBasedFiltering on the title genre features (top-k similarity index)."""
+    from cbfilter import ContentBasedFiltering
+    cbf = ContentBasedFiltering(asset_root)
+    genres = AssetStore(asset_root).load_frame('ryota_title_genre_2000p').set_index('title_id')
+    cbf.create_sim_mat(genres, top_k=top_k)
+
+    def recommend(seeds, k):
+        return cbf.recommend(seeds, k=k)[0]
+    return recommend
+
+
+def hide_heldout(ubf, heldout):
+    """Removes the held-out entries from the data a UserBasedFiltering is fitted on.
+
+    The media list rows of the held-out (user_id, title_id) pairs are dropped, their genre counts are
+    subtracted from the user genre tables and their entries are zeroed in the title:user matrix, so that a
+    held-out title cannot be found through the very entry that hides it. Must be called before the model,
+    the item neighbor table or the title factors are built.
+
+    Args:
+        ubf (UserBasedFiltering): freshly loaded recommender
+        heldout (pd.DataFrame): user_id and title_id of the hidden pairs (see heldout_pairs)
+    """
+    from scipy import sparse
+    # user columns of the full matrix, taken before the media lists change
+    user_col = ubf._title_user_columns()
+    mlist = ubf.df_mlist
+    is_hidden = pd.MultiIndex.from_frame(mlist[['user_id', 'title_id']]).isin(pd.MultiIndex.from_frame(heldout[['user_id', 'title_id']]))
+    hidden = mlist[is_hidden]
+
+    in_matrix = hidden[hidden.title_id.isin(ubf.title_pos)].drop_duplicates(['user_id', 'title_id'])
+    rows = np.array([ubf.title_pos[t] for t in in_matrix.title_id.values], dtype=int)
+    cols = np.array([user_col[u] for u in in_matrix.user_id.values], dtype=int)
+    mat = sparse.csr_matrix(ubf.mat_title_user)
+    mask = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=mat.shape)
+    mat = sparse.csr_matrix(mat - mat.multiply(mask))
+    mat.eliminate_zeros()
+
+    # genre counts and distributions of the users that lose titles (as ubfilter's ingest_media_list, subtracted)
+    genres = list(ubf.df_mlist_genre.columns[2:])
+    title_genres = ubf.df_titles_genre.set_index('title_id')[genres]
+    hidden = hidden[hidden.title_id.isin(title_genres.index)]
+    counts = title_genres.loc[hidden.title_id.values].groupby(hidden.user_id.values).sum()
+    counts['mlist_count'] = hidden.groupby('user_id').size()
+    users = counts.index.values
+    df_mlist_genre = ubf.df_mlist_genre.set_index('user_id')
+    df_mlist_genre.loc[users, ['mlist_count'] + genres] -= counts[['mlist_count'] + genres].values
+    df_user_genre_dist = ubf.df_user_genre_dist.set_index('user_id')
+    dist_genres = list(df_user_genre_dist.columns)
+    affected = df_mlist_genre.loc[users]
+    df_user_genre_dist.loc[users, dist_genres] = affected[dist_genres].values / np.maximum(affected[['mlist_count']].values, 1)
+
+    ubf.__dict__.update({'df_mlist': mlist[~is_hidden].reset_index(drop=True), 'mat_title_user': mat,
+                         'df_mlist_genre': df_mlist_genre.reset_index(), 'df_user_genre_dist': df_user_genre_dist.reset_index()})
+
+
+def ubf_factory(asset_root=DEFAULT_ASSET_ROOT, fusion='min', n_neighbors=None, factor_rank=None, heldout=None):
+    """UserBasedFiltering item kNN over the title:user matrix, as served by the app (or over its SVD title factors).
+
+    heldout (pd.DataFrame) holds the hidden (user_id, title_id) pairs of the split (see heldout_pairs): they are
+    removed before fitting (see hide_heldout). None fits on every entry, held-out ones included.
+    """
+    from ubfilter import UserBasedFiltering
+    ubf = UserBasedFiltering(asset_root)
+    if heldout is not None:
+        hide_heldout(ubf, heldout)
+    if factor_rank:
+        ubf.build_title_factors(factor_rank)
+    if n_neighbors:
+        ubf.build_item_neighbor_table(n_neighbors)
+
+    def recommend(seeds, k):
+        return ubf.recommend_from_titles(seeds, n_titles=k, output_neighbors=max(k, 51), fusion=fusion)[0]
+    return recommend
+
+
+def ibf_factory(asset_root=DEFAULT_ASSET_ROOT, query_path='', version='v2', approximate=False):
+    """ImageBasedRecommendation title embeddings; candidates of several seeds are ranked by their best similarity."""
+    from ibfilter import ImageBasedRecommendation
+    ibr = ImageBasedRecommendation(query_path, version, asset_root, approximate=approximate)
+
+    def recommend(seeds, k):
+        seeds = [t for t in seeds if t in ibr.title_index.id_pos]
+        if not seeds:
+            return []
+        res = pd.concat([ibr.recommend_titles_from_similar_image_embedding(t, k + len(seeds)) for t in seeds])
+        res = res[~res.title_id.isin(seeds)].sort_values('similarity', ascending=False, kind='mergesort')
+        return res.drop_duplicates(subset='title_id').title_id.values[:k]
+    return recommend
+
+
+RECOMMENDERS = {'cbf': cbf_factory, 'ubf': ubf_factory, 'ibf': ibf_factory}
+
+
+###################### process pool ######################
+
+_worker = {}
+
+
+def _init_worker(factory, trace_memory):
+    _worker['recommend'] = factory()
+    _worker['trace_memory'] = trace_memory
+
+
+def _evaluate_chunk(args):
+    seeds_list, heldout_list, k = args
+    recommend = _worker['recommend']
+    metrics = np.zeros((len(seeds_list), 3))
+    latencies = np.zeros(len(seeds_list))
+    recommended = set()
+    if _worker['trace_memory']:
+        tracemalloc.start()
+    for i, (seeds, heldout) in enumerate(zip(seeds_list, heldout_list)):
+        start = time.perf_counter()
+        rec = list(recommend(seeds, k))
+        latencies[i] = time.perf_counter() - start
+        metrics[i] = ranking_metrics(rec, heldout, k)
+        recommended.update(rec)
+    query_peak = 0
+    if _worker['trace_memory']:
+        query_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return metrics, latencies, recommended, peak_rss, query_peak
+
+
+def evaluate(factory, split, k=10, n_workers=1, chunk_size=200, catalog_size=None, trace_memory=False):
+    """Evaluates one recommender on a leave-n-out split.
+
+    Users are sent in chunks to a pool of worker processes; every worker builds
+    its own recommender with factory() once and then answers the queries of
+    its chunks, timing each one.
+
+    Args:
+        factory (callable): picklable, builds recommend(seed_title_ids, k) -> ranked title_ids (see RECOMMENDERS)
+        split (pd.DataFrame): output of leave_n_out_split
+        k (int): cut-off of the metrics
+        n_workers (int): worker processes, 1 evaluates in this process
+        chunk_size (int): users per task sent to a worker
+        catalog_size (int): number of recommendable titles, for coverage
+        trace_memory (bool): measure the peak Python/numpy allocation during the queries with tracemalloc (slower)
+
+    Returns:
+        dict: precision@k, recall@k, ndcg@k, coverage, latency_ms percentiles and peak memory
+    """
+    seeds, heldout = split.seeds.tolist(), split.heldout.tolist()
+    chunks = [(seeds[i:i + chunk_size], heldout[i:i + chunk_size], k) for i in range(0, len(seeds), chunk_size)]
+
+    start = time.perf_counter()
+    if n_workers <= 1:
+        _init_worker(factory, trace_memory)
+        load_seconds = time.perf_counter() - start
+        results = [_evaluate_chunk(chunk) for chunk in chunks]
+    else:
+        load_seconds = None
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(factory, trace_memory)) as pool:
+            results = list(pool.map(_evaluate_chunk, chunks))
+    wall_seconds = time.perf_counter() - start
+
+    metrics = np.vstack([r[0] for r in results]) if results else np.zeros((0, 3))
+    recommended = set().union(*[r[2] for r in results])
+    report = {f'precision@{k}': float(metrics[:, 0].mean()) if len(metrics) else None,
+              f'recall@{k}': float(metrics[:, 1].mean()) if len(metrics) else None,
+              f'ndcg@{k}': float(metrics[:, 2].mean()) if len(metrics) else None,
+              'coverage': len(recommended) / catalog_size if catalog_size else None,
+              'recommended_titles': len(recommended),
+              'users': len(metrics),
+              'latency_ms': latency_summary(np.concatenate([r[1] for r in results]) if results else []),
+              'peak_rss_mb': max([r[3] for r in results], default=0) / 2**20,
+              'wall_seconds': wall_seconds,
+              'load_seconds': load_seconds}
+    if trace_memory:
+        report['peak_query_alloc_mb'] = max([r[4] for r in results], default=0) / 2**20
+    return report
+
+
+def compare(factories, split, k=10, n_workers=1, catalog_size=None, trace_memory=False):
+    """Runs evaluate() for several recommenders on the same split.
+
+    Args:
+        factories (dict): name: factory
+        split (pd.DataFrame): output of leave_n_out_split
+
+    Returns:
+        pd.DataFrame: one row per recommender, quality and speed side by side
+    """
+    reports = {}
+    for name, factory in factories.items():
+        report = evaluate(factory, split, k, n_workers, catalog_size=catalog_size, trace_memory=trace_memory)
+        latency = report.pop('latency_ms')
+        report.update({f'latency_{q}_ms': v for q, v in latency.items()})
+        reports[name] = report
+    return pd.DataFrame(reports).T
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='offline leave-n-out evaluation of the recommenders')
+    parser.add_argument('--asset-root', default=DEFAULT_ASSET_ROOT)
+    parser.add_argument('--recommenders', nargs='+', default=['cbf', 'ubf'], choices=list(RECOMMENDERS))
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--n-holdout', type=int, default=1)
+    parser.add_argument('--min-history', type=int, default=5)
+    parser.add_argument('--n-users', type=int, default=1000)
+    parser.add_argument('--max-seeds', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--trace-memory', action='store_true')
+    parser.add_argument('--image-path', default='', help='character image folder (ibf)')
+    parser.add_argument('--image-version', default='v2', help='image embedding version (ibf)')
+    parser.add_argument('--factor-rank', type=int, default=None, help='serve ubf from truncated SVD title factors of this rank')
+    parser.add_argument('--out', default=None, help='json file to write the results to')
+    args = parser.parse_args()
+
+    mlist = AssetStore(args.asset_root).load_frame('media_list_all_users', columns=['user_id', 'title_id'])
+    split = leave_n_out_split(mlist, args.n_holdout, args.min_history, args.n_users, args.max_seeds)
+    kwargs = {'ubf': {'factor_rank': args.factor_rank, 'heldout': heldout_pairs(split)}, 'ibf': {'query_path': args.image_path, 'version': args.image_version}}
+    factories = {name: partial(RECOMMENDERS[name], args.asset_root, **kwargs.get(name, {})) for name in args.recommenders}
+    results = compare(factories, split, args.k, args.workers, mlist.title_id.nunique(), args.trace_memory)
+    print(results.to_string())
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results.to_dict(orient='index'), f, indent=2, default=float)
@@ -0,0 +1,546 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from scipy import sparse
+
+RECOMMENDER_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '2.RecommenderSystem')
+for folder in ['', '2.1 Content based filtering', '2.2 User based filtering', '2.3 Image embedding']:
+    sys.path.append(os.path.join(RECOMMENDER_ROOT, folder))
+from assetstore import DEFAULT_ASSET_ROOT
+from instrumentation import Instrumentation
+from querycache import QueryCache
+from registry import ModelRegistry, file_version
+
+logger = logging.getLogger('recommend_service')
+
+# largest accepted k / n_titles / output_neighbors / top_n of a request
+MAX_COUNT = 1000
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+class Overloaded(Exception):
+    """Raised when a batcher already holds max_pending requests."""
+
+
+class MicroBatcher:
+    def __init__(self, batch_fn, executor, max_batch_size=64, max_wait=0.002, max_pending=1024, max_in_flight=4):
+        """Collects concurrent requests of one endpoint into batches run on a worker pool.
+
+        The first request of a batch waits at most max_wait seconds for others
+        to arrive; the batch is then handed to batch_fn on the executor while
+        the event loop keeps accepting requests. Requests that timed out while
+        queued are dropped before the batch runs.
+
+        Args:
+            batch_fn (callable): takes a list of payloads and returns one result per payload;
+                a result may be an exception instance, which is raised for that request only
+            executor (concurrent.futures.Executor): worker pool running batch_fn
+            max_batch_size (int): maximum payloads per batch_fn call
+            max_wait (float): seconds to wait for a batch to fill up
+            max_pending (int): queued requests above which submit() raises Overloaded
+            max_in_flight (int): batches of this endpoint running at the same time
+        """
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        self.queue = None
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        """Starts collecting batches; must be called from the running event loop."""
+        self.queue = asyncio.Queue(self.max_pending)
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        return asyncio.ensure_future(self._collect())
+
+    async def submit(self, payload):
+        """Queues a payload and waits for its result.
+
+        Raises:
+            Overloaded: if max_pending requests are already queued
+        """
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self.queue.put_nowait((payload, future))
+        except asyncio.QueueFull:
+            raise Overloaded(f'{self.queue.qsize()} requests queued')
+        return await future
+
+    async def _collect(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            batch = [(payload, future) for payload, future in batch if not future.done()]
+            if batch:
+                await self.in_flight.acquire()
+                asyncio.ensure_future(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        try:
+            results = await asyncio.get_event_loop().run_in_executor(self.executor, self.batch_fn, [payload for payload, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        finally:
+            self.in_flight.release()
+        self.batches += 1
+        self.items += len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+###################### batch functions: one vectorized call per batch ######################
+
+
+def _title_list(payload, key='title_ids'):
+    title_ids = payload.get(key)
+    if not isinstance(title_ids, list):
+        raise ValueError(f'{key} must be a list')
+    return [int(t) for t in title_ids]
+
+
+def _count(payload, key, default):
+    value = int(payload.get(key, default))
+    if not 0 < value <= MAX_COUNT:
+        raise ValueError(f'{key} must be between 1 and {MAX_COUNT}, got {value}')
+    return value
+
+
+def _validated(payloads, parse):
+    # parse every payload; invalid ones become their ValueError/KeyError result
+    parsed = []
+    for payload in payloads:
+        try:
+            parsed.append(parse(payload))
+        except (ValueError, KeyError, TypeError) as e:
+            parsed.append(e if isinstance(e, (ValueError, KeyError)) else ValueError(str(e)))
+    return parsed
+
+
+def _merge_results(parsed, computed):
+    computed = iter(computed)
+    return [p if isinstance(p, Exception) else next(computed) for p in parsed]
+
+
+def cbf_batch(scorer, payloads):
+    """SimilarityScorer.recommend of the queries of the batch, one pass per distinct k (k is part of the cache key)."""
+    parsed = _validated(payloads, lambda p: (_title_list(p), _count(p, 'k', 50)))
+    results = list(parsed)
+    groups = {}
+    for i, p in enumerate(parsed):
+        if not isinstance(p, Exception):
+            groups.setdefault(p[1], []).append(i)
+    for k, members in groups.items():
+        rec_ids, rec_scores = scorer.recommend([parsed[i][0] for i in members], k=k)
+        for i, ids, scores in zip(members, rec_ids, rec_scores):
+            keep = ids != -1
+            results[i] = {'title_ids': ids[keep].tolist(), 'scores': scores[keep].tolist()}
+    return results
+
+
+def ubf_user_batch(ubf, payloads):
+    """Similar users of all the queried users in one matrix product, then their unread titles."""
+    def parse(p):
+        user_id = int(p['user_id'])
+        if user_id not in ubf.user_index['user_pos']:
+            raise KeyError(f'unknown user_id {user_id}')
+        method = p.get('method', 'refer_others')
+        if method not in ['refer_others', 'refer_popularity']:
+            raise ValueError(f'unknown method {method}')
+        return user_id, _count(p, 'n_titles', 10), method
+
+    parsed = _validated(payloads, parse)
+    valid = [p for p in parsed if not isinstance(p, Exception)]
+    computed = []
+    if valid:
+        similar = ubf.get_similar_users_from_user_ids([user_id for user_id, _, _ in valid])
+        for (user_id, n_titles, method), similar_user_ids in zip(valid, similar):
+            titles = ubf.recommend_unread_titles(n_titles, similar_user_ids, query_user_id=user_id, method=method)
+            computed.append({'similar_user_ids': [int(u) for u in similar_user_ids], 'title_ids': [int(t) for t in titles]})
+    return _merge_results(parsed, computed)
+
+
+def ubf_titles_batch(ubf, payloads):
+    """recommend_from_titles_batch per group of queries sharing the same fusion settings."""
+    def parse(p):
+        fusion = p.get('fusion', 'min')
+        if fusion not in ['min', 'sum', 'mean', 'rrf']:
+            raise ValueError(f'unknown fusion {fusion}')
+        return _title_list(p), _count(p, 'n_titles', 50), _count(p, 'output_neighbors', 51), fusion
+
+    parsed = _validated(payloads, parse)
+    results = list(parsed)
+    groups = {}
+    for i, p in enumerate(parsed):
+        if not isinstance(p, Exception):
+            groups.setdefault(p[2:], []).append(i)
+    for (output_neighbors, fusion), members in groups.items():
+        n_titles = max(parsed[i][1] for i in members)
+        batch = ubf.recommend_from_titles_batch([parsed[i][0] for i in members], n_titles, output_neighbors, fusion)
+        for i, (ids, scores) in zip(members, batch):
+            k = parsed[i][1]
+            results[i] = {'title_ids': ids[:k].tolist(), 'scores': scores[:k].tolist()}
+    return results
+
+
+def item_knn_batch(ubf, payloads):
+    """Nearest titles of all the queried titles in one neighbor search."""
+    def parse(p):
+        title_id = int(p['title_id'])
+        if title_id not in ubf.title_pos:
+            raise KeyError(f'unknown title_id {title_id}')
+        return ubf.title_pos[title_id], _count(p, 'k', 10)
+
+    parsed = _validated(payloads, parse)
+    valid = [p for p in parsed if not isinstance(p, Exception)]
+    computed = []
+    if valid:
+        indices, distances = ubf.get_item_neighbors_batch([pos for pos, _ in valid], max(k for _, k in valid))
+        for (_, k), idx, dist in zip(valid, indices, distances):
+            computed.append({'title_ids': ubf.title_idx_arr[idx[:k]].tolist(), 'distances': dist[:k].tolist()})
+    return _merge_results(parsed, computed)
+
+
+def image_batch(ibr, payloads):
+    """Titles with similar character images, one index search per queried title."""
+    def run(p):
+        title_id = int(p['title_id'])
+        if title_id not in ibr.title_index.id_pos:
+            raise KeyError(f'unknown title_id {title_id}')
+        res = ibr.recommend_titles_from_similar_image_embedding(title_id, _count(p, 'top_n', 10))
+        return {'title_ids': res.title_id.tolist(), 'similarities': res.similarity.tolist()}
+
+    return _validated(payloads, run)
+
+
+###################### service ######################
+
+
+class RecommendService:
+    def __init__(self, registry, instrumentation=None, n_workers=4, request_timeout=2.0, idle_timeout=30.0,
+                 max_body=1 << 20, max_batch_size=64, max_wait=0.002, max_pending=1024, cache=None):
+        """HTTP/JSON recommendation service on asyncio, standard library only.
+
+        Every recommendation endpoint has a MicroBatcher, so concurrent requests
+        reach the vectorized batch paths of the models; the batches run on a
+        shared thread pool (numpy releases the GIL in the heavy parts) while the
+        event loop keeps serving. Models come from a ModelRegistry and are loaded
+        in the background: /readyz answers 503 until they are all loaded,
+        /healthz answers as soon as the process serves.
+
+        Args:
+            registry (ModelRegistry): models 'cbf_scorer', 'ubf' and optionally 'ibf'
+            instrumentation (Instrumentation): exported on /metrics
+            n_workers (int): threads running the batches
+            request_timeout (float): seconds a request may wait for its result before a 504
+            idle_timeout (float): seconds a keep-alive connection may stay idle
+            max_body (int): largest accepted request body in bytes
+            max_batch_size (int): see MicroBatcher
+            max_wait (float): see MicroBatcher
+            max_pending (int): see MicroBatcher
+            cache (QueryCache): cache shared by the models, its stats are reported on /stats
+        """
+        self.registry = registry
+        self.cache = cache
+        self.instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        self.request_timeout = request_timeout
+        self.idle_timeout = idle_timeout
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(n_workers, thread_name_prefix='recommend-worker')
+
+        # path: (model name, batch function)
+        self.endpoints = {'/recommend/cbf': ('cbf_scorer', cbf_batch),
+                          '/recommend/ubf/user': ('ubf', ubf_user_batch),
+                          '/recommend/ubf/titles': ('ubf', ubf_titles_batch),
+                          '/neighbors/item': ('ubf', item_knn_batch),
+                          '/recommend/image': ('ibf', image_batch)}
+        self.batchers = {}
+        for path, (model, batch_fn) in self.endpoints.items():
+            self.batchers[path] = MicroBatcher(self._instrumented(path, model, batch_fn), self.executor,
+                                               max_batch_size, max_wait, max_pending, max_in_flight=n_workers)
+
+    def _instrumented(self, path, model, batch_fn):
+        def run(payloads):
+            self.instrumentation.count('service.batches' + path.replace('/', '.'))
+            self.instrumentation.count('service.requests' + path.replace('/', '.'), len(payloads))
+            with self.instrumentation.stage('service.batch' + path.replace('/', '.')):
+                return batch_fn(self.registry.get(model), payloads)
+        return run
+
+    def ready(self):
+        status = self.registry.status()
+        return all(entry['loaded'] for entry in status.values()), status
+
+    async def handle(self, method, path, body):
+        """Routes one request.
+
+        Returns:
+            tuple: status code, response body (dict or str) and content type
+        """
+        if path == '/healthz':
+            return 200, {'status': 'ok'}, 'application/json'
+        if path == '/readyz':
+            ready, status = self.ready()
+            return (200 if ready else 503), {'ready': ready, 'models': {name: entry['loaded'] for name, entry in status.items()}}, 'application/json'
+        if path == '/metrics':
+            return 200, self.instrumentation.prometheus(), 'text/plain; version=0.0.4'
+        if path == '/stats':
+            stats = {p: {'batches': b.batches, 'requests': b.items, 'queued': b.queue.qsize()} for p, b in self.batchers.items()}
+            if self.cache is not None:
+                stats['cache'] = self.cache.stats()
+            return 200, stats, 'application/json'
+        if path not in self.endpoints:
+            return 404, {'error': f'no endpoint {path}'}, 'application/json'
+        if method != 'POST':
+            return 405, {'error': 'use POST with a json body'}, 'application/json'
+
+        model = self.endpoints[path][0]
+        if model not in self.registry.status():
+            return 404, {'error': f'{model} is not served'}, 'application/json'
+        if not self.registry.status()[model]['loaded']:
+            return 503, {'error': f'{model} is still loading'}, 'application/json'
+        try:
+            payload = json.loads(body or b'{}')
+            if not isinstance(payload, dict):
+                raise ValueError('body must be a json object')
+        except ValueError as e:
+            return 400, {'error': f'invalid json: {e}'}, 'application/json'
+
+        try:
+            result = await asyncio.wait_for(self.batchers[path].submit(payload), self.request_timeout)
+        except asyncio.TimeoutError:
+            return 504, {'error': f'no result within {self.request_timeout}s'}, 'application/json'
+        except Overloaded as e:
+            return 503, {'error': f'overloaded: {e}'}, 'application/json'
+        except KeyError as e:
+            return 404, {'error': str(e.args[0]) if e.args else 'not found'}, 'application/json'
+        except ValueError as e:
+            return 400, {'error': str(e)}, 'application/json'
+        except Exception as e:
+            logger.exception('%s failed', path)
+            return 500, {'error': repr(e)}, 'application/json'
+        return 200, result, 'application/json'
+
+    async def serve_connection(self, reader, writer):
+        """Serves the HTTP/1.1 requests of one keep-alive connection."""
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ')
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'malformed request line'}, 'application/json', False)
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                length = int(headers.get('content-length', 0) or 0)
+                if length > self.max_body:
+                    await self._respond(writer, 413, {'error': f'body larger than {self.max_body} bytes'}, 'application/json', False)
+                    return
+                body = await reader.readexactly(length) if length else b''
+                status, response, content_type = await self.handle(method, target.split('?', 1)[0], body)
+                await self._respond(writer, status, response, content_type, keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, response, content_type, keep_alive):
+        data = (response if isinstance(response, str) else json.dumps(response)).encode()
+        writer.write((f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+                      f'Content-Type: {content_type}\r\n'
+                      f'Content-Length: {len(data)}\r\n'
+                      f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n').encode() + data)
+        await writer.drain()
+
+    async def serve(self, host='127.0.0.1', port=8500, ready_event=None):
+        """Starts the batchers and serves until cancelled.
+
+        Args:
+            host (str): interface to listen on
+            port (int): port to listen on, 0 picks a free one
+            ready_event (threading.Event): set once the socket listens, with the bound port in self.port
+        """
+        collectors = [batcher.start() for batcher in self.batchers.values()]
+        server = await asyncio.start_server(self.serve_connection, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        logger.info('serving on %s:%s', host, self.port)
+        if ready_event is not None:
+            ready_event.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for collector in collectors:
+                collector.cancel()
+            self.executor.shutdown(wait=False)
+
+
+###################### models ######################
+
+
+def bundle_file(bundle_dir, name):
+    """Returns the bundle file of a model in bundle_dir (see bundle.py), None without a bundle_dir."""
+    return None if bundle_dir is None else os.path.join(bundle_dir, name + '.bundle')
+
+
+def load_cbf_scorer(titles_path, sim_path, title_idx_path, instrumentation, cache=None, bundle_path=None):
+    from cbfilter import SimilarityScorer
+    if bundle_path is not None and os.path.exists(bundle_path):
+        return SimilarityScorer.load_bundle(bundle_path, instrumentation=instrumentation, cache=cache)
+    titles = pd.read_csv(titles_path, index_col='title_id')
+    title_idx_num = pd.read_csv(title_idx_path)
+    # seeds and titles whose romaji contains a seed's romaji(sequels, spin-offs) are excluded by id
+    return SimilarityScorer(sparse.load_npz(sim_path), title_idx_num.title_id.values, power=3,
+                            names=titles.title_romaji.reindex(title_idx_num.title_id).values,
+                            instrumentation=instrumentation, cache=cache)
+
+
+def load_ubf(asset_root, instrumentation, factor_rank=None, cache=None, compact=False, bundle_path=None):
+    from ubfilter import UserBasedFiltering
+    if bundle_path is not None and os.path.exists(bundle_path):
+        # the indexes are mapped from the bundle; the NearestNeighbors model is only fit if a query needs it
+        ubf = UserBasedFiltering.load_bundle(bundle_path, instrumentation=instrumentation, cache=cache)
+        if factor_rank and ubf.title_factors is None:
+            logger.info('title factors: %s', ubf.build_title_factors(factor_rank))
+        return ubf
+    ubf = UserBasedFiltering(asset_root, instrumentation=instrumentation, cache=cache, compact=compact)
+    # load what the endpoints query now rather than on the first request
+    for asset in ['model', 'title_pos', 'title_idx_arr', 'df_titles']:
+        getattr(ubf, asset)
+    ubf.rebuild_user_index()
+    ubf.rebuild_user_title_index()
+    if factor_rank:
+        logger.info('title factors: %s', ubf.build_title_factors(factor_rank))
+    return ubf
+
+
+def load_ibf(image_path, version, asset_root, instrumentation, cache=None, bundle_path=None):
+    from ibfilter import ImageBasedRecommendation
+    if bundle_path is not None and os.path.exists(bundle_path):
+        return ImageBasedRecommendation.load_bundle(bundle_path, image_path, instrumentation=instrumentation, cache=cache)
+    return ImageBasedRecommendation(image_path, version, asset_root, instrumentation=instrumentation, cache=cache)
+
+
+def build_registry(asset_root=DEFAULT_ASSET_ROOT, titles_path='titles_200p_synopsis_cleaned.csv', sim_path='latent_sim.npz',
+                   title_idx_path='title_idx_num.csv', image_version=None, image_path='', instrumentation=None, factor_rank=None,
+                   cache=None, compact=False, bundle_dir=None):
+    """Registers the served models (loaded later by warm_up).
+
+    Args:
+        asset_root (str): folder of the UserBasedFiltering/ImageBasedRecommendation assets
+        titles_path (str): titles csv the CBF alias exclusion reads the romaji from
+        sim_path (str): CBF similarity matrix (.npz)
+        title_idx_path (str): title_id of each row of the similarity matrix
+        image_version (str): image embedding version; None does not serve the image endpoint
+        image_path (str): character image folder
+        instrumentation (Instrumentation): passed to every model
+        factor_rank (int): serve the item kNN endpoints from truncated SVD title factors of this rank; None is exact
+        cache (QueryCache): query result cache shared by every model; None caches nothing
+        compact (bool): load the UserBasedFiltering tables in compact dtypes (see ubfilter.memory_report)
+        bundle_dir (str): folder of <model>.bundle files (see write_bundles); the models whose bundle exists are
+            memory-mapped from it instead of being built from the assets, and reloaded when it is replaced
+
+    Returns:
+        ModelRegistry
+    """
+    registry = ModelRegistry()
+    paths = {name: bundle_file(bundle_dir, name) for name in ['cbf_scorer', 'ubf', 'ibf']}
+    registry.register('cbf_scorer', lambda: load_cbf_scorer(titles_path, sim_path, title_idx_path, instrumentation, cache, paths['cbf_scorer']),
+                      version=file_version(*[p for p in [titles_path, sim_path, title_idx_path, paths['cbf_scorer']] if p]))
+    registry.register('ubf', lambda: load_ubf(asset_root, instrumentation, factor_rank, cache, compact, paths['ubf']),
+                      version=file_version(paths['ubf']) if paths['ubf'] else None)
+    if image_version:
+        registry.register('ibf', lambda: load_ibf(image_path, image_version, asset_root, instrumentation, cache, paths['ibf']),
+                          version=file_version(paths['ibf']) if paths['ibf'] else None)
+    return registry
+
+
+def write_bundles(registry, bundle_dir):
+    """Loads every registered model and writes its fitted state to bundle_dir/<model>.bundle.
+
+    Service processes started with the same bundle_dir then memory-map these files read-only: the
+    fitted state is not recomputed at startup and its pages are shared by every process.
+
+    Args:
+        registry (ModelRegistry): see build_registry
+        bundle_dir (str): folder to write the bundles to
+
+    Returns:
+        dict: bundle file of each model
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    paths = {}
+    for name in registry.status():
+        paths[name] = bundle_file(bundle_dir, name)
+        registry.get(name).save_bundle(paths[name])
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='recommendation service (CBF, UBF, item kNN and image endpoints)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8500)
+    parser.add_argument('--asset-root', default=DEFAULT_ASSET_ROOT)
+    parser.add_argument('--titles', default='titles_200p_synopsis_cleaned.csv')
+    parser.add_argument('--sim', default='latent_sim.npz')
+    parser.add_argument('--title-idx', default='title_idx_num.csv')
+    parser.add_argument('--image-version', default=None, help='serve /recommend/image with this embedding version')
+    parser.add_argument('--image-path', default='')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=2.0, help='seconds before a request gets a 504')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    parser.add_argument('--factor-rank', type=int, default=None, help='approximate item kNN over SVD title factors of this rank')
+    parser.add_argument('--cache-mb', type=float, default=64, help='memory cap of the query result cache, 0 disables it')
+    parser.add_argument('--cache-ttl', type=float, default=None, help='seconds a cached result stays valid')
+    parser.add_argument('--compact', action='store_true', help='compact-dtype UserBasedFiltering tables (less memory per worker)')
+    parser.add_argument('--bundle-dir', default=None, help='memory-map the models from the <model>.bundle files of this folder')
+    parser.add_argument('--write-bundles', action='store_true', help='build the models, write them to --bundle-dir and exit')
+    parser.add_argument('--debug', action='store_true', help='record stage timings, exported on /metrics')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    instrumentation = Instrumentation(enabled=args.debug)
+    cache = QueryCache(int(args.cache_mb * 2**20), args.cache_ttl, instrumentation) if args.cache_mb > 0 else None
+    if args.write_bundles and args.bundle_dir is None:
+        parser.error('--write-bundles needs --bundle-dir')
+    # bundles are always written from the assets, never from the previous bundles
+    registry = build_registry(args.asset_root, args.titles, args.sim, args.title_idx, args.image_version, args.image_path, instrumentation,
+                              args.factor_rank, cache, args.compact, None if args.write_bundles else args.bundle_dir)
+    if args.write_bundles:
+        for name, path in write_bundles(registry, args.bundle_dir).items():
+            logger.info('%s -> %s', name, path)
+        sys.exit(0)
+    registry.warm_up(background=True)
+    service = RecommendService(registry, instrumentation, args.workers, args.timeout,
+                               max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000, cache=cache)
+    asyncio.run(service.serve(args.host, args.port))
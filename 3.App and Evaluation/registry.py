@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+
+
+def file_version(*paths):
+    """Builds a version callable from the modification times of asset files.
+
+    Args:
+        paths (str): files the model is loaded from
+
+    Returns:
+        callable: returns a string that changes whenever one of the files changes
+    """
+    def version():
+        return '|'.join(str(os.path.getmtime(p)) if os.path.exists(p) else 'missing' for p in paths)
+    return version
+
+
+class ModelRegistry:
+    def __init__(self):
+        """Process-wide registry of read-only models shared by every session.
+
+        Each model is loaded once by its loader and then handed out to every
+        caller; sessions must treat the returned objects as read-only. A model
+        is reloaded when reload() is called or, on refresh(), when its version
+        callable reports a new asset version. The new model is built next to
+        the old one and swapped in at once, so readers never see a partial load.
+        """
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def register(self, name, loader, version=None):
+        """Registers a model without loading it.
+
+        Args:
+            name (str): name the model is retrieved with
+            loader (callable): builds the model, called without arguments
+            version (callable): returns the current asset version, see file_version
+        """
+        with self._lock:
+            self._entries[name] = {'loader': loader, 'version_fn': version, 'lock': threading.Lock(),
+                                   'model': None, 'loaded': False, 'asset_version': None,
+                                   'generation': 0, 'load_seconds': None, 'loaded_at': None}
+
+    def _load(self, entry):
+        start = time.perf_counter()
+        asset_version = entry['version_fn']() if entry['version_fn'] else None
+        model = entry['loader']()
+        entry.update({'model': model, 'loaded': True, 'asset_version': asset_version,
+                      'generation': entry['generation'] + 1,
+                      'load_seconds': time.perf_counter() - start, 'loaded_at': time.time()})
+
+    def get(self, name):
+        """Returns the shared model, loading it on first use.
+
+        Args:
+            name (str): registered name
+
+        Returns:
+            the model
+        """
+        entry = self._entries[name]
+        if not entry['loaded']:
+            with entry['lock']:
+                if not entry['loaded']:
+                    self._load(entry)
+        return entry['model']
+
+    def version(self, name):
+        """Returns (generation, asset version) of a model; generation counts its loads."""
+        entry = self._entries[name]
+        return entry['generation'], entry['asset_version']
+
+    def warm_up(self, names=None, background=False):
+        """Loads models ahead of the first request.
+
+        Args:
+            names (list): models to load, default all registered ones (in registration order)
+            background (bool): load in a daemon thread; get() waits for a model still being loaded
+
+        Returns:
+            threading.Thread or None: the loading thread when background is True
+        """
+        names = list(self._entries) if names is None else names
+
+        def load_all():
+            for name in names:
+                self.get(name)
+
+        if not background:
+            load_all()
+            return None
+        thread = threading.Thread(target=load_all, name='registry-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def reload(self, name):
+        """Rebuilds a model and swaps it in; callers keep the old one until they call get() again.
+
+        Args:
+            name (str): registered name
+        """
+        entry = self._entries[name]
+        with entry['lock']:
+            self._load(entry)
+
+    def refresh(self):
+        """Reloads the loaded models whose asset version changed.
+
+        Returns:
+            list: names of the reloaded models
+        """
+        reloaded = []
+        for name, entry in list(self._entries.items()):
+            if entry['loaded'] and entry['version_fn'] and entry['version_fn']() != entry['asset_version']:
+                self.reload(name)
+                reloaded.append(name)
+        return reloaded
+
+    def status(self):
+        """Returns a dictionary of name: generation, asset version and load time of each model."""
+        return {name: {k: entry[k] for k in ['loaded', 'generation', 'asset_version', 'load_seconds', 'loaded_at']}
+                for name, entry in self._entries.items()}
@@ -0,0 +1,94 @@
+import json
+import urllib.error
+import urllib.request
+
+
+class ServiceError(Exception):
+    """Raised when the recommendation service answers with an error status."""
+
+    def __init__(self, status, message):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+
+
+class RecommenderClient:
+    def __init__(self, base_url='http://127.0.0.1:8500', timeout=5.0):
+        """Thin client of recommend_service.py.
+
+        Args:
+            base_url (str): address of the service
+            timeout (float): seconds to wait for an answer
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, payload=None):
+        data = None if payload is None else json.dumps(payload).encode()
+        request = urllib.request.Request(self.base_url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = response.read().decode()
+                return json.loads(body) if response.headers.get_content_type() == 'application/json' else body
+        except urllib.error.HTTPError as e:
+            body = e.read().decode()
+            try:
+                message = json.loads(body).get('error', body)
+            except ValueError:
+                message = body
+            raise ServiceError(e.code, message)
+
+    def ready(self):
+        """Returns True once every model of the service is loaded."""
+        try:
+            return self._request('/readyz')['ready']
+        except (ServiceError, OSError):
+            return False
+
+    def metrics(self):
+        """Returns the Prometheus text of the service's instrumentation."""
+        return self._request('/metrics')
+
+    def recommend_cbf(self, title_ids, k=50):
+        """Content based recommendations for a list of seed titles.
+
+        Returns:
+            tuple: list of title_ids and list of their scores, best first
+        """
+        res = self._request('/recommend/cbf', {'title_ids': [int(t) for t in title_ids], 'k': k})
+        return res['title_ids'], res['scores']
+
+    def recommend_ubf_titles(self, title_ids, n_titles=50, output_neighbors=51, fusion='min'):
+        """Item kNN recommendations over the title:user matrix for a list of seed titles.
+
+        Returns:
+            tuple: list of title_ids and list of their fused scores, best first
+        """
+        res = self._request('/recommend/ubf/titles', {'title_ids': [int(t) for t in title_ids], 'n_titles': n_titles,
+                                                      'output_neighbors': output_neighbors, 'fusion': fusion})
+        return res['title_ids'], res['scores']
+
+    def recommend_ubf_user(self, user_id, n_titles=10, method='refer_others'):
+        """Unread titles of the users most similar to user_id.
+
+        Returns:
+            dict: similar_user_ids and title_ids
+        """
+        return self._request('/recommend/ubf/user', {'user_id': int(user_id), 'n_titles': n_titles, 'method': method})
+
+    def item_neighbors(self, title_id, k=10):
+        """Nearest titles of one title in the title:user matrix.
+
+        Returns:
+            tuple: list of title_ids and list of their cosine distances, nearest first
+        """
+        res = self._request('/neighbors/item', {'title_id': int(title_id), 'k': k})
+        return res['title_ids'], res['distances']
+
+    def recommend_image(self, title_id, top_n=10):
+        """Titles whose characters look alike.
+
+        Returns:
+            tuple: list of title_ids and list of their similarities, most similar first
+        """
+        res = self._request('/recommend/image', {'title_id': int(title_id), 'top_n': top_n})
+        return res['title_ids'], res['similarities']
@@ -1,3 +1,5 @@
+import os
+import sys
 import json
 from ast import literal_eval
 import streamlit as st
@@ -12,7 +14,58 @@ import datetime
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import db
-from ubfilter import UserBasedFiltering
+
+# instrumentation.py lives in 2.RecommenderSystem
+RECOMMENDER_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '2.RecommenderSystem')
+sys.path.append(RECOMMENDER_ROOT)
+from eventlog import EventLogger, FirebaseSink
+from registry import ModelRegistry, file_version
+from titlesearch import TitleSearchIndex
+from instrumentation import Instrumentation
+from service_client import RecommenderClient, ServiceError
+
+
+@st.experimental_singleton
+def get_instrumentation():
+    """Creates the app-side stage timers once per process.
+
+    Disabled unless the app is started with OTAKU_DEBUG=1; every session then
+    shows the breakdown of its last recommendation(service call, metadata
+    merge) and the service's own metrics in a debug panel.
+    """
+    return Instrumentation(enabled = os.environ.get('OTAKU_DEBUG') == '1')
+
+
+@st.experimental_singleton
+def get_client():
+    """Client of the recommendation service(recommend_service.py), which holds the models.
+
+    The service address is read from OTAKU_SERVICE_URL.
+    """
+    return RecommenderClient(os.environ.get('OTAKU_SERVICE_URL', 'http://127.0.0.1:8500'))
+
+
+@st.experimental_singleton
+def get_registry():
+    """Creates the registry of the title data once per process and starts loading it.
+
+    The recommenders run in the recommendation service; the app only keeps
+    the titles it displays and searches. Every session shares them, and they
+    are reloaded by registry.refresh() when their file changes.
+    """
+    registry = ModelRegistry()
+    registry.register('titles', lambda : pd.read_csv('titles_200p_synopsis_cleaned.csv', index_col = 'title_id'), 
+                      version = file_version('titles_200p_synopsis_cleaned.csv'))
+    registry.register('title_search', lambda : TitleSearchIndex(registry.get('titles')), 
+                      version = file_version('titles_200p_synopsis_cleaned.csv'))
+    registry.warm_up(background = True)
+    return registry
+
+
+registry = get_registry()
+registry.refresh()
+instrumentation = get_instrumentation()
+client = get_client()
 
 
 if 'yes' not in st.session_state:
@@ -56,28 +109,30 @@ if st.session_state['yes']:
     except:
         firebase_admin.initialize_app(cred, dburl)
 
-    if 'session_id' not in st.session_state:
-        dbdir = db.reference('sessions')
-        if dbdir.get() == None:
-            session_id = 1
-        else:
-            session_id = dbdir.get()['session_id'] + 1
+    @st.experimental_singleton
+    def get_event_logger():
+        """Creates the clickstream logger once per process.
 
-        dbdir.update({'session_id':session_id})
+        Events are buffered locally and pushed to the realtime database by a
+        background thread, so logging never waits for a Firebase round trip;
+        the app logs with block = False, so a full buffer drops events instead of stalling a page.
+        """
+        return EventLogger(FirebaseSink(db.reference), buffer_dir = 'event_buffer')
+
+    event_logger = get_event_logger()
+
+    if 'session_id' not in st.session_state:
+        # increment the counter in a transaction so that concurrent sessions never get the same id
+        session_id = db.reference('sessions/session_id').transaction(lambda current : (current or 0) + 1)
         st.session_state['session_id'] = session_id
         st.session_state['abtest_id'] = np.random.choice([0,1])
 
-        dbdir = db.reference('user_sessions')
-
         session_info = {'session_id':str(st.session_state['session_id']),
                         'abtest_id':str(st.session_state['abtest_id']),
                         'timestamp':str(datetime.datetime.now())}
 
 
-        dbdir.push().set(session_info)
-
-
-    dbdir = db.reference('test')
+        event_logger.log('user_sessions', session_info, block = False)
 
 
     st.title('Project Otaku: comic/anime recommender system')
@@ -88,8 +143,7 @@ if st.session_state['yes']:
     #     st.write('ubf')
     
     
-    if 'dataset' not in st.session_state:
-        st.session_state['titles'] = pd.read_csv('titles_200p_synopsis_cleaned.csv', index_col = 'title_id')
+    titles = registry.get('titles')
 
 
     def aggrid_interactive_table(df: pd.DataFrame):
@@ -123,9 +177,10 @@ if st.session_state['yes']:
 
     keyword = st.text_input("What is your favorite anime/comic")
     if keyword == '':
-        _titles = st.session_state['titles'].drop(['cover_image_url','adult'], axis = 1)
+        _titles = titles.drop(['cover_image_url','adult'], axis = 1)
     else:
-        _titles = st.session_state['titles'].fillna('').loc[lambda x : (x.title_english.apply(lambda x : x.lower()).str.contains(keyword.lower())) | (x.title_romaji.apply(lambda x : x.lower()).str.contains(keyword.lower()))].drop(['cover_image_url','adult'], axis = 1)
+        # prefix matches first, then substring matches, each ranked by popularity
+        _titles = titles.loc[registry.get('title_search').search(keyword)].fillna('').drop(['cover_image_url','adult'], axis = 1)
 
     selection = aggrid_interactive_table(df=_titles.reset_index())
 
@@ -172,28 +227,9 @@ if st.session_state['yes']:
     
 ####################### initializing algorithms #########################
 
-    if st.session_state['abtest_id'] == 0:
-        ##############################
-        #                            #
-        #  content based filtering   #
-        #                            #
-        ##############################
-        
-        if 'titles_sim' not in st.session_state:
-            st.session_state['titles_sim'] = sparse.load_npz("latent_sim.npz")
-            st.session_state['title_idx_num'] = pd.read_csv('title_idx_num.csv')
-            
-        # titles_sim = pd.DataFrame(cosine_similarity(latent_mat), index = latent_mat.index, columns = latent_mat.index)
-        
-    else:
-        ##############################
-        #                            #
-        #    user based filtering    #
-        #                            #
-        ##############################
-        
-        if 'ubf' not in st.session_state:
-            st.session_state['ubf'] = UserBasedFiltering() # initialize module
+    # both algorithms(content based filtering / user based filtering) run in the recommendation service
+    if not client.ready():
+        st.warning('The recommender is still starting up, recommendations may take a moment.')
 
 
     if 'button' not in st.session_state:
@@ -218,22 +254,15 @@ if st.session_state['yes']:
             #                            #
             ##############################
 
-            idx = st.session_state['title_idx_num'].loc[lambda x : x.title_id.isin(final_selected_title_id)].index
-            r = st.session_state['titles_sim'][idx]
-            result_list = (-(r.toarray()**3).sum(axis = 0)).argsort()
-            result_list = result_list[~np.isin(result_list, idx)][:50]
-            
-            result = st.session_state['title_idx_num'].loc[result_list].merge(st.session_state['titles'], how = 'left', on = 'title_id')
-            # sim_list = st.session_state['titles_sim'].loc[final_selected_title_id]
-            # wa = sim_list.values
-            # wa[np.where(wa < 0)] = 0
-            # sim_list = pd.DataFrame(wa**3, columns = st.session_state['latent_mat'].index).sum()
-            # sim_list = sim_list.sort_values(ascending = False).to_frame()
-            # # .sort_values(ascending = False).iloc[1:21].to_frame().rename(columns = {selected_id:'similarity'})
-            # result = sim_list.reset_index().merge(st.session_state['titles'], how = 'left', on = 'title_id')
-            fst_pattern = str(final_selected_title_name).replace(',','|').replace('[','').replace("'",'').replace(']','').replace('| ','|').lower()
-            # st.write(fst_pattern)
-            result = result.loc[lambda x : ~x.title_romaji.str.lower().str.contains(fst_pattern)].head(50)
+            with instrumentation.request('cbf') as debug_request:
+                try:
+                    with instrumentation.stage('app.service_call'):
+                        result_list, _ = client.recommend_cbf(final_selected_title_id, k = 50)
+                except (ServiceError, OSError) as e:
+                    st.error(f'The recommender is not available right now, please try again later. ({e})')
+                    st.stop()
+                with instrumentation.stage('app.metadata_merge'):
+                    result = pd.DataFrame({'title_id' : result_list}).merge(titles, how = 'left', on = 'title_id')
           
             
             
@@ -248,42 +277,53 @@ if st.session_state['yes']:
             # st.session_state['ubf'].evaluate_by_overlap_titles(top_10_similar_user_ids)
             # recommended_titles = st.session_state['ubf'].recommend_unread_titles(50, top_10_similar_user_ids,final_selected_title_id, method="refer_others")        
             
-            result = pd.DataFrame( columns = ['title_id','distances'])            
-            for title in final_selected_title_id:
-                result = pd.concat([result, st.session_state['ubf'].recommend_from_other_user_histories(title, output_neighbors=51).loc[lambda x : ~x.title_id.isin(result.title_id)]])
-                
-            result = result.sort_values('distances').loc[lambda x : ~x.title_id.isin(final_selected_title_id)].head(50)
-            result = result.merge(st.session_state['titles'], how = 'left', on = 'title_id')
+            # one neighbor search for all the selected titles, ranked by the nearest of them
+            with instrumentation.request('ubf') as debug_request:
+                try:
+                    with instrumentation.stage('app.service_call'):
+                        result_list, result_scores = client.recommend_ubf_titles(final_selected_title_id, n_titles = 50, output_neighbors = 51, fusion = 'min')
+                except (ServiceError, OSError) as e:
+                    st.error(f'The recommender is not available right now, please try again later. ({e})')
+                    st.stop()
+                with instrumentation.stage('app.metadata_merge'):
+                    result = pd.DataFrame({'title_id' : result_list, 'distances' : 1 - np.array(result_scores)})
+                    result = result.merge(titles, how = 'left', on = 'title_id')
+
+        if instrumentation.enabled:
+            with st.sidebar.expander('debug: recommendation breakdown'):
+                st.write(f"{debug_request['name']}: {debug_request['seconds'] * 1000:.1f} ms")
+                st.dataframe(pd.DataFrame(debug_request['stages'], columns = ['stage', 'seconds', 'allocated_bytes']))
+                st.write(debug_request['counters'])
+                try:
+                    st.code(client.metrics())
+                except (ServiceError, OSError):
+                    st.code(instrumentation.prometheus())
         
         
 ####################### pushing query data #########################        
         
         if 'selected_id' not in st.session_state:
             st.session_state['selected_id'] = selected_id
-            dbdir = db.reference('query')
 
             update_query = {'session_id':st.session_state['session_id'],
                             'query':st.session_state['selected_id'],
                             'timestamp':str(datetime.datetime.now())}
 
-            dbdir.push().set(update_query)
+            event_logger.log('query', update_query, block = False)
 
         else:
             if st.session_state['selected_id'] != selected_id and selected_id != -1:
                 st.session_state['selected_id'] = selected_id
-                dbdir = db.reference('query')
 
                 update_query = {'session_id':st.session_state['session_id'],
                                 'query':st.session_state['selected_id'],
                                 'timestamp':str(datetime.datetime.now())}
 
-                dbdir.push().set(update_query)
+                event_logger.log('query', update_query, block = False)
             else:
                 pass
 
 
-        dbdir = db.reference('test')
-
         buttons = []
         # st.write(len(result))
 
@@ -331,8 +371,8 @@ if st.session_state['yes']:
                           'timestamp': str(datetime.datetime.now())}
                 
                 # st.write(update)
-                dbdir.push().set(update)
-                chosen = st.session_state['titles'].loc[int(update['title_id'])].to_dict()
+                event_logger.log('test', update, block = False)
+                chosen = titles.loc[int(update['title_id'])].to_dict()
                 st.session_state['bucket'].append(chosen)
 
 ####################### bucket #########################                
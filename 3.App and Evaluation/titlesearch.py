@@ -0,0 +1,85 @@
+import re
+import unicodedata
+import numpy as np
+
+
+def normalize(text):
+    """Lower-cases, strips accents and collapses punctuation/whitespace of a title.
+
+    Args:
+        text (str): title or search keyword
+
+    Returns:
+        str: normalized text
+    """
+    if not isinstance(text, str):
+        return ''
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return re.sub(r'[\W_]+', ' ', text).strip()
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TitleSearchIndex:
+    def __init__(self, titles, columns=('title_romaji', 'title_english'), popularity='popularity'):
+        """Search index over the normalized title names, built once at load.
+
+        Titles are ranked by popularity once; every posting list of the trigram
+        inverted index is stored in that rank order, so intersecting them keeps
+        the results sorted by popularity without sorting per keystroke. Keywords
+        shorter than three characters have no trigram and are found by scanning
+        the names, which are kept in the same rank order.
+
+        Args:
+            titles (pd.DataFrame): titles indexed by title_id
+            columns (tuple): name columns to search
+            popularity (str): column used to rank the results
+        """
+        ranked = titles.sort_values(popularity, ascending=False, kind='mergesort') if popularity in titles else titles
+        self.title_ids = ranked.index.values
+        self.names = [' | '.join(n for n in map(normalize, names) if n) for names in zip(*(ranked[c] for c in columns))]
+        self.names_arr = np.array(self.names, dtype=str)
+
+        postings = {}
+        for rank, name in enumerate(self.names):
+            for gram in trigrams(name):
+                postings.setdefault(gram, []).append(rank)
+        self.postings = {gram: np.array(ranks, dtype=np.int32) for gram, ranks in postings.items()}
+
+    def search(self, keyword, limit=None):
+        """Titles whose romaji or English name contains the keyword.
+
+        Titles whose name starts with the keyword come first, then the other
+        matches; both groups are ordered by popularity.
+
+        Args:
+            keyword (str): text typed in the search box
+            limit (int): maximum number of results, None returns all
+
+        Returns:
+            np.ndarray: matching title_ids
+        """
+        keyword = normalize(keyword)
+        if keyword == '':
+            ranks = np.arange(len(self.title_ids))
+        elif len(keyword) < 3:
+            # no trigram to look up: substring scan of every name, already in popularity order
+            ranks = np.nonzero(np.char.find(self.names_arr, keyword) >= 0)[0]
+        else:
+            grams = sorted(trigrams(keyword), key=lambda g: len(self.postings.get(g, ())))
+            ranks = self.postings.get(grams[0], np.array([], dtype=np.int32))
+            for gram in grams[1:]:
+                if len(ranks) == 0:
+                    break
+                ranks = np.intersect1d(ranks, self.postings.get(gram, ranks[:0]), assume_unique=True)
+            # trigrams only narrow the candidates down; check the actual substring
+            ranks = ranks[np.char.find(self.names_arr[ranks], keyword) >= 0]
+
+        if len(ranks) and keyword:
+            names = self.names_arr[ranks]
+            is_prefix = np.char.startswith(names, keyword) | (np.char.find(names, ' | ' + keyword) >= 0)
+            ranks = np.concatenate([ranks[is_prefix], ranks[~is_prefix]])
+        return self.title_ids[ranks[:limit]]